@@ -1,32 +1,45 @@
 import argparse
-import importlib.util
-import io
-import json
+import asyncio
 import logging
-import os
 import re
 import sys
+import tempfile
 import time
-import urllib
-import urllib.parse
-import urllib.request
-import subprocess
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import List, Optional, Tuple
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
 
-import gruut
-import pyaudio
 import speech_recognition as stt
-import torch
-import torchaudio
-from TTS.api import TTS
-from pydub import AudioSegment
-from pydub.playback import play as play_audio_segment
 
 
+from .async_dialog import AsyncDialog
+from .audio import PCMAudio
+from .bench import FakeKoboldServer, WavFileSource
+from .capture import ContinuousCapture
+from .chat_log import ChatHistory, ChatLog, TokenCounter
+from .filler import LatencyModel, ThinkingFiller
+from .fixtures import default_fixture_phrases, load_fixture, render_fixtures
+from .import_profile import profile_imports
+from .keyword_spotter import KeywordSpotter
+from .kobold_client import KoboldAPIError, backoff_delays, build_kobold_client
+from .memory import ModelEvictor, format_rss, rss_bytes
+from .metrics import metrics, print_stats
+from .model_host import ModelHost, ModelHostClient, ModelHostError, RemoteSTTBackend, RemoteTTSEngine
+from .normalizer import TextNormalizer
+from .playback import NullAudioOutput, PlaybackEngine, PyAudioOutput
 from .radio_silence import RadioSilence
-from .settings import build_settings
+from .response_cache import ResponseCache
+from .settings import SettingsWatcher, build_settings
+from .speech_gate import SpeechGate
+from .speculation import Speculation, Speculator
+from .stt_bench import run_stt_benchmark
+from .stt_backends import build_stt_backend, stt_backend_names
+from .text_bench import run_text_benchmark
+from .tts_cache import TTSCache
+from .tts_engine import TTSEngine
 
 
 logger = logging.getLogger('kobold-assistant')
@@ -52,7 +65,7 @@ def get_microphone_device_id(Microphone) -> int:
     return None
 
 
-def prompt_ai(prompt: str, stop_words: List[str]) -> str:
+def build_generate_request(prompt: str, stop_words: List[str]) -> dict:
     post_data = {
         'prompt': prompt,
         'temperature': settings.GENERATE_TEMPERATURE,
@@ -61,113 +74,289 @@ def prompt_ai(prompt: str, stop_words: List[str]) -> str:
         'rep_pen': 1.5,
         'stop_sequence': stop_words,
         'frmttriminc': True,
+        # identifies the request, so that it alone can be aborted
+        'genkey': f'KA{uuid.uuid4().hex}',
     }
 
     if settings.ASSISTANT_SOUL_NUMBER:
         post_data['sampler_seed'] = settings.ASSISTANT_SOUL_NUMBER
 
-    post_json = json.dumps(post_data)
-    post_json_bytes = post_json.encode('utf8')
+    return post_data
 
-    logger.debug("Calling settings.GENERATE_URL %r with request %r", settings.GENERATE_URL, post_json)
 
-    req = urllib.request.Request(settings.GENERATE_URL, method="POST")
-    req.add_header('Content-Type', 'application/json; charset=utf-8')
+@contextmanager
+def abortable_response_generation(abort: Callable[[], None]):
+    """While in this context, abort_response_generation() calls abort, to stop generating the response"""
+
+    global response_generation_abort # horrible hack for now
+
+    with response_generation_lock:
+        response_generation_abort = abort
 
     try:
-        response_obj = urllib.request.urlopen(req, data=post_json_bytes)
-        response_charset = response_obj.info().get_param('charset') or 'utf-8'
-        json_response = json.loads(response_obj.read().decode(response_charset))
+        yield
 
-        try:
-            response_text = json_response['results'][0]['text']
-            return response_text
-        except (KeyError, IndexError) as e:
-            logger.error("KoboldAI API returned an unexpected response format!")
-            return None
+    finally:
+        with response_generation_lock:
+            response_generation_abort = None
+
+
+def abort_response_generation():
+    """Stop generating the assistant's current response (e.g., on barge-in), if it's being generated"""
 
-    except urllib.error.URLError as e:
+    with response_generation_lock:
+        abort = response_generation_abort
+
+    if abort is not None:
+        abort()
+
+
+def prompt_ai(prompt: str, stop_words: List[str], speculation: Optional[Speculation] = None) -> Optional[str]:
+    """Get the LLM's response to prompt, or the speculation's response, if given"""
+
+    try:
+        with metrics.span('llm_total'):
+            if speculation is not None:
+                with abortable_response_generation(speculation.cancel):
+                    return ''.join(speculation.tokens())
+
+            post_data = build_generate_request(prompt, stop_words)
+            with abortable_response_generation(lambda: kobold_client.abort(post_data['genkey'])):
+                return kobold_client.generate(post_data)
+    except KoboldAPIError as e:
         logger.error(f"The KoboldAI API returned %r!", e)
 
     return None
 
-# horrible global hack for now; will get fixed
-temp_audio_files = {}
 
+def speculate(chat_log: ChatLog, transcript: str) -> Optional[Speculation]:
+    """Start generating a response to a partial transcript, for the Speculator, unless it's not for the assistant to respond to"""
+
+    user_command = clean_as_user_command(transcript)
+    if sleeping or user_command in (settings.SLEEP_COMMAND.lower(), settings.WAKE_COMMAND.lower()) or transcript in settings.STT_HALLUCINATIONS:
+        return None
+
+    chat_state = chat_log.build_prompt()
+    post_data = build_generate_request(chat_log.build_prompt([ f'{settings.USER_NAME}: {transcript}' ]), settings.AI_MODEL_STOP_WORDS)
+
+    if settings.STREAM_AI_RESPONSES:
+        tokens = kobold_client.stream(post_data)
+    else:
+        def generate_all_at_once():
+            yield kobold_client.generate(post_data)
+
+        tokens = generate_all_at_once()
+
+    # a blocking generate() only returns early if it's aborted, so a superseded speculation would otherwise hold up the LLM
+    return Speculation(transcript, chat_state, tokens, abort=lambda: kobold_client.abort(post_data['genkey']))
+
+
+def summarize_dialog(previous_summary: Optional[str], lines: List[str]) -> Optional[str]:
+    """Ask the LLM for a running summary of the dialog, for ChatLog to remember it by"""
+
+    summary_lines = [ ChatLog.summary_format.format(summary=previous_summary) ] if previous_summary else []
+    prompt = '\n'.join((settings.CHAT_SUMMARY_INSTRUCTION, *summary_lines, *lines, settings.CHAT_SUMMARY_CUE))
+
+    post_data = build_generate_request(prompt, [ '###', '</s>' ])
+    post_data['max_length'] = settings.CHAT_SUMMARY_MAX_TOKENS
+
+    try:
+        summary = kobold_client.generate(post_data)
+    except KoboldAPIError as e:
+        logger.error(f"The KoboldAI API returned %r, while summarizing the dialog!", e)
+        return None
+
+    return strip_stop_words(summary)
+
+
+def prompt_ai_streamed(prompt: str, stop_words: List[str], speculation: Optional[Speculation] = None) -> Iterator[str]:
+    """
+    Like prompt_ai(), but yields the response a token at a time, as it's generated,
+    using the server-sent events (SSE) streaming endpoint that KoboldCPP provides.
+    With a speculation, its tokens are yielded instead.
+
+    Yields nothing if the request fails.
+    """
+
+    start_time = time.perf_counter()
+    got_first_token = False
+    try:
+        if speculation is not None:
+            tokens = speculation.tokens()
+            abort = speculation.cancel
+        else:
+            post_data = build_generate_request(prompt, stop_words)
+            tokens = kobold_client.stream(post_data)
+            abort = lambda: kobold_client.abort(post_data['genkey'])
+
+        # aborting ends the stream straight away, rather than at the next sentence
+        with abortable_response_generation(abort):
+            for token in tokens:
+                if not got_first_token:
+                    metrics.record('llm_first_token', time.perf_counter() - start_time)
+                    got_first_token = True
+
+                yield token
+
+        metrics.record('llm_total', time.perf_counter() - start_time)
+
+    except KoboldAPIError as e:
+        logger.error(f"The KoboldAI API returned %r!", e)
+
+
+# splits after sentence-ending punctuation (plus any closing quotes/brackets) that's
+# followed by whitespace, or at line breaks, so that "2.5" or "e.g" don't split.
+sentence_end_re = re.compile(r'[.!?\u2026]+["\')\]]*\s+|\n+')
+
+
+def partial_stop_word_length(text: str, stop_words: List[str]) -> int:
+    """The length of the longest end of text that could be the start of a stop word"""
+    return max((n for stop_word in stop_words for n in range(1, len(stop_word)) if text.endswith(stop_word[:n])), default=0)
+
+
+def split_into_sentences(tokens: Iterable[str], stop_words: List[str]) -> Iterator[str]:
+    """
+    Reassemble a stream of tokens into whole sentences, yielding each one
+    as soon as it's complete.  Stops at the first stop word, since
+    everything after that isn't part of the response.
+    """
+
+    buffer = ""
+    for token in tokens:
+        buffer += token
+
+        found_stop_word = False
+        for stop_word in stop_words:
+            if stop_word in buffer:
+                logger.debug("stop word %r FOUND in streamed response %r", stop_word, buffer)
+                buffer = buffer.split(stop_word)[0]
+                found_stop_word = True
+
+        while True:
+            # what might be the start of a stop word (such as the newline of
+            # "\nUser:") can't end a sentence until the next token says if it is
+            held_back = 0 if found_stop_word else partial_stop_word_length(buffer, stop_words)
+            sentence_end = sentence_end_re.search(buffer, 0, len(buffer) - held_back)
+            if sentence_end is None:
+                break
+
+            sentence = buffer[:sentence_end.end()].strip()
+            buffer = buffer[sentence_end.end():]
+
+            if sentence:
+                yield sentence
+
+        if found_stop_word:
+            break
 
-def expand_text(text_match) -> str:
-    text = text_match.group(0)
-    replacement = ' '.join([ s.text_spoken for s in gruut.sentences(text) ])
-    return replacement
+    if buffer.strip():
+        yield buffer.strip()
 
 
-def expand_to_pronounced_word_form(text):
-    """Detect mathematical formulae and abbreviations, and replace them"""
+# TODO: make these non-global
+playback_engine = None
+audio_output = None
+capture = None
+stt_backend = None
+keyword_spotter = None
+speech_gate = None
+kobold_client = None
+normalizer = None
+settings_watcher = None
+model_host_client = None
+speculator = None
+response_cache = None
+thinking_filler = None
+model_evictor = None
 
-    component = r"([0-9]|[A-Za-z]+)"
-    term = component + r"\." + component
-    abbreviation = r"([A-Z](\.|)){2,}"
-    expr_pattern = r"(" + term + r"|" + abbreviation + r"|" + r"\=" + r")"
+# stops generating the assistant's current response; see abortable_response_generation()
+response_generation_abort = None
+response_generation_lock = threading.Lock()
 
-    expanded_text = re.sub(expr_pattern, expand_text, text)
+# serializes speech recognition, which the speculator also does, in the background
+stt_lock = threading.Lock()
 
-    return expanded_text
+# set while say() is playing audio itself, rather than via the playback engine
+speaking = threading.Event()
 
+sleeping = False
 
-def say(tts_engine, text, cache=False, warmup_only=False):
-    # horrible global hack for now; will get fixed
-    global temp_audio_files
+
+def synthesize(tts_engine, text, cache=False) -> PCMAudio:
+    with metrics.span('text_expand'):
+        expanded_text = normalizer.expand(text)
+
+    with metrics.span('tts_synthesis'):
+        return tts_engine.synthesize(expanded_text, cache=cache or settings.TTS_CACHE_ALL_RESPONSES)
+
+
+def synthesize_batch(tts_engine, texts: List[str], cache=False) -> List[PCMAudio]:
+    with metrics.span('text_expand'):
+        expanded_texts = [ normalizer.expand(text) for text in texts ]
+
+    with metrics.span('tts_synthesis'):
+        return tts_engine.synthesize_batch(expanded_texts, cache=cache or settings.TTS_CACHE_ALL_RESPONSES)
+
+
+def play(audio: PCMAudio, should_stop=None):
+    metrics.first_audio()
+
+    with metrics.span('playback'):
+        audio_output.play(audio, should_stop)
+
+
+def say(tts_engine, text, cache=False, warmup_only=False, wait=True):
+    """
+    Speak text aloud.  If the playback engine is running, the text is split into
+    sentences and queued, so that later sentences are synthesized while earlier
+    ones play.  With wait=False, returns without waiting for that to finish.
+    """
 
     assert text.strip() != "", "called say() without any text"
 
-    # TODO: Choose (or obtain from config) the best speaker
-    #       in a better way, per tss_engine.
-    if tts_engine.speakers is not None and len(tts_engine.speakers) > 0:
-        params['speaker'] = tts_engine.speakers[0]
+    if warmup_only:
+        synthesize(tts_engine, text, cache=cache)
+        return
+
+    if playback_engine is None:
+        if cache:
+            audios = [ synthesize(tts_engine, text, cache=True) ]
+        else:
+            # without the playback engine to overlap synthesis with playback,
+            # synthesize all of the sentences of a long response together
+            audios = synthesize_batch(tts_engine, list(split_into_sentences([text], [])))
 
-    # TODO: Choose (or obtain from config) the best language in a better
-    #       way, based on locale.
-    if tts_engine.languages is not None and len(tts_engine.languages) > 0:
-        params['language'] = tts_engine.languages[0]
+        speaking.set()
+        try:
+            for audio in audios:
+                play(audio)
+        finally:
+            speaking.clear()
 
-    expanded_text = expand_to_pronounced_word_form(text)
+        return
 
-    if text in temp_audio_files:
-        audio = temp_audio_files[text]
+    if cache:
+        # keep cached phrases whole, so that they're found in the cache next time
+        playback_engine.say(text, cache=True)
     else:
-        audio_file = NamedTemporaryFile()
-
-        params = {
-            "emotion": "Happy",
-            "speed": settings.TTS_SPEECH_SPEED,
-            "text": expanded_text,
-            "file_path": audio_file.name,
-        }
-
-        tts_done = False
-        while not tts_done:
-            try:
-                with RadioSilence(stdout=True, stderr=False):
-                    wav_audio = tts_engine.tts_to_file(**params)
-                tts_done = True
-            except Exception as e:
-                logger.error(
-                    "WARNING:"
-                    " TTS model %r threw error %r. Retrying. If this keeps failing,"
-                    " override the TTS_MODEL_NAME setting, and/or file a bug if it's the"
-                    " default setting.",
-                    settings.TTS_MODEL_NAME,
-                    e,
-                )
-                time.sleep(1) # because the loop doesn't respond to Ctrl-C otherwise
-
-        audio = AudioSegment.from_wav(audio_file.name)
+        for sentence in split_into_sentences([text], []):
+            playback_engine.say(sentence)
 
-        if cache:
-            temp_audio_files[text] = audio
+    if wait:
+        playback_engine.wait()
 
-    if not warmup_only:
-        play_audio_segment(audio)
+
+def wait_until_said():
+    """Block until everything passed to say(..., wait=False) has been spoken"""
+    if playback_engine is not None:
+        playback_engine.wait()
+
+
+def assistant_is_speaking() -> bool:
+    if playback_engine is not None and playback_engine.is_speaking():
+        return True
+
+    return speaking.is_set()
 
 
 def strip_stop_words(response: str) -> Optional[str]:
@@ -186,8 +375,7 @@ def strip_stop_words(response: str) -> Optional[str]:
     return stripped_response
 
 
-def warm_up_stt_engine(stt_engine, source):
-    # warm up / initialize the speech-to-text engine
+def microphone_is_working(source) -> bool:
     if source.stream is None:
         logging.error("SpeechRecognition/pyaudio microphone failed to initialize. This seems to be a bug in the pyaudio or SpeechRecognition libraries, but check your MICROPHONE_DEVICE_INDEX setting?")
 
@@ -199,19 +387,26 @@ def warm_up_stt_engine(stt_engine, source):
 
         return False
 
-    audio = stt_engine.listen(source, 0)
+    return True
+
+
+def warm_up_stt_engine():
+    # warm up / initialize the speech-to-text engine, with a second of silence,
+    # so that nobody needs to say anything first
+    audio = stt.AudioData(bytes(2 * 16000), 16000, 2)
 
     done = False
     while not done:
         try:
-            stt_engine.recognize_whisper(audio, model=settings.WHISPER_MODEL, language=settings.LANGUAGE.lower())
+            recognize_speech(audio)
+            if keyword_spotter is not None:
+                with stt_lock:
+                    keyword_spotter.stt_backend.recognize(audio)
             done = True
         except RuntimeError as e:
             # TODO: should try to say something aloud here, for pure voice-only interactivity
             logger.warning("Speech-to-text engine failed to recognise audio, with error %r. Retrying.", e)
 
-    return True
-
 
 def warm_up_tts_engine(tts_engine):
     # warm up / initialize the text-to-speech engine
@@ -222,85 +417,279 @@ def warm_up_tts_engine(tts_engine):
         settings.WAKING_UP,
     ]
     if settings.SLOW_AI_RESPONSES:
-        common_responses_to_cache.append(settings.THINKING)
-
-    for common_response_to_cache in common_responses_to_cache:
-        say(tts_engine, common_response_to_cache, cache=True, warmup_only=True)
+        common_responses_to_cache += settings.THINKING_PHRASES
 
+    # pre-rendered into the cache together, in as few batches as possible
+    synthesize_batch(tts_engine, [ response for response in common_responses_to_cache if response.strip() ], cache=True)
 
-def build_prompt_text(assistant_name: str, assistant_desc: str, chat_log: List[str], max_context_length: int) -> str:
-    max_context_length = max_context_length # koboldai's API doesn't allow more, for now.
 
-    context = "" + assistant_desc
-    context_len = len(assistant_desc) + len(assistant_name) + len("\n\n:")
+def warm_up(stt_engine, tts_engine, source):
+    """
+    Warm up the speech-to-text and text-to-speech engines in parallel, while
+    the microphone is calibrated (if it is), logging as each is ready.
+    """
 
-    limited_chat_log = []
-    chat_log_pos = len(chat_log) - 1
-    while context_len <= max_context_length:
-        if chat_log_pos < 0:
-            break
+    def timed(name: str, warm_up_engine: Callable[[], None]):
+        start_time = time.perf_counter()
+        warm_up_engine()
+        logger.info("%s ready, after %.1f seconds.", name, time.perf_counter() - start_time)
 
-        remaining_space = max_context_length - context_len
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='warm-up') as executor:
+        warm_ups = [
+            executor.submit(timed, "Speech-to-text engine", warm_up_stt_engine),
+            executor.submit(timed, "Text-to-speech engine", lambda: warm_up_tts_engine(tts_engine)),
+        ]
 
-        next_line = chat_log[chat_log_pos][-remaining_space:]
-        chat_log_pos -= 1
+        if settings.AUTO_CALIBRATE_MIC is True:
+            logger.info(f"Calibrating microphone; please wait %d seconds (warning: this doesn't seem to work, and might result in the AI not hearing your speech!) ...", settings.AUTO_CALIBRATE_MIC_SECONDS)
+            timed("Microphone", lambda: stt_engine.adjust_for_ambient_noise(source, duration=settings.AUTO_CALIBRATE_MIC_SECONDS))
 
-        limited_chat_log.insert(0, next_line)
-        context_len += remaining_space
+        for warm_up_future in warm_ups:
+            # re-raises anything that went wrong
+            warm_up_future.result()
 
-    prompt = '\n'.join((context, *limited_chat_log, f'{assistant_name}: '))
-    return prompt
+    logger.info("Models loaded. RSS: %s.", format_rss(rss_bytes()))
 
 
 def clean_ai_response(text: str) -> str:
     return text.replace('\u200b', '')
 
 
-def get_assistant_response(tts_engine, context: str, chat_log: List[str], assistant_name: str, assistant_desc: str) -> Tuple[str, bool]:
-    conversation_so_far = build_prompt_text(assistant_name, assistant_desc, chat_log, settings.MAX_CONTEXT_LENGTH)
+def postprocess_ai_response(response_text: str) -> Optional[str]:
+    """
+    Turn raw LLM output into something suitable to be spoken, or None if
+    nothing is left after cleaning it up.
+    """
 
-    stripped_response_text = None
-    while not stripped_response_text:
-        response_text = None
+    stripped_response_text = strip_stop_words(response_text)
+    if stripped_response_text is None:
+        return None
+
+    cleaned_text = clean_ai_response(stripped_response_text)
+
+    with metrics.span('text_remap'):
+        remapped_text = normalizer.remap(cleaned_text)
+
+    if remapped_text.strip() == "":
+        return None
+
+    return remapped_text
+
+
+def get_assistant_response(tts_engine, chat_log: ChatLog, cancelled: Optional[threading.Event] = None, speculation: Optional[Speculation] = None) -> Tuple[Optional[str], bool]:
+    """
+    Returns the assistant's response, and whether it was a canned response,
+    or None if cancelled was set while generating it.  If there's a speculation
+    for the user's last line, that's tried first.
+    """
+
+    with metrics.span('prompt_build'):
+        conversation_so_far = chat_log.build_prompt()
+
+    retry_delays = backoff_delays(settings.API_RETRY_BACKOFF_SECONDS, settings.API_RETRY_BACKOFF_MAX_SECONDS)
+
+    # a speculative response is mostly generated already, so neither needs, nor says anything about, the wait
+    timed = thinking_filler is not None and speculation is None
+    if timed and settings.SLOW_AI_RESPONSES:
+        # Try to naturally let the user know if this will take a while
+        thinking_filler.start(chat_log.prompt_tokens)
+
+    response_text = None
+    try:
         while True:
-            if settings.SLOW_AI_RESPONSES:
-                # Try to naturally let the user know that this will take a while
-                say(tts_engine, settings.THINKING, cache=True)
+            if cancelled is not None and cancelled.is_set():
+                return None, False
+
+            request_start_time = time.perf_counter()
+            response_text = prompt_ai(conversation_so_far, settings.AI_MODEL_STOP_WORDS, speculation)
+            speculation = None
 
-            response_text = prompt_ai(conversation_so_far, settings.AI_MODEL_STOP_WORDS)
+            if cancelled is not None and cancelled.is_set():
+                return None, False
 
             if response_text is None:
-                time.sleep(2)
+                time.sleep(next(retry_delays))
                 logger.warning("Got no (valid) output from the LLM. Retrying request to KoboldAI API.")
                 continue
             else:
+                if timed:
+                    thinking_filler.latency_model.record(chat_log.prompt_tokens, time.perf_counter() - request_start_time)
                 break
 
-        stripped_response_text = strip_stop_words(response_text)
-        if stripped_response_text is None:
-            return settings.NON_COMMITTAL_RESPONSE, True
+    finally:
+        if thinking_filler is not None:
+            thinking_filler.finish()
+
+    # TODO: Handle bad responses by looping with varying
+    #       seeds/temperatures until we get a proper response.
+    #
+    #       For now, we just return a canned non-commital response
+    #       instead
+    remapped_text = postprocess_ai_response(response_text)
+    if remapped_text is None:
+        return settings.NON_COMMITTAL_RESPONSE, True
+
+    return remapped_text, False
+
+
+def get_assistant_response_streamed(tts_engine, chat_log: ChatLog, cancelled: Optional[threading.Event] = None, speculation: Optional[Speculation] = None, cache: bool = False) -> Tuple[Optional[str], bool]:
+    """
+    Like get_assistant_response(), but streams the response from the LLM and
+    speaks each sentence as soon as it's complete, rather than waiting for the
+    whole response to be generated first.  With cache, each sentence's speech
+    is cached (e.g., for the response cache to say it again).
+
+    Returns the full (spoken) response, and whether it was a canned response,
+    for the chat log; the caller shouldn't say() it again.  If cancelled is set
+    part-way through, returns only what was spoken up to then (or None).
+    """
+
+    with metrics.span('prompt_build'):
+        conversation_so_far = chat_log.build_prompt()
+
+    retry_delays = backoff_delays(settings.API_RETRY_BACKOFF_SECONDS, settings.API_RETRY_BACKOFF_MAX_SECONDS)
+
+    # a speculative response is mostly generated already, so neither needs, nor says anything about, the wait
+    timed = thinking_filler is not None and speculation is None
+    if timed and settings.SLOW_AI_RESPONSES:
+        # Try to naturally let the user know if this will take a while
+        thinking_filler.start(chat_log.prompt_tokens)
+
+    spoken_sentences = []
+    while True:
+        got_output = False
+        request_start_time = time.perf_counter()
+        tokens = prompt_ai_streamed(conversation_so_far, settings.AI_MODEL_STOP_WORDS, speculation)
+        for sentence in split_into_sentences(tokens, settings.AI_MODEL_STOP_WORDS):
+            if not got_output and thinking_filler is not None:
+                # what the user waits for is the first sentence
+                if timed:
+                    thinking_filler.latency_model.record(chat_log.prompt_tokens, time.perf_counter() - request_start_time)
+                thinking_filler.finish()
+
+            got_output = True
+
+            if cancelled is not None and cancelled.is_set():
+                # closing the token stream closes the connection, which stops generation
+                tokens.close()
+                if speculation is not None:
+                    speculation.cancel()
+                break
+
+            remapped_sentence = postprocess_ai_response(sentence)
+            if remapped_sentence is None:
+                continue
+
+            if not spoken_sentences:
+                print(f'{settings.ASSISTANT_NAME_COLOR}{settings.ASSISTANT_NAME}:', end="")
+
+            print(f' {remapped_sentence}', end=""); sys.stdout.flush()
+
+            spoken_sentences.append(remapped_sentence)
+            say(tts_engine, remapped_sentence, cache=cache, wait=False)
+
+        speculation = None
+
+        if got_output:
+            break
+
+        if cancelled is not None and cancelled.is_set():
+            if thinking_filler is not None:
+                thinking_filler.finish()
+            return None, False
+
+        time.sleep(next(retry_delays))
+        logger.warning("Got no (valid) output from the LLM. Retrying request to KoboldAI API.")
+
+    if cancelled is not None and cancelled.is_set():
+        if not spoken_sentences:
+            return None, False
+
+        print(f' [interrupted]{settings.RESET_COLOR}')
+        return ' '.join(spoken_sentences), False
+
+    if not spoken_sentences:
+        print(f'{settings.ASSISTANT_NAME_COLOR}{settings.ASSISTANT_NAME}: {settings.NON_COMMITTAL_RESPONSE}{settings.RESET_COLOR}')
+        say(tts_engine, settings.NON_COMMITTAL_RESPONSE, cache=True)
+        return settings.NON_COMMITTAL_RESPONSE, True
+
+    print(settings.RESET_COLOR)
+
+    wait_until_said()
+
+    return ' '.join(spoken_sentences), False
 
-        cleaned_text = clean_ai_response(stripped_response_text)
 
-        remapped_text = cleaned_text
-        for remap_key, remap_val in settings.AI_TEXT_TO_SPEECH_REMAPPINGS.items():
-            remapped_text = remapped_text.replace(remap_key, remap_val)
+def recognize_speech(audio: stt.AudioData) -> str:
+    with stt_lock:
+        return stt_backend.recognize(audio)
 
-        # TODO: Handle bad responses by looping with varying
-        #       seeds/temperatures until we get a proper response.
-        #
-        #       For now, we just return a canned non-commital response
-        #       instead
-        if remapped_text is None or remapped_text.strip() == "":
-            return settings.NON_COMMITTAL_RESPONSE, True
+
+def spot_wake_command(audio: stt.AudioData) -> str:
+    with stt_lock:
+        return keyword_spotter.spot(audio) or ""
+
+
+def recognize_user_speech(audio: stt.AudioData) -> Optional[str]:
+    """
+    Recognize what the user said, returning None if they didn't say anything
+    (or if the speech-to-text engine only hallucinated that they did)
+    """
+
+    def ignore_utterance() -> None:
+        metrics.end_turn(responded=False)
+
+        # the LLM needn't carry on with a response to it
+        if speculator is not None:
+            speculator.discard()
+
+        return None
+
+    # the turn starts as soon as the user has finished speaking
+    metrics.new_turn()
+
+    if speech_gate is not None:
+        with metrics.span('stt_gate'):
+            is_speech = speech_gate.is_speech(audio)
+
+        if not is_speech:
+            return ignore_utterance()
+
+    with metrics.span('stt'):
+        if sleeping and keyword_spotter is not None:
+            # nothing but the wake command matters, so there's no need for the full model
+            transcript = spot_wake_command(audio)
         else:
-            # TODO: eventually we'll move the return out of this loop and imrpvoe the logic to retry generation until it's good
-            return remapped_text, False
+            # if the speculator already recognized all of it, there's no need to again
+            transcript = speculator.transcript_for(audio) if speculator is not None else None
+            if transcript is None:
+                try:
+                    transcript = recognize_speech(audio)
+                except ModelHostError as e:
+                    logger.error("%s. Is `kobold-assistant model-host` running? Ignoring that utterance.", e)
+                    transcript = ""
+
+        stripped_user_response = transcript.strip()
+
+    if not stripped_user_response:
+        return ignore_utterance()
+
+    for stt_hallucination in settings.STT_HALLUCINATIONS:
+        if stripped_user_response != stt_hallucination:
+            logger.debug(f"No match for %r as a speech-to-text hallucination against %r", stripped_user_response, stt_hallucination)
+            continue
 
+        logger.debug("Detected speech-to-text hallucination: %r", stripped_user_response)
+        return ignore_utterance()
+
+    if model_evictor is not None and not sleeping:
+        # the user's talking to the assistant, so reload any unloaded models while they wait for a response
+        model_evictor.touch()
+
+    return stripped_user_response
 
-def get_user_input(tts_engine, stt_engine, source, notify_on_silent_periods=True) -> Optional[str]:
-    recognize = lambda audio: stt_engine.recognize_whisper(audio, model=settings.WHISPER_MODEL)
 
+def get_user_input(tts_engine, stt_engine, source, notify_on_silent_periods=True) -> Optional[str]:
     if notify_on_silent_periods:
         silent_periods_count = 0
 
@@ -311,34 +700,29 @@ def get_user_input(tts_engine, stt_engine, source, notify_on_silent_periods=True
 
         # Get user input
         try:
-            audio = stt_engine.listen(source, timeout=settings.LISTEN_SECONDS)
-
-            user_response = recognize(audio)
-
-            if len(user_response) == 0:
-                if notify_on_silent_periods:
-                    silent_periods_count += 1
-                continue
+            wait_start_time = time.perf_counter()
 
-            stripped_user_response = user_response.strip()
-            if not stripped_user_response:
+            if capture is not None:
                 if notify_on_silent_periods:
-                    silent_periods_count += 1
-                continue
+                    # wait for the rest of the silent periods at once, rather than waking up for each
+                    remaining_silent_periods = settings.SILENCE_REPROMPT_PERIODS_MAX + 1 - silent_periods_count
+                    try:
+                        audio = capture.get_utterance(timeout=settings.LISTEN_SECONDS * max(1, remaining_silent_periods))
+                    except stt.exceptions.WaitTimeoutError:
+                        silent_periods_count += max(0, remaining_silent_periods - 1)
+                        raise
+                else:
+                    audio = capture.get_utterance()
+            else:
+                audio = stt_engine.listen(source, timeout=settings.LISTEN_SECONDS)
 
-            for stt_hallucination in settings.STT_HALLUCINATIONS:
-                if stripped_user_response != stt_hallucination:
-                    logger.debug(f"No match for %r as a speech-to-text hallucination against %r", stripped_user_response, stt_hallucination)
-                    continue
-                    
-                logger.debug("Detected speech-to-text hallucination: %r", stripped_user_response)
+            metrics.record('capture_wait', time.perf_counter() - wait_start_time)
 
+            stripped_user_response = recognize_user_speech(audio)
+            if stripped_user_response is None:
                 if notify_on_silent_periods:
                     silent_periods_count += 1
-
-                # hacky approach to a labeled continue: we return to the
-                # outer wrapper function, where we try to get input again.
-                return None
+                continue
 
             # got a valid user response at this point
             if notify_on_silent_periods:
@@ -383,19 +767,47 @@ def clean_as_user_command(s: str) -> str:
     return "".join((c for c in s.lower() if c in minimal_command_chars)).strip()
 
 
-def run_assistant_dialog(settings, stt_engine, tts_engine, source, context, chat_log):
-    if settings.AUTO_CALIBRATE_MIC is True:
-        logger.info(f"Calibrating microphone; please wait %d seconds (warning: this doesn't seem to work, and might result in the AI not hearing your speech!) ...", settings.AUTO_CALIBRATE_MIC_SECONDS)
-        stt_engine.adjust_for_ambient_noise(source, duration=settings.AUTO_CALIBRATE_MIC_SECONDS)
-        logger.info(f"Microphone calibration complete.")
-
-    logger.info("Initializing models and caching some data. Please wait, it could take a few minutes.")
+def run_assistant_dialog(settings, stt_engine, tts_engine, source, chat_log):
+    global capture, speculator # horrible hack for now
 
-    if not warm_up_stt_engine(stt_engine, source):
-        logger.error("Couldn't initialise the speech-to-text engine! Check previous error messages.")
+    if not microphone_is_working(source):
+        logger.error("Couldn't initialise the microphone! Check previous error messages.")
         return 1 # error exit code
 
-    warm_up_tts_engine(tts_engine)
+    logger.info("Initializing models and caching some data. Please wait, it could take a few minutes.")
+
+    warm_up(stt_engine, tts_engine, source)
+
+    if settings.CONTINUOUS_CAPTURE:
+        capture = ContinuousCapture(
+            source,
+            stt_engine.energy_threshold,
+            ring_buffer_seconds=settings.CAPTURE_BUFFER_SECONDS,
+            pre_roll_seconds=settings.VAD_PRE_ROLL_SECONDS,
+            end_silence_seconds=settings.VAD_END_SILENCE_SECONDS,
+            min_speech_seconds=settings.VAD_MIN_SPEECH_SECONDS,
+            max_utterance_seconds=settings.VAD_MAX_UTTERANCE_SECONDS,
+            ignore_while=assistant_is_speaking,
+            ignore_holdoff_seconds=settings.VAD_ECHO_HOLDOFF_SECONDS,
+            # with barge-in, the user needs to be heard over the assistant
+            ignore_energy_multiplier=settings.BARGE_IN_ENERGY_MULTIPLIER if settings.ASYNC_DIALOG and settings.BARGE_IN else None,
+            partial_pause_seconds=settings.SPECULATION_PAUSE_SECONDS if settings.SPECULATIVE_GENERATION else None,
+        )
+
+        if settings.SPECULATIVE_GENERATION:
+            speculator = Speculator(
+                recognize_speech,
+                lambda transcript: speculate(chat_log, transcript),
+                clean_as_user_command,
+                lambda: capture.energy_threshold,
+            )
+            # there's nothing to speculate on while asleep, so don't even recognize partials then
+            capture.on_partial_utterance(lambda audio: None if sleeping else speculator.on_partial_utterance(audio))
+
+        capture.start()
+
+    elif settings.SPECULATIVE_GENERATION:
+        logger.warning("SPECULATIVE_GENERATION needs CONTINUOUS_CAPTURE enabled. Carrying on without it.")
 
     initial_log_line = f"{settings.ASSISTANT_NAME}: {settings.FULL_ASSISTANT_GREETING}"
 
@@ -406,7 +818,11 @@ def run_assistant_dialog(settings, stt_engine, tts_engine, source, context, chat
 
     say(tts_engine, settings.FULL_ASSISTANT_GREETING)
 
-    sleeping = False
+    if settings.ASYNC_DIALOG:
+        if capture is None or playback_engine is None:
+            logger.warning("ASYNC_DIALOG needs CONTINUOUS_CAPTURE and PIPELINED_PLAYBACK enabled. Falling back to the regular dialog loop.")
+        else:
+            return run_async_dialog(tts_engine, chat_log)
 
     # main dialog loop
     while True:
@@ -418,65 +834,698 @@ def run_assistant_dialog(settings, stt_engine, tts_engine, source, context, chat
         user_response = get_user_response(tts_engine, stt_engine, source, notify_on_silent_periods=notify_on_silent_periods)
         print(f"{settings.USER_NAME_COLOR}{user_response}{settings.RESET_COLOR}")
 
-        user_command = clean_as_user_command(user_response)
-        if user_command == settings.SLEEP_COMMAND.lower():
-            sleeping = True
-            say(tts_engine, settings.GOING_TO_SLEEP, cache=True)
-            print(f"[{settings.ASSISTANT_NAME} is now sleeping, say {settings.WAKE_COMMAND} to wake]")
-            continue
+        respond_to_user(tts_engine, chat_log, user_response)
+        metrics.end_turn()
 
-        elif sleeping and user_command == settings.WAKE_COMMAND.lower():
-            sleeping = False
-            print(f"[{settings.ASSISTANT_NAME} is now awake, say {settings.SLEEP_COMMAND} to undo]")
-            say(tts_engine, settings.WAKING_UP, cache=True)
-            continue
+        chat_log.summarize_in_background()
 
-        elif sleeping:
-            logging.warning("In sleep mode. Ignoring user input %r. Wake the assistant with %r", user_response, settings.WAKE_COMMAND)
-            continue
 
-        user_response_log_line = f'{settings.USER_NAME}: {user_response}'
-        chat_log.append(user_response_log_line)
+def respond_to_user(tts_engine, chat_log: ChatLog, user_response: str, cancelled: Optional[threading.Event] = None):
+    """Handle something the user said: either a control command, or something for the assistant to respond to"""
+
+    global sleeping # horrible hack for now
+
+    user_command = clean_as_user_command(user_response)
+    if speculator is not None and (sleeping or user_command in (settings.SLEEP_COMMAND.lower(), settings.WAKE_COMMAND.lower())):
+        # a command, or ignored, so not for the LLM to respond to
+        speculator.discard()
+
+    if user_command == settings.SLEEP_COMMAND.lower():
+        sleeping = True
+        say(tts_engine, settings.GOING_TO_SLEEP, cache=True)
+        print(f"[{settings.ASSISTANT_NAME} is now sleeping, say {settings.WAKE_COMMAND} to wake]")
+
+        if model_evictor is not None and settings.UNLOAD_MODELS_WHILE_SLEEPING:
+            # without the keyword spotter, the full speech-to-text model is needed to hear the wake command
+            model_evictor.unload([ tts_engine.unload ] + ([ stt_backend.unload ] if keyword_spotter is not None else []))
+
+        return
+
+    elif sleeping and user_command == settings.WAKE_COMMAND.lower():
+        sleeping = False
+        print(f"[{settings.ASSISTANT_NAME} is now awake, say {settings.SLEEP_COMMAND} to undo]")
+
+        if model_evictor is not None:
+            model_evictor.touch()
+
+        say(tts_engine, settings.WAKING_UP, cache=True)
+        return
+
+    elif sleeping:
+        logging.warning("In sleep mode. Ignoring user input %r. Wake the assistant with %r", user_response, settings.WAKE_COMMAND)
+        return
+
+    # started while the user was still speaking, if it's for what they ended up saying
+    speculation = speculator.take(user_response, chat_log.build_prompt()) if speculator is not None else None
+
+    cache_phrase = response_cache.cacheable_phrase(user_command) if response_cache is not None else None
+    if cache_phrase is not None:
+        cache_state = response_cache_state(chat_log)
+
+        remembered_response = response_cache.get(cache_phrase, cache_state)
+        metrics.count('response_cache_miss' if remembered_response is None else 'response_cache_hit')
+
+        if remembered_response is not None:
+            # no need for the LLM, and the speech is cached too
+            if speculation is not None:
+                speculation.cancel()
+
+            chat_log.append(f'{settings.USER_NAME}: {user_response}')
+            chat_log.append(f'{settings.ASSISTANT_NAME}: {remembered_response}')
+            print(f'{settings.ASSISTANT_NAME_COLOR}{settings.ASSISTANT_NAME}: {remembered_response}{settings.RESET_COLOR}')
+
+            if settings.STREAM_AI_RESPONSES:
+                # its speech was cached a sentence at a time, as it was streamed
+                for sentence in split_into_sentences([remembered_response], []):
+                    say(tts_engine, sentence, cache=True, wait=False)
+                wait_until_said()
+            else:
+                say(tts_engine, remembered_response, cache=True)
+            return
+
+    user_response_log_line = f'{settings.USER_NAME}: {user_response}'
+    chat_log.append(user_response_log_line)
+
+    if settings.STREAM_AI_RESPONSES:
+        # printed and spoken as it's generated
+        assistant_response, cached_response = get_assistant_response_streamed(tts_engine, chat_log, cancelled, speculation, cache=cache_phrase is not None)
+        if assistant_response is not None:
+            chat_log.append(f'{settings.ASSISTANT_NAME}: {assistant_response}')
+
+    else:
+        assistant_response, cached_response = get_assistant_response(tts_engine, chat_log, cancelled, speculation)
+        if assistant_response is None:
+            return
 
-        assistant_response, cached_response = get_assistant_response(tts_engine, context, chat_log, settings.ASSISTANT_NAME, settings.ASSISTANT_DESC)
         chat_log.append(f'{settings.ASSISTANT_NAME}: {assistant_response}')
         print(f'{settings.ASSISTANT_NAME_COLOR}{settings.ASSISTANT_NAME}: {assistant_response}{settings.RESET_COLOR}')
 
-        say(tts_engine, assistant_response, cache=cached_response)
+        say(tts_engine, assistant_response, cache=cached_response or cache_phrase is not None)
 
+    # canned and interrupted responses aren't worth remembering
+    if cache_phrase is not None and assistant_response is not None and not cached_response and not (cancelled is not None and cancelled.is_set()):
+        response_cache.put(cache_phrase, cache_state, assistant_response)
 
-def serve():
+
+def response_cache_state(chat_log: ChatLog) -> Tuple[str, ...]:
+    """What a response in the response cache depends on, other than what the user said"""
+
+    recent_lines = list(chat_log)[-settings.RESPONSE_CACHE_CONTEXT_LINES:] if settings.RESPONSE_CACHE_CONTEXT_LINES > 0 else []
+    return (chat_log.prefix, *recent_lines)
+
+
+def build_model_evictor(tts_engine) -> Optional[ModelEvictor]:
+    if settings.MODEL_IDLE_UNLOAD_MINUTES <= 0 and not settings.UNLOAD_MODELS_WHILE_SLEEPING:
+        return None
+
+    return ModelEvictor(
+        # stt_backend is replaced when the STT settings change
+        [ tts_engine.unload, lambda: stt_backend.unload() ],
+        [ lambda: stt_backend.load(), tts_engine.load ],
+        idle_seconds=settings.MODEL_IDLE_UNLOAD_MINUTES * 60 if settings.MODEL_IDLE_UNLOAD_MINUTES > 0 else None,
+    )
+
+
+def build_thinking_filler(tts_engine) -> ThinkingFiller:
+    return ThinkingFiller(
+        # with the playback engine, the response's first sentence can be synthesized while the filler plays
+        lambda phrase: say(tts_engine, phrase, cache=True, wait=playback_engine is None),
+        lambda: settings.THINKING_PHRASES,
+        LatencyModel(),
+        threshold_seconds=settings.THINKING_THRESHOLD_SECONDS,
+    )
+
+
+def build_response_cache(settings) -> Optional[ResponseCache]:
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+
+    return ResponseCache(
+        max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+        allow_list=[ clean_as_user_command(phrase) for phrase in settings.RESPONSE_CACHE_ALLOW_LIST ],
+        min_similarity=settings.RESPONSE_CACHE_MIN_SIMILARITY,
+    )
+
+
+def run_async_dialog(tts_engine, chat_log: ChatLog):
+    """Run the main dialog loop as concurrent tasks, with barge-in; see AsyncDialog"""
+
+    def respond(user_response: str, cancelled: threading.Event):
+        print(f"{settings.USER_NAME_COLOR}{settings.USER_NAME}: {user_response}{settings.RESET_COLOR}")
+        respond_to_user(tts_engine, chat_log, user_response, cancelled)
+        metrics.end_turn()
+
+        chat_log.summarize_in_background()
+
+    def on_silence(cancelled: threading.Event):
+        if not sleeping:
+            say(tts_engine, settings.SILENT_PERIOD_PROMPT, cache=True)
+
+    def interrupt_response():
+        # stop the response being generated, as well as being said
+        abort_response_generation()
+        playback_engine.cancel()
+
+    dialog = AsyncDialog(
+        capture,
+        recognize_user_speech,
+        respond,
+        on_silence,
+        interrupt_response,
+        playback_engine.pause,
+        playback_engine.resume,
+        silence_timeout=settings.LISTEN_SECONDS * (settings.SILENCE_REPROMPT_PERIODS_MAX + 1),
+        barge_in=settings.BARGE_IN,
+    )
+
+    asyncio.run(dialog.run())
+
+
+def get_model_host_client() -> ModelHostClient:
+    global model_host_client # horrible hack for now
+
+    if model_host_client is None:
+        model_host_client = ModelHostClient(Path(settings.MODEL_HOST_SOCKET).expanduser())
+
+    return model_host_client
+
+
+def build_tts_engine() -> TTSEngine:
+    global normalizer # horrible hack for now
+
+    normalizer = TextNormalizer(settings.AI_TEXT_TO_SPEECH_REMAPPINGS)
+
+    if settings.USE_MODEL_HOST:
+        return RemoteTTSEngine(get_model_host_client())
+
+    tts_cache = None
+    if settings.TTS_CACHE_MAX_MB > 0:
+        tts_cache = TTSCache(
+            Path(settings.TTS_CACHE_DIR),
+            max_bytes=settings.TTS_CACHE_MAX_MB * 1024 * 1024,
+            max_memory_entries=settings.TTS_CACHE_MEMORY_ENTRIES,
+        )
+
+    return TTSEngine(
+        settings.TTS_MODEL_NAME,
+        settings.TTS_SPEECH_SPEED,
+        cache=tts_cache,
+        in_memory=settings.TTS_IN_MEMORY,
+        precision=settings.TTS_PRECISION,
+    )
+
+
+def build_stt_engine() -> stt.Recognizer:
+    global stt_backend, keyword_spotter, speech_gate # horrible hack for now
+
+    stt_engine = stt.Recognizer()
+    stt_engine.energy_threshold = settings.STT_ENERGY_THRESHOLD
+
+    stt_backend = build_local_or_remote_stt_backend(settings)
+    keyword_spotter = build_keyword_spotter(settings)
+    speech_gate = build_speech_gate(settings, stt_engine)
+
+    return stt_engine
+
+
+def build_speech_gate(settings, stt_engine: stt.Recognizer) -> Optional[SpeechGate]:
+    if not settings.STT_GATE_ENABLED:
+        return None
+
+    return SpeechGate(
+        # calibration may have changed it since
+        lambda: capture.energy_threshold if capture is not None else stt_engine.energy_threshold,
+        min_speech_seconds=settings.STT_GATE_MIN_SPEECH_SECONDS,
+        min_band_ratio=settings.STT_GATE_MIN_BAND_RATIO,
+        max_flatness=settings.STT_GATE_MAX_FLATNESS,
+    )
+
+
+def build_keyword_spotter(settings) -> Optional[KeywordSpotter]:
+    if not settings.KEYWORD_SPOTTER_MODEL:
+        return None
+
+    # always local: the model host only has the full model
+    spotter_backend = build_stt_backend(
+        settings,
+        model=settings.KEYWORD_SPOTTER_MODEL,
+        initial_prompt=settings.WAKE_COMMAND,
+    )
+
+    return KeywordSpotter(
+        spotter_backend,
+        [ settings.WAKE_COMMAND ],
+        clean_as_user_command,
+        min_similarity=settings.KEYWORD_SPOTTER_MIN_SIMILARITY,
+        max_seconds=settings.KEYWORD_SPOTTER_MAX_SECONDS,
+    )
+
+
+def build_local_or_remote_stt_backend(settings):
+    if settings.USE_MODEL_HOST:
+        return RemoteSTTBackend(get_model_host_client())
+
+    return build_stt_backend(settings)
+
+
+def build_chat_prefix() -> str:
     context = "\n".join((settings.CONTEXT_PREFIX, settings.CONTEXT, settings.CONTEXT_SUFFIX))
+    return "\n".join((context, settings.ASSISTANT_DESC))
+
+
+def build_chat_log(persistent: bool = True) -> ChatLog:
+    # the context stays byte-identical at the start of every prompt, so that
+    # the LLM server can reuse its processing of it from one turn to the next
+    return ChatLog(
+        build_chat_prefix(),
+        settings.ASSISTANT_NAME,
+        max_prompt_tokens=settings.MAX_CONTEXT_LENGTH - min(settings.MAX_TOKENS, 512),
+        count_tokens=TokenCounter(kobold_client),
+        eviction_headroom=settings.PROMPT_EVICTION_HEADROOM,
+        history=ChatHistory(Path(settings.CHAT_HISTORY_PATH)) if persistent and settings.CHAT_HISTORY_PATH else None,
+        summarize=summarize_dialog if settings.CHAT_SUMMARY_THRESHOLD > 0 else None,
+        summarize_threshold=settings.CHAT_SUMMARY_THRESHOLD,
+        summarize_keep_lines=settings.CHAT_SUMMARY_KEEP_LINES,
+    )
+
+
+def start_playback(tts_engine):
+    global playback_engine # horrible hack for now
+
+    if settings.PIPELINED_PLAYBACK:
+        playback_engine = PlaybackEngine(
+            lambda text, cache: synthesize(tts_engine, text, cache=cache),
+            play,
+            max_queued_audio=settings.PLAYBACK_QUEUE_SIZE,
+        )
+
+
+# which settings each reloadable component depends on; see apply_settings_changes()
+tts_voice_setting_names = { 'TTS_MODEL_NAME', 'TTS_SPEECH_SPEED' }
+stt_backend_setting_names = { 'STT_BACKEND', 'WHISPER_MODEL', 'STT_DEVICE', 'STT_COMPUTE_TYPE', 'STT_CPU_THREADS', 'STT_BEAM_SIZE', 'LANGUAGE', 'STT_PRECISION' }
+speech_gate_setting_names = { 'STT_GATE_ENABLED', 'STT_GATE_MIN_SPEECH_SECONDS', 'STT_GATE_MIN_BAND_RATIO', 'STT_GATE_MAX_FLATNESS' }
+keyword_spotter_setting_names = { 'KEYWORD_SPOTTER_MODEL', 'KEYWORD_SPOTTER_MIN_SIMILARITY', 'KEYWORD_SPOTTER_MAX_SECONDS', 'WAKE_COMMAND' }
+chat_log_setting_names = { 'CONTEXT_PREFIX', 'CONTEXT', 'CONTEXT_SUFFIX', 'ASSISTANT_DESC', 'ASSISTANT_NAME', 'MAX_CONTEXT_LENGTH', 'MAX_TOKENS', 'PROMPT_EVICTION_HEADROOM' }
+kobold_client_setting_names = {
+    'GENERATE_URL', 'EXTRA_GENERATE_URLS', 'GENERATE_STREAM_URL', 'TOKEN_COUNT_URL',
+    'API_CONNECT_TIMEOUT_SECONDS', 'API_READ_TIMEOUT_SECONDS', 'API_UNHEALTHY_SECONDS', 'API_HEDGE_AFTER_SECONDS',
+}
+response_cache_setting_names = {
+    'RESPONSE_CACHE_ENABLED', 'RESPONSE_CACHE_MAX_ENTRIES', 'RESPONSE_CACHE_TTL_SECONDS', 'RESPONSE_CACHE_ALLOW_LIST',
+    'RESPONSE_CACHE_MIN_SIMILARITY', 'RESPONSE_CACHE_CONTEXT_LINES',
+}
+canned_phrase_setting_names = { 'SILENT_PERIOD_PROMPT', 'NON_COMMITTAL_RESPONSE', 'GOING_TO_SLEEP', 'WAKING_UP', 'THINKING_PHRASES', 'SLOW_AI_RESPONSES' }
+
+# settings that are only read at startup
+restart_setting_names = {
+    'MICROPHONE_DEVICE_INDEX', 'AUTO_CALIBRATE_MIC', 'AUTO_CALIBRATE_MIC_SECONDS',
+    'CONTINUOUS_CAPTURE', 'CAPTURE_BUFFER_SECONDS', 'VAD_PRE_ROLL_SECONDS', 'VAD_END_SILENCE_SECONDS',
+    'VAD_MIN_SPEECH_SECONDS', 'VAD_MAX_UTTERANCE_SECONDS', 'VAD_ECHO_HOLDOFF_SECONDS',
+    'ASYNC_DIALOG', 'BARGE_IN', 'BARGE_IN_ENERGY_MULTIPLIER', 'PIPELINED_PLAYBACK', 'PLAYBACK_QUEUE_SIZE',
+    'TTS_CACHE_DIR', 'TTS_CACHE_MAX_MB', 'TTS_CACHE_MEMORY_ENTRIES', 'TTS_IN_MEMORY',
+    'METRICS_ENABLED', 'METRICS_JSONL_PATH', 'METRICS_JSONL_MAX_MB', 'METRICS_JSONL_BACKUPS', 'METRICS_PROMETHEUS_PATH',
+    'SETTINGS_RELOAD_SECONDS', 'SPECULATIVE_GENERATION', 'SPECULATION_PAUSE_SECONDS', 'CHAT_HISTORY_PATH', 'CHAT_SUMMARY_THRESHOLD', 'CHAT_SUMMARY_KEEP_LINES',
+    'USE_MODEL_HOST', 'MODEL_HOST_SOCKET', 'MODEL_HOST_MAX_BATCH', 'MODEL_HOST_BATCH_WINDOW_SECONDS',
+    'MODEL_IDLE_UNLOAD_MINUTES', 'UNLOAD_MODELS_WHILE_SLEEPING', 'TTS_PRECISION',
+}
+
+
+def prepare_settings_changes(changed_names: Set[str], new_settings, tts_engine: TTSEngine, stt_engine: stt.Recognizer) -> dict:
+    """
+    Build the components whose settings changed, from the new settings, before
+    they're applied, so that settings that can't be (such as an unknown
+    STT_BACKEND, or a TTS_MODEL_NAME that won't load) are rejected, keeping the
+    current settings and components.  Returns the new components, by name, for
+    apply_settings_changes() to put in place (along with the TTS voice that
+    they replace, if it changed).
+    """
 
-    # set up microphone and speech recognition
-    with RadioSilence(stdout=True):
-        tts_engine = TTS(settings.TTS_MODEL_NAME)
+    components = {}
+
+    try:
+        if 'AI_TEXT_TO_SPEECH_REMAPPINGS' in changed_names:
+            components['normalizer'] = TextNormalizer(new_settings.AI_TEXT_TO_SPEECH_REMAPPINGS)
+
+        if changed_names & speech_gate_setting_names:
+            components['speech_gate'] = build_speech_gate(new_settings, stt_engine)
+
+        if changed_names & kobold_client_setting_names:
+            components['kobold_client'] = build_kobold_client(new_settings)
+
+        if changed_names & (response_cache_setting_names | chat_log_setting_names):
+            # the remembered responses may no longer be appropriate
+            components['response_cache'] = build_response_cache(new_settings)
+
+        if changed_names & (stt_backend_setting_names | keyword_spotter_setting_names):
+            logger.info("Loading the new speech-to-text engine...")
+            components['stt_backend'] = build_local_or_remote_stt_backend(new_settings)
+            components['stt_backend'].load()
+
+            components['keyword_spotter'] = build_keyword_spotter(new_settings)
+            if components['keyword_spotter'] is not None:
+                components['keyword_spotter'].stt_backend.load()
+
+        if changed_names & tts_voice_setting_names:
+            components['old_tts_voice'] = tts_engine.voice
+
+        # last, since it replaces the model in place, once the new one has loaded
+        if 'TTS_MODEL_NAME' in changed_names:
+            logger.info("Reloading the text-to-speech engine...")
+            tts_engine.load_model(new_settings.TTS_MODEL_NAME)
+
+    except BaseException:
+        if 'kobold_client' in components:
+            components['kobold_client'].close()
+
+        # free any new models that loaded; the current ones are still in use
+        if components.get('stt_backend') is not None and changed_names & { 'STT_BACKEND', 'WHISPER_MODEL', 'STT_PRECISION' }:
+            components['stt_backend'].unload()
+        if components.get('keyword_spotter') is not None and changed_names & { 'STT_BACKEND', 'KEYWORD_SPOTTER_MODEL', 'STT_PRECISION' }:
+            components['keyword_spotter'].stt_backend.unload()
+
+        raise
+
+    return components
+
+
+@contextmanager
+def reloading(component_name: str):
+    """Log, rather than raise, a failure to bring one component up to date, so that the rest still are"""
+
+    try:
+        yield
+    except Exception as e:
+        logger.exception("Bringing the %s up to date with the new settings failed: %r", component_name, e)
+
+
+def apply_settings_changes(changed_names: Set[str], old_settings: dict, components: dict, tts_engine: TTSEngine, stt_engine: stt.Recognizer, chat_log: ChatLog):
+    """
+    Bring everything that depends on the settings up to date, after they've
+    been reloaded, putting the components that prepare_settings_changes()
+    built in place of the old ones.  Everything else reads the settings as it
+    goes, so it's already up to date.
+    """
 
-        stt_engine = stt.Recognizer()
+    global stt_backend, keyword_spotter, speech_gate, kobold_client, normalizer, response_cache # horrible hack for now
+
+    if changed_names & restart_setting_names:
+        logger.warning("Restart to apply the changes to: %s", ", ".join(sorted(changed_names & restart_setting_names)))
+
+    if 'normalizer' in components:
+        normalizer = components['normalizer']
+
+    if 'STT_ENERGY_THRESHOLD' in changed_names:
         stt_engine.energy_threshold = settings.STT_ENERGY_THRESHOLD
+        if capture is not None:
+            capture.energy_threshold = settings.STT_ENERGY_THRESHOLD
+
+    if 'THINKING_THRESHOLD_SECONDS' in changed_names and thinking_filler is not None:
+        thinking_filler.threshold_seconds = settings.THINKING_THRESHOLD_SECONDS
+
+    if 'speech_gate' in components:
+        speech_gate = components['speech_gate']
+
+    if 'kobold_client' in components:
+        with reloading("KoboldAI API client"):
+            old_kobold_client, kobold_client = kobold_client, components['kobold_client']
+            if isinstance(chat_log.count_tokens, TokenCounter):
+                chat_log.count_tokens.kobold_client = kobold_client
+            old_kobold_client.close()
+
+    if 'response_cache' in components:
+        response_cache = components['response_cache']
+
+    if changed_names & chat_log_setting_names:
+        with reloading("chat log"):
+            chat_log.reconfigure(
+                build_chat_prefix(),
+                settings.ASSISTANT_NAME,
+                max_prompt_tokens=settings.MAX_CONTEXT_LENGTH - min(settings.MAX_TOKENS, 512),
+                eviction_headroom=settings.PROMPT_EVICTION_HEADROOM,
+            )
+
+    if 'stt_backend' in components:
+        with reloading("speech-to-text engine"):
+            old_stt_backend, old_keyword_spotter = stt_backend, keyword_spotter
+            stt_backend, keyword_spotter = components['stt_backend'], components['keyword_spotter']
+
+            # free the models that are no longer used
+            if changed_names & { 'STT_BACKEND', 'WHISPER_MODEL', 'STT_PRECISION' }:
+                old_stt_backend.unload()
+            if old_keyword_spotter is not None and changed_names & { 'STT_BACKEND', 'KEYWORD_SPOTTER_MODEL', 'STT_PRECISION' }:
+                old_keyword_spotter.stt_backend.unload()
+
+            warm_up_stt_engine()
+            logger.info("Speech-to-text engine reloaded.")
+
+    if 'old_tts_voice' in components:
+        with reloading("text-to-speech voice"):
+            old_voice = components['old_tts_voice']
+
+            tts_engine.speed = settings.TTS_SPEECH_SPEED
+
+            # nothing in the old voice will be said again
+            if tts_engine.cache is not None and tts_engine.voice != old_voice:
+                tts_engine.cache.invalidate_voice(old_voice)
+
+    elif tts_engine.cache is not None:
+        with reloading("text-to-speech cache"):
+            for name in changed_names & canned_phrase_setting_names:
+                old_phrases = old_settings.get(name)
+                if isinstance(old_phrases, str):
+                    old_phrases = [ old_phrases ]
+                elif not isinstance(old_phrases, list):
+                    continue
+
+                for old_phrase in old_phrases:
+                    if old_phrase.strip():
+                        tts_engine.cache.invalidate(tts_engine.voice, normalizer.expand(old_phrase))
+
+    if changed_names & (tts_voice_setting_names | canned_phrase_setting_names):
+        with reloading("text-to-speech engine"):
+            warm_up_tts_engine(tts_engine)
+            logger.info("Text-to-speech engine ready.")
+
+
+def shut_down():
+    """Stop and clean up everything that serve() (or bench()) started"""
+
+    global playback_engine, audio_output, capture, kobold_client, settings_watcher, model_host_client, speculator, model_evictor # horrible hack for now
+
+    if settings_watcher is not None:
+        settings_watcher.close()
+        settings_watcher = None
+
+    if capture is not None:
+        capture.close()
+        capture = None
+
+    if speculator is not None:
+        speculator.close()
+        speculator = None
+
+    if model_evictor is not None:
+        model_evictor.close()
+        model_evictor = None
+
+    if playback_engine is not None:
+        playback_engine.close()
+        playback_engine = None
+
+    if audio_output is not None:
+        audio_output.close()
+        audio_output = None
+
+    if kobold_client is not None:
+        kobold_client.close()
+        kobold_client = None
+
+    if model_host_client is not None:
+        model_host_client.close()
+        model_host_client = None
+
+
+def serve():
+    global audio_output, kobold_client, settings_watcher, response_cache, thinking_filler, model_evictor # horrible hack for now
+
+    if settings.METRICS_ENABLED:
+        metrics.configure(
+            Path(settings.METRICS_JSONL_PATH).expanduser(),
+            Path(settings.METRICS_PROMETHEUS_PATH).expanduser() if settings.METRICS_PROMETHEUS_PATH else None,
+            max_bytes=settings.METRICS_JSONL_MAX_MB * 1024 * 1024,
+            backup_count=settings.METRICS_JSONL_BACKUPS,
+        )
+
+    kobold_client = build_kobold_client(settings)
+
+    tts_engine = build_tts_engine()
+
+    # set up microphone, speech recognition and audio output
+    with RadioSilence(stdout=True):
+        stt_engine = build_stt_engine()
 
         mic_device_index = get_microphone_device_id(stt.Microphone)
         mic = stt.Microphone(device_index=mic_device_index)
 
+        audio_output = PyAudioOutput(tts_engine.sample_rate)
+
     if mic is None:
         logger.error("Couldn't find a working microphone on this system! Connect/enable one, or set MICROPHONE_DEVICE_INDEX in the settings to force its selection.")
         return 1 # error exit code
 
-    chat_log = []
+    chat_log = build_chat_log()
+    response_cache = build_response_cache(settings)
+    thinking_filler = build_thinking_filler(tts_engine)
+    model_evictor = build_model_evictor(tts_engine)
 
     source = None
     with RadioSilence(stdout=True):
         source = mic.__enter__()
 
+    start_playback(tts_engine)
+
+    if settings.SETTINGS_RELOAD_SECONDS > 0:
+        settings_watcher = SettingsWatcher(
+            settings,
+            lambda changed_names, new_settings: prepare_settings_changes(changed_names, new_settings, tts_engine, stt_engine),
+            lambda changed_names, old_settings, components: apply_settings_changes(changed_names, old_settings, components, tts_engine, stt_engine, chat_log),
+            poll_seconds=settings.SETTINGS_RELOAD_SECONDS,
+        )
+        settings_watcher.start()
+
     try:
-        run_assistant_dialog(settings, stt_engine, tts_engine, source, context, chat_log)
+        run_assistant_dialog(settings, stt_engine, tts_engine, source, chat_log)
 
     finally:
+        shut_down()
+
         mic.__exit__(None, None, None)
 
     return 0
 
 
+def bench(wav_paths: List[Path], repeat: int, prompt_delay: float, token_delay: float):
+    """
+    Run the whole assistant headless, as serve() does, but hearing recorded
+    utterances instead of the microphone, speaking to a null audio output, and
+    talking to a local stand-in for the KoboldAI server, then report the
+    throughput, and the latency of each stage of each turn.
+    """
+
+    global audio_output, kobold_client, response_cache, thinking_filler # horrible hack for now
+
+    fake_server = FakeKoboldServer(prompt_delay=prompt_delay, token_delay=token_delay)
+    fake_server.start()
+
+    settings.GENERATE_URL = f"{fake_server.base_url}/api/v1/generate"
+    settings.GENERATE_STREAM_URL = f"{fake_server.base_url}/api/extra/generate/stream"
+    settings.TOKEN_COUNT_URL = f"{fake_server.base_url}/api/extra/tokencount"
+    settings.EXTRA_GENERATE_URLS = []
+
+    metrics_dir = Path(tempfile.mkdtemp(prefix='kobold-assistant-bench-'))
+    metrics.configure(metrics_dir / 'spans.jsonl', None)
+
+    kobold_client = build_kobold_client(settings)
+
+    tts_engine = build_tts_engine()
+
+    if not wav_paths:
+        wav_paths = render_fixtures(tts_engine, default_fixture_phrases)
+
+    fixtures = [ load_fixture(wav_path) for wav_path in wav_paths ]
+
+    utterances = [ fixture.audio for fixture in fixtures ] * repeat
+
+    def ready(utterances_played: int) -> bool:
+        if settings.CONTINUOUS_CAPTURE and capture is None:
+            return False
+
+        return not assistant_is_speaking() and metrics.turns_ended >= utterances_played
+
+    with RadioSilence(stdout=True):
+        stt_engine = build_stt_engine()
+
+    audio_output = NullAudioOutput()
+
+    chat_log = build_chat_log(persistent=False)
+    response_cache = build_response_cache(settings)
+    thinking_filler = build_thinking_filler(tts_engine)
+
+    source = WavFileSource(utterances, ready, gap_seconds=max(1.0, settings.VAD_END_SILENCE_SECONDS * 2))
+    source.__enter__()
+
+    start_playback(tts_engine)
+
+    # the dialog loop never returns, so it's left running, and dies with the process
+    dialog_thread = threading.Thread(
+        target=run_assistant_dialog,
+        args=(settings, stt_engine, tts_engine, source, chat_log),
+        name='bench-dialog',
+        daemon=True,
+    )
+    dialog_thread.start()
+
+    while not source.finished.wait(timeout=1.0):
+        if not dialog_thread.is_alive():
+            logger.error("The dialog stopped before the benchmark finished! Check previous error messages.")
+            return 1
+
+    turns = len(utterances)
+    elapsed_seconds = source.finished_time - source.utterance_times[0]
+
+    print(f"\nRan {turns} turns in {elapsed_seconds:.1f}s ({60 * turns / elapsed_seconds:.1f} turns/minute), with {token_delay:.3f}s/token from the stand-in LLM.\n")
+
+    print_stats(metrics_dir / 'spans.jsonl')
+
+    return 0
+
+
+def model_host():
+    """
+    Load the speech-to-text and text-to-speech models once, and serve them to
+    any number of `serve` front ends (e.g., one per room) with USE_MODEL_HOST set.
+    """
+
+    global stt_backend # horrible hack for now
+
+    # this is the model host, so load the models here
+    settings.USE_MODEL_HOST = False
+
+    tts_engine = build_tts_engine()
+
+    # only the STT backend: the keyword spotter and speech gate run in the front ends
+    with RadioSilence(stdout=True):
+        stt_backend = build_stt_backend(settings)
+
+    warm_up_stt_engine()
+    warm_up_tts_engine(tts_engine)
+
+    host = ModelHost(
+        stt_backend,
+        tts_engine,
+        Path(settings.MODEL_HOST_SOCKET).expanduser(),
+        max_batch_size=settings.MODEL_HOST_MAX_BATCH,
+        batch_window_seconds=settings.MODEL_HOST_BATCH_WINDOW_SECONDS,
+    )
+    host.serve_forever()
+
+    return 0
+
+
+def stt_bench(wav_paths: List[Path], backend_names: List[str], models: List[str]):
+    if not wav_paths:
+        tts_engine = TTSEngine(settings.TTS_MODEL_NAME, settings.TTS_SPEECH_SPEED, in_memory=settings.TTS_IN_MEMORY)
+        wav_paths = render_fixtures(tts_engine, default_fixture_phrases + [settings.SLEEP_COMMAND, settings.WAKE_COMMAND])
+        del tts_engine
+
+    fixtures = [ load_fixture(wav_path) for wav_path in wav_paths ]
+
+    run_stt_benchmark(settings, fixtures, backend_names, models)
+
+    return 0
+
+
 def main():
     global settings # horrible hack for now
 
@@ -490,10 +1539,20 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--quiet', action='store_true')
-    parser.add_argument('mode', choices=('serve', 'list-mics',))
+    parser.add_argument('--wav', action='append', type=Path, default=[], help="stt-bench, bench: a WAV recording to benchmark with (repeatable); a .txt file alongside it is taken as its transcript. Defaults to synthesized recordings.")
+    parser.add_argument('--stt-backend', action='append', choices=stt_backend_names, default=[], help="stt-bench: an STT backend to benchmark (repeatable). Defaults to the STT_BACKEND setting.")
+    parser.add_argument('--stt-model', action='append', default=[], help="stt-bench: a whisper model size to benchmark, such as tiny.en or small.en (repeatable). Defaults to the WHISPER_MODEL setting.")
+    parser.add_argument('--repeat', type=int, default=3, help="bench: how many times to play all of the recordings")
+    parser.add_argument('--prompt-delay', type=float, default=0.2, help="bench: how long the stand-in LLM takes to process each prompt, in seconds")
+    parser.add_argument('--token-delay', type=float, default=0.05, help="bench: how long the stand-in LLM takes to generate each token, in seconds")
+    parser.add_argument('--profile-imports', action='store_true', help="Report how long startup spends importing each package, after running the given mode.")
+    parser.add_argument('mode', choices=('serve', 'list-mics', 'stt-bench', 'stats', 'bench', 'text-bench', 'model-host',))
 
     args = parser.parse_args()
 
+    if args.profile_imports:
+        return profile_imports([ arg for arg in sys.argv[1:] if arg != '--profile-imports' ])
+
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug("Debug mode enabled.")
@@ -505,6 +1564,23 @@ def main():
         if args.mode == 'serve':
             return serve()
 
+        elif args.mode == "stt-bench":
+            return stt_bench(args.wav, args.stt_backend or [settings.STT_BACKEND], args.stt_model or [settings.WHISPER_MODEL])
+
+        elif args.mode == "bench":
+            return bench(args.wav, args.repeat, args.prompt_delay, args.token_delay)
+
+        elif args.mode == "text-bench":
+            run_text_benchmark(settings)
+            return 0
+
+        elif args.mode == "model-host":
+            return model_host()
+
+        elif args.mode == "stats":
+            print_stats(Path(settings.METRICS_JSONL_PATH).expanduser())
+            return 0
+
         elif args.mode == "list-mics":
             print(f"Using mic_device_index {settings.MICROPHONE_DEVICE_INDEX}, per settings. These are the available microphone devices:\n")
 
@@ -524,3 +1600,7 @@ def main():
         msg = "Exiting on user request."
         logger.info(msg)
         print(msg)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
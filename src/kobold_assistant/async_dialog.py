@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import speech_recognition as stt
+
+from .capture import ContinuousCapture
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class AsyncDialog:
+    """
+    Runs the conversation as concurrent asyncio tasks, rather than as a strictly
+    sequential loop: the microphone is always captured (by ContinuousCapture),
+    utterances are recognized as they arrive, and responses are generated and
+    spoken in the background, so that the assistant is always listening, even
+    while it's speaking.
+
+    The blocking work is done by the given callables, in worker threads:
+
+    - recognize(audio) turns an utterance into text, or None if nothing was said.
+    - respond(text, cancelled) responds to what the user said.  It should stop
+      as soon as it can once cancelled (a threading.Event) is set.
+    - on_silence(cancelled) is called after silence_timeout seconds without
+      anything being said, e.g., to check that the user is still there.
+    - interrupt_speech() stops the assistant speaking immediately.
+    - pause_speech() and resume_speech() hold the assistant's speech where it
+      is, and carry on with it.
+
+    With barge_in, the user starting to speak pauses the current response's
+    speech (its generation carries on).  Only once what they said is
+    recognized as something to respond to is the response cancelled (both its
+    generation and its playback), for the new one.  If it was only noise (a
+    cough, a door, the TV), too short to be speech, or nothing recognizable,
+    the response's speech is resumed.
+    """
+
+    def __init__(
+        self,
+        capture: ContinuousCapture,
+        recognize: Callable[[stt.AudioData], Optional[str]],
+        respond: Callable[[str, threading.Event], None],
+        on_silence: Callable[[threading.Event], None],
+        interrupt_speech: Callable[[], None],
+        pause_speech: Callable[[], None],
+        resume_speech: Callable[[], None],
+        silence_timeout: Optional[float] = None,
+        barge_in: bool = True,
+    ):
+        self.capture = capture
+        self.recognize = recognize
+        self.respond = respond
+        self.on_silence = on_silence
+        self.interrupt_speech = interrupt_speech
+        self.pause_speech = pause_speech
+        self.resume_speech = resume_speech
+        self.silence_timeout = silence_timeout
+        self.barge_in = barge_in
+
+        self._stt_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dialog-stt')
+
+        # one response at a time, so that a cancelled response has finished
+        # with the chat log before the next one starts
+        self._response_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dialog-response')
+
+        self._response_task = None
+
+        # sounds that paused the response, which haven't yet turned out to be
+        # something to respond to, or not
+        self._unconfirmed_speech = 0
+
+    def _start_response(self, work: Callable[[threading.Event], None]):
+        self._cancel_response()
+        self._response_task = asyncio.create_task(self._run_response(work))
+
+    async def _run_response(self, work: Callable[[threading.Event], None]):
+        cancelled = threading.Event()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._response_executor, work, cancelled)
+
+        except asyncio.CancelledError:
+            cancelled.set()
+            self.interrupt_speech()
+            raise
+
+        except Exception as e:
+            logger.exception("Responding failed: %r", e)
+
+    def _cancel_response(self) -> bool:
+        if self._response_task is None or self._response_task.done():
+            return False
+
+        self._response_task.cancel()
+        return True
+
+    def _on_speech_start(self):
+        if not self.barge_in or self._response_task is None or self._response_task.done():
+            return
+
+        if self._unconfirmed_speech == 0:
+            logger.info("User started speaking; pausing the response.")
+            self.pause_speech()
+
+        self._unconfirmed_speech += 1
+
+    def _on_speech_end(self, confirmed: bool):
+        """Once a sound that paused the response has turned out to be speech to respond to (or not)"""
+
+        if self._unconfirmed_speech == 0:
+            return
+
+        self._unconfirmed_speech -= 1
+
+        if confirmed:
+            logger.info("Interrupting the response, to respond to what the user said.")
+            self._unconfirmed_speech = 0
+            self._cancel_response()
+
+        elif self._unconfirmed_speech == 0:
+            logger.info("That wasn't anything to respond to; resuming the response.")
+            self.resume_speech()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        utterances = asyncio.Queue()
+        self.capture.on_utterance(lambda audio: loop.call_soon_threadsafe(utterances.put_nowait, audio))
+        self.capture.on_speech_start(lambda: loop.call_soon_threadsafe(self._on_speech_start))
+        self.capture.on_speech_discarded(lambda: loop.call_soon_threadsafe(self._on_speech_end, False))
+
+        try:
+            while True:
+                try:
+                    audio = await asyncio.wait_for(utterances.get(), timeout=self.silence_timeout)
+                except asyncio.TimeoutError:
+                    if self._response_task is None or self._response_task.done():
+                        self._start_response(self.on_silence)
+                    continue
+
+                text = await loop.run_in_executor(self._stt_executor, self.recognize, audio)
+                self._on_speech_end(text is not None)
+                if text is None:
+                    continue
+
+                self._start_response(lambda cancelled, text=text: self.respond(text, cancelled))
+
+        finally:
+            self._cancel_response()
+
+            self._stt_executor.shutdown(wait=False)
+            self._response_executor.shutdown(wait=False)
@@ -0,0 +1,122 @@
+from typing import NamedTuple
+
+
+class PCMAudio(NamedTuple):
+    """Raw, uncompressed, interleaved PCM audio, plus what's needed to play it back"""
+
+    data: bytes # or any other bytes-like object
+    sample_rate: int
+    sample_width: int # bytes per sample
+    channels: int = 1
+
+    @property
+    def duration(self) -> float:
+        frame_size = self.sample_width * self.channels
+        return len(self.data) / (frame_size * self.sample_rate)
+
+
+def float_to_pcm16(samples, sample_rate: int) -> PCMAudio:
+    """
+    Convert a float waveform in the range [-1.0, 1.0] (such as a TTS model's output)
+    to 16-bit PCM, clipping anything out of range.  Conversion happens in place
+    where possible, and the result refers to the converted array's memory directly,
+    rather than copying it again into a bytes object.
+    """
+
+    import numpy as np
+
+    waveform = np.asarray(samples, dtype=np.float32)
+    if waveform is samples:
+        # don't modify the caller's array
+        waveform = waveform.copy()
+
+    np.clip(waveform, -1.0, 1.0, out=waveform)
+    waveform *= 32767
+
+    pcm = waveform.astype('<i2')
+    pcm.setflags(write=False) # so that C extensions accept it as read-only bytes
+
+    return PCMAudio(memoryview(pcm).cast('B'), sample_rate, 2, 1)
+
+
+class WhisperSampleConverter:
+    """
+    Converts captured 16-bit PCM audio straight to the 16kHz mono float32
+    samples that whisper models take, without going through the WAV (or FLAC)
+    encoding and decoding that the SpeechRecognition library does.
+
+    Conversion to float32, and resampling (by linear interpolation, like
+    audioop.ratecv), are vectorized, into buffers that are kept and reused from
+    one utterance to the next, so that only the first few utterances (and any
+    longer than those before them) allocate anything.  The returned samples are
+    a view of one of those buffers, so they're only valid until the next
+    conversion; that's fine for passing straight to a model, but copy them to
+    keep them.  Not thread-safe: use one converter per thread, or a lock.
+    """
+
+    sample_rate = 16000
+
+    def __init__(self):
+        import numpy as np
+
+        self._pcm = np.empty(0, dtype=np.float32)
+        self._ramp = np.empty(0, dtype=np.float64)
+        self._positions = np.empty(0, dtype=np.float64)
+        self._indices = np.empty(0, dtype=np.intp)
+        self._fractions = np.empty(0, dtype=np.float32)
+        self._next_samples = np.empty(0, dtype=np.float32)
+        self._samples = np.empty(0, dtype=np.float32)
+
+    def _reserve(self, name: str, length: int):
+        """The first length items of the named buffer, reallocating it (with room to grow) if it's too small"""
+
+        import numpy as np
+
+        buffer = getattr(self, name)
+        if len(buffer) < length:
+            buffer = np.empty(max(length, len(buffer) * 2), dtype=buffer.dtype)
+            if name == '_ramp':
+                buffer[:] = np.arange(len(buffer))
+            setattr(self, name, buffer)
+
+        return buffer[:length]
+
+    def convert(self, data, sample_rate: int):
+        """Convert mono, 16-bit, PCM data (any bytes-like object) at sample_rate to 16kHz float32 samples"""
+
+        import numpy as np
+
+        pcm = np.frombuffer(data, dtype='<i2')
+        scale = np.float32(1.0 / 32768.0)
+
+        if sample_rate == self.sample_rate or len(pcm) < 2:
+            samples = self._reserve('_samples', len(pcm))
+            np.multiply(pcm, scale, out=samples)
+            return samples
+
+        pcm_samples = self._reserve('_pcm', len(pcm))
+        np.multiply(pcm, scale, out=pcm_samples)
+
+        length = len(pcm) * self.sample_rate // sample_rate
+        positions = self._reserve('_positions', length)
+        indices = self._reserve('_indices', length)
+        fractions = self._reserve('_fractions', length)
+        next_samples = self._reserve('_next_samples', length)
+        samples = self._reserve('_samples', length)
+
+        # where each output sample falls, between input samples i and i + 1
+        np.multiply(self._reserve('_ramp', length), sample_rate / self.sample_rate, out=positions)
+        np.minimum(positions, len(pcm) - 1, out=positions)
+        np.copyto(indices, positions, casting='unsafe') # i.e., floor(), since they're positive
+        np.minimum(indices, len(pcm) - 2, out=indices)
+        np.subtract(positions, indices, out=fractions, casting='unsafe')
+
+        # samples[i] + (samples[i + 1] - samples[i]) * fraction
+        np.take(pcm_samples, indices, out=samples)
+        indices += 1
+        np.take(pcm_samples, indices, out=next_samples)
+        next_samples -= samples
+        next_samples *= fractions
+        samples += next_samples
+
+        return samples
@@ -0,0 +1,202 @@
+import json
+import logging
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, List
+
+import speech_recognition as stt
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+default_bench_response = (
+    "Sure, I can help with that. "
+    "Here's a short answer, with a few sentences in it, so that streaming and playback both get some exercise. "
+    "Would you like to know more?"
+)
+
+
+class FakeKoboldServer:
+    """
+    A stand-in for a KoboldCPP server, for benchmarking without an LLM.  Serves
+    the generate, streaming generate, token count and abort APIs on localhost,
+    always responding with the same text, after prompt_delay seconds (to
+    process the prompt), plus token_delay seconds per token generated.
+    """
+
+    def __init__(self, response_text: str = default_bench_response, prompt_delay: float = 0.2, token_delay: float = 0.05):
+        self.response_tokens = re.findall(r'\S+\s*', response_text)
+        self.prompt_delay = prompt_delay
+        self.token_delay = token_delay
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-kobold-server', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _generate(self) -> Iterator[str]:
+        time.sleep(self.prompt_delay)
+        for token in self.response_tokens:
+            time.sleep(self.token_delay)
+            yield token
+
+    def _handler_class(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug("fake KoboldAI server: " + format, *args)
+
+            def _send_json(self, payload: dict):
+                body = json.dumps(payload).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+                if self.path == '/api/v1/generate':
+                    self._send_json({'results': [{'text': "".join(fake_server._generate())}]})
+
+                elif self.path == '/api/extra/generate/stream':
+                    # no content length, so the end of the response is marked by closing the connection
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    self.close_connection = True
+
+                    for token in fake_server._generate():
+                        self.wfile.write(f"event: message\ndata: {json.dumps({'token': token})}\n\n".encode('utf8'))
+                        self.wfile.flush()
+
+                elif self.path == '/api/extra/tokencount':
+                    self._send_json({'value': math.ceil(len(request.get('prompt', '')) / 4)})
+
+                elif self.path == '/api/extra/abort':
+                    self._send_json({'success': True})
+
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _WavFileStream:
+    def __init__(self, chunks: Iterator[bytes], chunk_seconds: float):
+        self._chunks = chunks
+        self._chunk_seconds = chunk_seconds
+        self._next_chunk_time = time.monotonic()
+
+    def read(self, size: int) -> bytes:
+        # deliver audio in real time, like a microphone would
+        now = time.monotonic()
+        if self._next_chunk_time > now:
+            time.sleep(self._next_chunk_time - now)
+        self._next_chunk_time = max(self._next_chunk_time, now) + self._chunk_seconds
+
+        return next(self._chunks)
+
+    def close(self):
+        pass
+
+
+class WavFileSource(stt.AudioSource):
+    """
+    Plays recorded utterances into the assistant, in place of a microphone,
+    for benchmarking.  Silence is played until ready(utterances_played) returns
+    True (e.g., once the assistant has responded to the previous utterance), and
+    stays True for gap_seconds; then the next utterance is played.
+
+    Once the last utterance has been played and responded to, the finished
+    event is set, and silence is played from then on.  The (monotonic) times
+    at which each utterance started playing, and at which the source finished,
+    are kept in utterance_times and finished_time.
+    """
+
+    def __init__(
+        self,
+        utterances: List[stt.AudioData],
+        ready: Callable[[int], bool],
+        gap_seconds: float = 1.0,
+        ready_timeout: float = 120.0,
+        sample_rate: int = 16000,
+        chunk_size: int = 1024,
+    ):
+        self.SAMPLE_RATE = sample_rate
+        self.SAMPLE_WIDTH = 2
+        self.CHUNK = chunk_size
+
+        self.utterances = [ audio.get_raw_data(convert_rate=sample_rate, convert_width=self.SAMPLE_WIDTH) for audio in utterances ]
+        self.ready = ready
+        self.gap_seconds = gap_seconds
+        self.ready_timeout = ready_timeout
+
+        self.utterance_times = []
+        self.finished_time = None
+        self.finished = threading.Event()
+        self.stream = None
+
+    def __enter__(self):
+        self.stream = _WavFileStream(self._chunks(), self.CHUNK / self.SAMPLE_RATE)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream = None
+
+    def _wait_until_ready(self, utterances_played: int) -> Iterator[bytes]:
+        silence = bytes(self.CHUNK * self.SAMPLE_WIDTH)
+        chunk_seconds = self.CHUNK / self.SAMPLE_RATE
+
+        waited_seconds = 0.0
+        ready_seconds = 0.0
+        while ready_seconds < self.gap_seconds:
+            if waited_seconds > self.ready_timeout:
+                logger.warning("Gave up waiting for a response to utterance %d after %.0f seconds", utterances_played, waited_seconds)
+                return
+
+            if self.ready(utterances_played):
+                ready_seconds += chunk_seconds
+            else:
+                ready_seconds = 0.0
+
+            waited_seconds += chunk_seconds
+            yield silence
+
+    def _chunks(self) -> Iterator[bytes]:
+        chunk_bytes = self.CHUNK * self.SAMPLE_WIDTH
+
+        for utterances_played, utterance in enumerate(self.utterances):
+            yield from self._wait_until_ready(utterances_played)
+            self.utterance_times.append(time.monotonic())
+
+            for chunk_start in range(0, len(utterance), chunk_bytes):
+                yield utterance[chunk_start:chunk_start + chunk_bytes].ljust(chunk_bytes, b'\0')
+
+        yield from self._wait_until_ready(len(self.utterances))
+        self.finished_time = time.monotonic()
+        self.finished.set()
+
+        silence = bytes(chunk_bytes)
+        while True:
+            yield silence
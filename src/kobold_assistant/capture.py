@@ -0,0 +1,257 @@
+import audioop
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from itertools import islice
+from typing import Callable, Optional
+
+import speech_recognition as stt
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class ContinuousCapture:
+    """
+    Captures audio from the microphone continuously, on a background thread,
+    so that nothing said while we're busy recognizing speech, generating a
+    response, and so on, is lost.
+
+    Audio is read into a fixed-size ring buffer of chunks.  A simple energy-based
+    voice activity detector (VAD) watches each chunk as it arrives, and when an
+    utterance ends (after end_silence_seconds of silence), its audio, including
+    a little pre-roll from before speech was detected, is cut from the ring
+    buffer and queued for recognition.
+
+    While ignore_while() returns True (e.g., while the assistant is speaking, so
+    that it doesn't hear itself), and for a short hold-off afterwards, audio is
+    still captured, but no utterances are detected.  Alternatively, if
+    ignore_energy_multiplier is given, utterances are still detected during
+    those times, but only if they're that much louder than usual, so that the
+    user can talk over the assistant.
+
+    If partial_pause_seconds is given, the utterance so far is also passed to
+    the on_partial_utterance() callbacks whenever the user pauses for that long
+    mid-utterance, so that work on it can start before the utterance ends.
+    """
+
+    def __init__(
+        self,
+        source: stt.AudioSource,
+        energy_threshold: float,
+        ring_buffer_seconds: float = 60,
+        pre_roll_seconds: float = 0.5,
+        end_silence_seconds: float = 0.8,
+        min_speech_seconds: float = 0.3,
+        max_utterance_seconds: float = 30,
+        ignore_while: Optional[Callable[[], bool]] = None,
+        ignore_holdoff_seconds: float = 0.3,
+        ignore_energy_multiplier: Optional[float] = None,
+        partial_pause_seconds: Optional[float] = None,
+    ):
+        self.source = source
+        self.energy_threshold = energy_threshold
+
+        chunk_seconds = source.CHUNK / source.SAMPLE_RATE
+        to_chunks = lambda seconds: max(1, int(round(seconds / chunk_seconds)))
+
+        self.pre_roll_chunks = to_chunks(pre_roll_seconds)
+        self.end_silence_chunks = to_chunks(end_silence_seconds)
+        self.min_speech_chunks = to_chunks(min_speech_seconds)
+        self.partial_pause_chunks = to_chunks(partial_pause_seconds) if partial_pause_seconds is not None else None
+
+        # an utterance must fit in the ring buffer, along with its pre-roll
+        ring_buffer_chunks = to_chunks(ring_buffer_seconds)
+        self.max_utterance_chunks = min(to_chunks(max_utterance_seconds), ring_buffer_chunks - self.pre_roll_chunks)
+
+        self.ignore_while = ignore_while
+        self.ignore_holdoff_seconds = ignore_holdoff_seconds
+        self.ignore_energy_multiplier = ignore_energy_multiplier
+        self._ignoring_until = 0.0
+
+        self._ring = deque(maxlen=ring_buffer_chunks)
+        self._chunks_read = 0 # absolute index of the next chunk
+
+        # absolute chunk index where the current utterance started, or None
+        self._utterance_start = None
+        self._voiced_chunks = 0
+        self._silent_chunks = 0
+
+        self._utterances = queue.Queue()
+        self._utterance_callbacks = []
+        self._speech_start_callbacks = []
+        self._speech_discarded_callbacks = []
+        self._partial_utterance_callbacks = []
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='mic-capture', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def on_speech_start(self, callback: Callable[[], None]):
+        """Call callback (from the capture thread) whenever the user starts speaking"""
+        self._speech_start_callbacks.append(callback)
+
+    def on_speech_discarded(self, callback: Callable[[], None]):
+        """
+        Call callback (from the capture thread) whenever something that started
+        like speech (see on_speech_start()) ends without being an utterance,
+        e.g., because it was too short
+        """
+        self._speech_discarded_callbacks.append(callback)
+
+    def on_utterance(self, callback: Callable[[stt.AudioData], None]):
+        """
+        Pass each utterance to callback (from the capture thread) as soon as
+        it ends, instead of queueing it for get_utterance()
+        """
+        self._utterance_callbacks.append(callback)
+
+    def on_partial_utterance(self, callback: Callable[[stt.AudioData], None]):
+        """
+        Pass the utterance so far to callback (from the capture thread)
+        whenever the user pauses mid-utterance; see partial_pause_seconds.
+        It should return quickly.
+        """
+        self._partial_utterance_callbacks.append(callback)
+
+    def get_utterance(self, timeout: Optional[float] = None) -> stt.AudioData:
+        """
+        Return the next complete utterance, waiting up to timeout seconds (or
+        forever, if timeout is None) for one.  Raises stt.WaitTimeoutError
+        on timeout, just as stt.Recognizer.listen() does.
+        """
+        try:
+            return self._utterances.get(timeout=timeout)
+        except queue.Empty:
+            raise stt.WaitTimeoutError("timed out waiting for an utterance")
+
+    def discard_utterances(self):
+        """Throw away any utterances that have been captured, but not yet collected"""
+        while True:
+            try:
+                self._utterances.get_nowait()
+            except queue.Empty:
+                break
+
+    def _current_energy_threshold(self) -> Optional[float]:
+        """The energy level above which audio is considered speech, right now, or None if we're ignoring audio"""
+
+        now = time.monotonic()
+
+        if self.ignore_while is not None and self.ignore_while():
+            self._ignoring_until = now + self.ignore_holdoff_seconds
+
+        if now < self._ignoring_until:
+            if self.ignore_energy_multiplier is None:
+                return None
+
+            return self.energy_threshold * self.ignore_energy_multiplier
+
+        return self.energy_threshold
+
+    def _run(self):
+        while not self._stop.is_set():
+            chunk = self.source.stream.read(self.source.CHUNK)
+            if not chunk:
+                # end of input; only expected for non-microphone sources
+                if self._utterance_start is not None:
+                    self._end_utterance()
+                break
+
+            self._process_chunk(chunk)
+
+    def _process_chunk(self, chunk: bytes):
+        chunk_index = self._chunks_read
+        self._chunks_read += 1
+        self._ring.append(chunk)
+
+        energy_threshold = self._current_energy_threshold()
+        if energy_threshold is None:
+            if self._utterance_start is not None:
+                self._discard_utterance()
+            return
+
+        is_speech = audioop.rms(chunk, self.source.SAMPLE_WIDTH) > energy_threshold
+
+        if self._utterance_start is None:
+            if not is_speech:
+                return
+
+            oldest_chunk_index = self._chunks_read - len(self._ring)
+            self._utterance_start = max(oldest_chunk_index, chunk_index - self.pre_roll_chunks)
+            self._voiced_chunks = 1
+            self._silent_chunks = 0
+
+            for callback in self._speech_start_callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error("Speech start callback %r failed: %r", callback, e)
+
+            return
+
+        if is_speech:
+            self._voiced_chunks += 1
+            self._silent_chunks = 0
+        else:
+            self._silent_chunks += 1
+
+            if self._silent_chunks == self.partial_pause_chunks and self._voiced_chunks >= self.min_speech_chunks:
+                audio = self._cut_utterance()
+                for callback in self._partial_utterance_callbacks:
+                    try:
+                        callback(audio)
+                    except Exception as e:
+                        logger.error("Partial utterance callback %r failed: %r", callback, e)
+
+        utterance_chunks = self._chunks_read - self._utterance_start
+        if self._silent_chunks >= self.end_silence_chunks or utterance_chunks >= self.max_utterance_chunks:
+            self._end_utterance()
+
+    def _cut_utterance(self) -> stt.AudioData:
+        """The current utterance's audio, so far, from the ring buffer"""
+
+        oldest_chunk_index = self._chunks_read - len(self._ring)
+        start = max(0, self._utterance_start - oldest_chunk_index)
+
+        # trailing silence beyond what's needed to detect the end isn't useful
+        end = len(self._ring) - max(0, self._silent_chunks - self.pre_roll_chunks)
+
+        frame_data = b"".join(islice(self._ring, start, end))
+        return stt.AudioData(frame_data, self.source.SAMPLE_RATE, self.source.SAMPLE_WIDTH)
+
+    def _discard_utterance(self):
+        self._utterance_start = None
+
+        for callback in self._speech_discarded_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Speech discarded callback %r failed: %r", callback, e)
+
+    def _end_utterance(self):
+        if self._voiced_chunks < self.min_speech_chunks:
+            logger.debug("Ignoring a sound too short to be speech (%d chunks)", self._voiced_chunks)
+            self._discard_utterance()
+            return
+
+        audio = self._cut_utterance()
+        self._utterance_start = None
+
+        if not self._utterance_callbacks:
+            self._utterances.put(audio)
+            return
+
+        for callback in self._utterance_callbacks:
+            try:
+                callback(audio)
+            except Exception as e:
+                logger.error("Utterance callback %r failed: %r", callback, e)
@@ -0,0 +1,344 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from .kobold_client import KoboldAPIError, KoboldClient
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class TokenCounter:
+    """
+    Counts tokens the way the LLM will, using the KoboldCPP token count API.
+    If that's unsupported (e.g., with KoboldAI), falls back to a rough estimate,
+    erring on the side of overcounting, from then on.  If it fails otherwise
+    (e.g., the server is restarting), the estimate is only used for
+    retry_seconds, before trying the API again.
+    """
+
+    # a conservative ratio for English text with llama-like tokenizers
+    estimated_chars_per_token = 3.0
+
+    def __init__(self, kobold_client: Optional[KoboldClient], retry_seconds: float = 30.0):
+        self.kobold_client = kobold_client
+        self.retry_seconds = retry_seconds
+
+        self._retry_after = 0.0
+
+    def estimate(self, text: str) -> int:
+        return math.ceil(len(text) / self.estimated_chars_per_token)
+
+    def __call__(self, text: str) -> int:
+        kobold_client = self.kobold_client
+        if kobold_client is None or time.monotonic() < self._retry_after:
+            return self.estimate(text)
+
+        try:
+            return kobold_client.count_tokens(text)
+
+        except KoboldAPIError as e:
+            if e.unsupported:
+                logger.warning("The KoboldAI API can't count tokens (%r); estimating token counts from now on.", e)
+                self.kobold_client = None
+            else:
+                logger.warning("Couldn't count tokens with the KoboldAI API (%r); estimating token counts for the next %.0fs.", e, self.retry_seconds)
+                self._retry_after = time.monotonic() + self.retry_seconds
+
+            return self.estimate(text)
+
+
+class ChatHistory:
+    """
+    The conversation, persisted to a JSONL file, so that a restart resumes it.
+    Each line of dialog is appended as it's said, as {"ts": ..., "line": ...}.
+    A summary of the earlier dialog is kept as {"ts": ..., "summary": ...,
+    "through": n}, where n is how many of the lines in the file (from the start)
+    it summarizes; only the latest summary counts.  The file is rewritten
+    whenever there's a new summary, so that it doesn't keep what it summarizes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path).expanduser()
+
+    def load(self) -> Tuple[Optional[str], List[str]]:
+        """Read the history, returning the latest summary (if any), and the lines of dialog since it"""
+
+        summary = None
+        summarized_line_count = 0
+        lines = []
+
+        try:
+            with open(self.path, encoding='utf8') as fp:
+                for record_line in fp:
+                    try:
+                        record = json.loads(record_line)
+                    except ValueError:
+                        # e.g., a half-written record, from a crash
+                        logger.warning("Ignoring a corrupt record in the chat history %r", str(self.path))
+                        continue
+
+                    if 'line' in record:
+                        lines.append(record['line'])
+                    elif 'summary' in record:
+                        summary, summarized_line_count = record['summary'], record['through']
+
+        except FileNotFoundError:
+            pass
+
+        return summary, lines[summarized_line_count:]
+
+    def _write(self, records: List[dict], mode: str):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, mode, encoding='utf8') as fp:
+            fp.write(''.join(json.dumps(record) + '\n' for record in records))
+
+    def append_line(self, line: str):
+        try:
+            self._write([ {'ts': time.time(), 'line': line} ], 'a')
+        except OSError as e:
+            logger.warning("Couldn't append to the chat history %r: %r", str(self.path), e)
+
+    def rewrite(self, summary: Optional[str], lines: List[str]):
+        """
+        Replace the whole history with just a summary and the lines since it,
+        dropping everything that's been summarized or evicted, so that the file
+        doesn't grow forever.  Written to a temporary file, then renamed over the
+        old one, so that a crash never loses the history.
+        """
+
+        records = [ {'ts': time.time(), 'summary': summary, 'through': 0} ] if summary is not None else []
+        records += [ {'ts': time.time(), 'line': line} for line in lines ]
+
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf8') as fp:
+                fp.write(''.join(json.dumps(record) + '\n' for record in records))
+            os.replace(tmp_path, self.path)
+
+        except OSError as e:
+            logger.warning("Couldn't compact the chat history %r: %r", str(self.path), e)
+
+
+class ChatLog:
+    """
+    The conversation so far, and the prompt for the LLM built from it.
+
+    The prompt is a fixed prefix (the context), followed by as many of the most
+    recent lines of dialog as fit in max_prompt_tokens, and then the cue for the
+    assistant to respond.  The token count of each line is counted once, when
+    it's appended, and kept with the line.
+
+    When the prompt gets too long, whole lines are evicted from the front, until
+    there's eviction_headroom (a fraction of max_prompt_tokens) to spare again.
+    Evicting in batches like this, and keeping the prefix byte-identical, means
+    that the start of the prompt stays the same for several turns at a time, so
+    that KoboldCPP can reuse its processing of it (its KV cache) rather than
+    processing the whole prompt again on every turn.
+
+    With a summarize function, long-range memory is kept by summarizing: once
+    the dialog takes up more than summarize_threshold of max_prompt_tokens,
+    summarize_in_background() asks summarize(previous_summary, lines) to fold
+    all but the latest summarize_keep_lines lines into a running summary, which
+    goes between the prefix and the dialog.  That happens in a background
+    thread, between turns, so the prompt stays short, and memory use stays flat,
+    without making anyone wait.
+
+    With a ChatHistory, every line and summary is also persisted, and the
+    conversation is resumed from it.
+    """
+
+    summary_format = "Summary of the dialog so far: {summary}"
+
+    def __init__(
+        self,
+        prefix: str,
+        assistant_name: str,
+        max_prompt_tokens: int,
+        count_tokens: Callable[[str], int],
+        eviction_headroom: float = 0.25,
+        history: Optional[ChatHistory] = None,
+        summarize: Optional[Callable[[Optional[str], List[str]], Optional[str]]] = None,
+        summarize_threshold: float = 0.5,
+        summarize_keep_lines: int = 6,
+    ):
+        self.prefix = prefix
+        self.assistant_cue = f'{assistant_name}: '
+        self.max_prompt_tokens = max_prompt_tokens
+        self.count_tokens = count_tokens
+        self.eviction_headroom = eviction_headroom
+        self.history = history
+        self.summarize = summarize
+        self.summarize_threshold = summarize_threshold
+        self.summarize_keep_lines = summarize_keep_lines
+
+        # lines may be appended while the dialog is summarized in the background
+        self._lock = threading.RLock()
+        self._summarizing = False
+
+        # (line number in the history, line, token count) for each line in the prompt
+        self._lines = deque()
+        self._lines_tokens = 0
+        self._line_count = 0
+
+        self.summary = None
+        self._summary_tokens = 0
+
+        # allowing for the prefix, and the assistant's cue at the end
+        self._reserved_tokens = count_tokens(prefix) + count_tokens("\n" + self.assistant_cue)
+
+        if history is not None:
+            summary, lines = history.load()
+            if summary is not None:
+                self._set_summary(summary, self._count_summary_tokens(summary))
+
+            for line in lines:
+                self._append(line, self._count_line_tokens(line))
+
+            logger.info("Resumed the conversation from %r, with %d lines of dialog%s.", str(history.path), len(self._lines), " and a summary" if summary else "")
+
+            self._compact_history()
+
+    def reconfigure(self, prefix: str, assistant_name: str, max_prompt_tokens: int, eviction_headroom: float):
+        """
+        Change the prefix, cue, or size limits of the prompt (e.g., when the settings
+        change), keeping the dialog so far.  If the prompt is now too long, it's
+        trimmed when the next line is appended.
+        """
+
+        reserved_tokens = self.count_tokens(prefix) + self.count_tokens("\n" + f'{assistant_name}: ')
+
+        self.prefix = prefix
+        self.assistant_cue = f'{assistant_name}: '
+        self.max_prompt_tokens = max_prompt_tokens
+        self.eviction_headroom = eviction_headroom
+        self._reserved_tokens = reserved_tokens
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter([ line for _, line, _ in self._lines ])
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self._reserved_tokens + self._summary_tokens + self._lines_tokens
+
+    def _compact_history(self):
+        """Drop whatever's been summarized or evicted from the history, and number the lines from 0 again, to match it"""
+
+        with self._lock:
+            self.history.rewrite(self.summary, [ line for _, line, _ in self._lines ])
+            self._lines = deque((i, line, line_tokens) for i, (_, line, line_tokens) in enumerate(self._lines))
+            self._line_count = len(self._lines)
+
+    def _count_summary_tokens(self, summary: str) -> int:
+        return self.count_tokens(self.summary_format.format(summary=summary)) + 1
+
+    def _count_line_tokens(self, line: str) -> int:
+        return self.count_tokens(line) + 1 # for the newline that joins it on
+
+    def _set_summary(self, summary: str, summary_tokens: int):
+        self.summary = summary
+        self._summary_tokens = summary_tokens
+
+    def _append(self, line: str, line_tokens: int):
+        with self._lock:
+            self._lines.append((self._line_count, line, line_tokens))
+            self._line_count += 1
+            self._lines_tokens += line_tokens
+
+            if self.prompt_tokens > self.max_prompt_tokens:
+                target_tokens = self.max_prompt_tokens * (1.0 - self.eviction_headroom)
+
+                # always keep the latest line, even if it doesn't fit
+                while len(self._lines) > 1 and self.prompt_tokens > target_tokens:
+                    _, _, evicted_tokens = self._lines.popleft()
+                    self._lines_tokens -= evicted_tokens
+
+                logger.debug("Evicted old lines from the prompt; %d lines (~%d tokens) remain", len(self._lines), self.prompt_tokens)
+
+    def append(self, line: str):
+        # counting can take a round trip to the LLM server, so it's done before
+        # taking the lock, which build_prompt() and the summarizer wait on
+        line_tokens = self._count_line_tokens(line)
+
+        with self._lock:
+            self._append(line, line_tokens)
+
+            if self.history is not None:
+                self.history.append_line(line)
+
+    def summarize_in_background(self) -> bool:
+        """
+        If the dialog is long enough, start summarizing its older lines in a
+        background thread, unless that's already happening.  Call between
+        turns.  Returns whether it started.
+        """
+
+        with self._lock:
+            if (
+                self.summarize is None
+                or self._summarizing
+                or self._lines_tokens <= self.max_prompt_tokens * self.summarize_threshold
+                or len(self._lines) <= self.summarize_keep_lines
+            ):
+                return False
+
+            lines_to_summarize = list(self._lines)[:len(self._lines) - self.summarize_keep_lines]
+            self._summarizing = True
+
+        threading.Thread(
+            target=self._summarize,
+            args=(self.summary, lines_to_summarize),
+            name='chat-summarizer',
+            daemon=True,
+        ).start()
+
+        return True
+
+    def _summarize(self, previous_summary: Optional[str], lines_to_summarize: List[Tuple[int, str, int]]):
+        try:
+            start_time = time.perf_counter()
+            summary = self.summarize(previous_summary, [ line for _, line, _ in lines_to_summarize ])
+            if not summary:
+                logger.warning("Couldn't summarize the dialog; trying again after the next turn.")
+                return
+
+            # the lines may have been evicted (or more appended) in the meantime
+            last_summarized_line = lines_to_summarize[-1][0]
+            summary_tokens = self._count_summary_tokens(summary)
+
+            with self._lock:
+                while self._lines and self._lines[0][0] <= last_summarized_line:
+                    _, _, summarized_tokens = self._lines.popleft()
+                    self._lines_tokens -= summarized_tokens
+
+                self._set_summary(summary, summary_tokens)
+
+                if self.history is not None:
+                    self._compact_history()
+
+            logger.debug("Summarized %d lines of dialog in %.1fs; %d lines (~%d tokens) remain", len(lines_to_summarize), time.perf_counter() - start_time, len(self._lines), self.prompt_tokens)
+
+        except Exception as e:
+            logger.exception("Summarizing the dialog failed with %r", e)
+
+        finally:
+            with self._lock:
+                self._summarizing = False
+
+    def build_prompt(self, extra_lines: Iterable[str] = ()) -> str:
+        """The prompt for the assistant's next response, as if extra_lines had been appended too"""
+
+        with self._lock:
+            summary_lines = [ self.summary_format.format(summary=self.summary) ] if self.summary is not None else []
+            return '\n'.join((self.prefix, *summary_lines, *self, *extra_lines, self.assistant_cue))
@@ -0,0 +1,135 @@
+import logging
+import random
+import threading
+from collections import deque
+from typing import Callable, List, Optional
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class LatencyModel:
+    """
+    Predicts how long the LLM will take to respond to a prompt, from how long
+    it took for the last few (window) prompts, with a least-squares fit of
+    seconds = a + b * prompt_tokens, since prompt processing time grows with
+    the prompt's length.  Until there are enough timings for a fit, it
+    predicts their mean.
+    """
+
+    def __init__(self, window: int = 20):
+        self._timings = deque(maxlen=window) # (prompt tokens, seconds)
+        self._lock = threading.Lock()
+
+    def record(self, prompt_tokens: int, seconds: float):
+        with self._lock:
+            self._timings.append((prompt_tokens, seconds))
+
+    def predict(self, prompt_tokens: int) -> Optional[float]:
+        """The predicted response time, in seconds, or None if there's nothing to go on yet"""
+
+        with self._lock:
+            timings = list(self._timings)
+
+        if not timings:
+            return None
+
+        n = len(timings)
+        mean_tokens = sum(tokens for tokens, _ in timings) / n
+        mean_seconds = sum(seconds for _, seconds in timings) / n
+
+        variance = sum((tokens - mean_tokens) ** 2 for tokens, _ in timings)
+        if n < 3 or variance == 0:
+            return mean_seconds
+
+        slope = sum((tokens - mean_tokens) * (seconds - mean_seconds) for tokens, seconds in timings) / variance
+
+        # a negative slope is just noise; longer prompts are never faster
+        slope = max(slope, 0.0)
+
+        return max(mean_seconds + slope * (prompt_tokens - mean_tokens), 0.0)
+
+
+class ThinkingFiller:
+    """
+    Says a filler phrase ("Let me think.") while the LLM works on a response,
+    but only if the response looks like it'll be slow, and without holding up
+    the request to the LLM.
+
+    start() is called as the request is sent.  If the latency model predicts
+    at least threshold_seconds for the response, a filler phrase is said
+    straight away, in the background.  Otherwise (or if there's no prediction
+    yet), it's said only if the response still hasn't arrived after
+    threshold_seconds, so fast responses never wait for it.  finish() is called
+    once the response has arrived (or failed), before it's said; it cancels the
+    filler if it hasn't started, or waits for it to be said, if it has, so that
+    they don't overlap.
+
+    Phrases are chosen at random from phrases() (which should be pre-rendered
+    into the TTS cache), avoiding saying the same one twice in a row.
+    """
+
+    def __init__(
+        self,
+        say: Callable[[str], None],
+        phrases: Callable[[], List[str]],
+        latency_model: LatencyModel,
+        threshold_seconds: float = 2.0,
+    ):
+        self.say = say
+        self.phrases = phrases
+        self.latency_model = latency_model
+        self.threshold_seconds = threshold_seconds
+
+        self._last_phrase = None
+
+        self._lock = threading.Lock()
+        self._timer = None
+        self._thread = None
+
+    def _choose_phrase(self) -> Optional[str]:
+        phrases = [ phrase for phrase in self.phrases() if phrase.strip() ]
+        if not phrases:
+            return None
+
+        fresh_phrases = [ phrase for phrase in phrases if phrase != self._last_phrase ] or phrases
+        self._last_phrase = random.choice(fresh_phrases)
+        return self._last_phrase
+
+    def _say_filler(self):
+        with self._lock:
+            if self._timer is None:
+                # finished in the meantime
+                return
+
+            self._timer = None
+            phrase = self._choose_phrase()
+            if phrase is None:
+                return
+
+            self._thread = threading.Thread(target=self.say, args=(phrase,), name='thinking-filler', daemon=True)
+            self._thread.start()
+
+    def start(self, prompt_tokens: int):
+        predicted_seconds = self.latency_model.predict(prompt_tokens)
+        if predicted_seconds is not None and predicted_seconds >= self.threshold_seconds:
+            logger.debug("Predicting a %.1fs response, so saying a filler phrase now", predicted_seconds)
+            delay = 0.0
+        else:
+            delay = self.threshold_seconds
+
+        with self._lock:
+            self._timer = threading.Timer(delay, self._say_filler)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def finish(self):
+        with self._lock:
+            timer, self._timer = self._timer, None
+            thread, self._thread = self._thread, None
+
+        if timer is not None:
+            timer.cancel()
+
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,76 @@
+import logging
+import wave
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+import speech_recognition as stt
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+default_fixtures_dir = Path("~").expanduser() / '.cache' / 'kobold_assistant' / 'fixtures'
+
+# typical things to say to the assistant, for benchmarking with when no recordings are given
+default_fixture_phrases = [
+    "What's the weather usually like in Scotland in the spring?",
+    "Tell me a joke about computers.",
+    "How many minutes are there in a day?",
+    "Thank you, that's all for now.",
+]
+
+
+class Fixture(NamedTuple):
+    """A recorded utterance, and what was said in it, if known"""
+
+    path: Path
+    audio: stt.AudioData
+    transcript: Optional[str]
+
+
+def load_fixture(wav_path: Path) -> Fixture:
+    """
+    Load a WAV recording.  If there's a .txt file of the same name alongside it,
+    that's taken as the transcript of what was said.
+    """
+
+    with stt.AudioFile(str(wav_path)) as source:
+        audio = stt.Recognizer().record(source)
+
+    transcript = None
+    transcript_path = wav_path.with_suffix('.txt')
+    if transcript_path.exists():
+        transcript = transcript_path.read_text().strip()
+
+    return Fixture(wav_path, audio, transcript)
+
+
+def render_fixtures(tts_engine, phrases: List[str], fixtures_dir: Path = default_fixtures_dir) -> List[Path]:
+    """
+    Synthesize a WAV recording (with a transcript) of each phrase with the TTS engine,
+    for use as fixtures when no real recordings are available.  Existing
+    recordings are reused.
+    """
+
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+
+    wav_paths = []
+    for i, phrase in enumerate(phrases):
+        wav_path = fixtures_dir / f"{i:02d}.wav"
+        transcript_path = wav_path.with_suffix('.txt')
+
+        if not (wav_path.exists() and transcript_path.exists() and transcript_path.read_text().strip() == phrase):
+            logger.info("Rendering fixture %r: %r", str(wav_path), phrase)
+            audio = tts_engine.synthesize(phrase)
+
+            with wave.open(str(wav_path), 'wb') as wav_file:
+                wav_file.setnchannels(audio.channels)
+                wav_file.setsampwidth(audio.sample_width)
+                wav_file.setframerate(audio.sample_rate)
+                wav_file.writeframes(audio.data)
+
+            transcript_path.write_text(phrase + "\n")
+
+        wav_paths.append(wav_path)
+
+    return wav_paths
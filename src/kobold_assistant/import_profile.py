@@ -0,0 +1,45 @@
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from typing import List
+
+
+# a line of python -X importtime's output: self time, cumulative time (both in
+# microseconds), and the module, indented by how deeply it was imported
+importtime_line_re = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def profile_imports(argv: List[str], top: int = 20) -> int:
+    """
+    Run kobold-assistant with argv in a child process, under python's
+    -X importtime, then print how long was spent importing each top-level
+    package (including its submodules), slowest first.
+    """
+
+    child = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'kobold_assistant', *argv],
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    package_microseconds = defaultdict(int)
+    for line in child.stderr.splitlines():
+        match = importtime_line_re.match(line)
+        if match is None:
+            # not import timing, so pass it on
+            print(line, file=sys.stderr)
+            continue
+
+        self_microseconds, _, _, module = match.groups()
+        package_microseconds[module.split('.')[0]] += int(self_microseconds)
+
+    total_microseconds = sum(package_microseconds.values())
+
+    print(f"\nSpent {total_microseconds / 1e6:.2f}s importing {len(package_microseconds)} packages. The slowest were:\n")
+    print(f"{'package':<32} {'time (s)':>9} {'share':>7}")
+
+    for package, microseconds in sorted(package_microseconds.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{package:<32} {microseconds / 1e6:9.3f} {microseconds / max(1, total_microseconds):7.1%}")
+
+    return child.returncode
@@ -0,0 +1,64 @@
+import difflib
+import logging
+from typing import Callable, List, Optional
+
+import speech_recognition as stt
+
+from .metrics import metrics
+from .stt_backends import STTBackend
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class KeywordSpotter:
+    """
+    Listens for a few command phrases (such as the WAKE_COMMAND, while the
+    assistant is asleep) cheaply, instead of running the full speech-to-text
+    model on everything that's heard.
+
+    Utterances that are too short or too long to be one of the phrases are
+    dropped without being recognized at all.  The rest are recognized with a
+    small STT backend (e.g., whisper's tiny.en model, prompted with the
+    phrases), and matched against the phrases with a similarity threshold,
+    to allow for the small model's mistakes.
+    """
+
+    def __init__(
+        self,
+        stt_backend: STTBackend,
+        phrases: List[str],
+        normalize: Callable[[str], str],
+        min_similarity: float = 0.75,
+        min_seconds: float = 0.3,
+        max_seconds: float = 3.0,
+    ):
+        self.stt_backend = stt_backend
+        self.phrases = phrases
+        self.normalize = normalize
+        self.min_similarity = min_similarity
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+
+    def spot(self, audio: stt.AudioData) -> Optional[str]:
+        """Return the phrase that was said in audio, or None if it wasn't one of them"""
+
+        duration = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+        if not self.min_seconds <= duration <= self.max_seconds:
+            logger.debug("Ignoring a %.1fs utterance, since it's not the length of a command", duration)
+            metrics.count('keyword_spotter_skipped')
+            return None
+
+        metrics.count('keyword_spotter_recognized')
+        heard = self.normalize(self.stt_backend.recognize(audio))
+        if not heard:
+            return None
+
+        similarity, phrase = max(
+            (difflib.SequenceMatcher(None, heard, self.normalize(phrase)).ratio(), phrase)
+            for phrase in self.phrases
+        )
+
+        logger.debug("Keyword spotter heard %r, which is %.0f%% similar to %r", heard, similarity * 100, phrase)
+
+        return phrase if similarity >= self.min_similarity else None
@@ -0,0 +1,420 @@
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Set
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class KoboldAPIError(Exception):
+    """A request to the KoboldAI API failed, or returned something unexpected"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status # the HTTP status, if the server responded with an error
+
+    @property
+    def unsupported(self) -> bool:
+        """Whether the server doesn't have the endpoint at all (e.g., a KoboldCPP-only one, on KoboldAI)"""
+        return self.status in (404, 405, 501)
+
+
+def backoff_delays(base_seconds: float, max_seconds: float) -> Iterator[float]:
+    """Exponentially increasing delays between retries, with some jitter, so that clients don't retry in lockstep"""
+
+    attempt = 0
+    while True:
+        delay = min(max_seconds, base_seconds * 2 ** attempt)
+        yield delay / 2 + random.uniform(0, delay / 2)
+        attempt += 1
+
+
+class Backend:
+    """
+    One KoboldAI API server: a pool of keep-alive connections to it, and
+    some bookkeeping on how busy and how healthy it is.
+    """
+
+    def __init__(self, generate_url: str, connect_timeout: float, read_timeout: float, unhealthy_seconds: float):
+        parsed_url = urllib.parse.urlsplit(generate_url)
+
+        self.scheme = parsed_url.scheme
+        self.netloc = parsed_url.netloc
+        self.generate_path = parsed_url.path or '/'
+        self.name = f"{self.scheme}://{self.netloc}"
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.unhealthy_seconds = unhealthy_seconds
+
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+        self._idle_connections = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Backend {self.name}>"
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.unhealthy_until = 0.0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.unhealthy_until = time.monotonic() + self.unhealthy_seconds
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+
+        connection = connection_class(self.netloc, timeout=self.connect_timeout)
+        connection.connect()
+
+        # the connect timeout is short; waiting for (more of) a response can take much longer
+        connection.sock.settimeout(self.read_timeout)
+
+        return connection
+
+    def _send(self, method: str, path: str, body: bytes, headers: dict):
+        while True:
+            with self._lock:
+                connection = self._idle_connections.pop() if self._idle_connections else None
+
+            reused = connection is not None
+            if not reused:
+                connection = self._new_connection()
+
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                return connection, connection.getresponse()
+
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+
+                # the server probably closed an idle keep-alive connection; try another
+                if not reused:
+                    raise
+
+            except BaseException:
+                connection.close()
+                raise
+
+    @contextmanager
+    def request(self, method: str, path: str, payload: dict, accept: str = 'application/json', count_failure: bool = True):
+        """
+        Send a request, yielding the response.  The connection goes back into the
+        pool for reuse if the response was read to the end, or is closed otherwise.
+        Raises KoboldAPIError if the request fails, recording the failure, unless
+        count_failure is False (for optional endpoints, which some servers don't
+        have, so that failing says nothing about whether they can generate).
+        """
+
+        body = json.dumps(payload).encode('utf8')
+        headers = {
+            'Content-Type': 'application/json; charset=utf-8',
+            'Accept': accept,
+            'Connection': 'keep-alive',
+        }
+
+        logger.debug("Calling %s%s with request %r", self.name, path, payload)
+
+        with self._lock:
+            self.in_flight += 1
+
+        connection = None
+        reusable = False
+        try:
+            connection, response = self._send(method, path, body, headers)
+
+            if response.status != 200:
+                response.read()
+                raise KoboldAPIError(f"{self.name}{path} returned HTTP {response.status} {response.reason}", status=response.status)
+
+            yield response
+
+            reusable = response.isclosed() and not response.will_close
+
+        except (OSError, http.client.HTTPException) as e:
+            if count_failure:
+                self.record_failure()
+            raise KoboldAPIError(f"{self.name}{path} failed with {e!r}") from e
+
+        except KoboldAPIError:
+            if count_failure:
+                self.record_failure()
+            raise
+
+        finally:
+            if connection is not None:
+                if reusable:
+                    with self._lock:
+                        self._idle_connections.append(connection)
+                else:
+                    connection.close()
+
+            with self._lock:
+                self.in_flight -= 1
+
+    def close(self):
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, []
+
+        for connection in idle_connections:
+            connection.close()
+
+
+def response_charset(response: http.client.HTTPResponse) -> str:
+    return response.msg.get_param('charset') or 'utf-8'
+
+
+class KoboldClient:
+    """
+    A client for one or more KoboldAI-compatible API servers.
+
+    Each request goes to the least loaded healthy backend, over a pooled
+    keep-alive connection, with connect and read timeouts.  A backend that
+    fails is marked unhealthy for a while, and the request is tried on the next
+    one.  Optionally, if a generate request hasn't completed after
+    hedge_after_seconds, the same request is sent to a second backend too, and
+    whichever responds first wins; the other is aborted.
+    """
+
+    def __init__(
+        self,
+        generate_urls: List[str],
+        stream_path: str,
+        token_count_path: str,
+        abort_path: str = '/api/extra/abort',
+        connect_timeout: float = 5.0,
+        read_timeout: float = 300.0,
+        unhealthy_seconds: float = 30.0,
+        hedge_after_seconds: Optional[float] = None,
+    ):
+        assert generate_urls, "KoboldClient needs at least one backend"
+
+        self.backends = [ Backend(generate_url, connect_timeout, read_timeout, unhealthy_seconds) for generate_url in generate_urls ]
+
+        self.stream_path = stream_path
+        self.token_count_path = token_count_path
+        self.abort_path = abort_path
+        self.hedge_after_seconds = hedge_after_seconds
+
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(self.backends), thread_name_prefix='kobold-client')
+
+        # the backends generating each request, by its genkey, so that abort() only stops those
+        self._generating = {}
+        self._generating_lock = threading.Lock()
+
+    def _choose_backend(self, exclude: Set[Backend], healthy_only: bool = False) -> Optional[Backend]:
+        candidates = [ backend for backend in self.backends if backend not in exclude ]
+        if healthy_only:
+            candidates = [ backend for backend in candidates if backend.is_healthy() ]
+
+        if not candidates:
+            return None
+
+        # prefer healthy backends, then the least loaded, then the most reliable lately
+        return min(candidates, key=lambda backend: (not backend.is_healthy(), backend.in_flight, backend.consecutive_failures))
+
+    @contextmanager
+    def _generating_on(self, backend: Backend, post_data: dict):
+        genkey = post_data.get('genkey')
+        if genkey is None:
+            yield
+            return
+
+        with self._generating_lock:
+            self._generating.setdefault(genkey, []).append(backend)
+
+        try:
+            yield
+
+        finally:
+            with self._generating_lock:
+                backends = self._generating[genkey]
+                backends.remove(backend)
+                if not backends:
+                    del self._generating[genkey]
+
+    def _generate_on(self, backend: Backend, post_data: dict) -> str:
+        with self._generating_on(backend, post_data), backend.request('POST', backend.generate_path, post_data) as response:
+            body = response.read().decode(response_charset(response))
+
+        try:
+            response_text = json.loads(body)['results'][0]['text']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            backend.record_failure()
+            raise KoboldAPIError(f"{backend.name} returned an unexpected response format: {body!r}") from e
+
+        backend.record_success()
+        return response_text
+
+    def _abort(self, backend: Backend, genkey: Optional[str] = None):
+        """Ask a backend to stop generating (best effort, supported by KoboldCPP only)"""
+        try:
+            with backend.request('POST', self.abort_path, {'genkey': genkey} if genkey else {}, count_failure=False) as response:
+                response.read()
+        except KoboldAPIError as e:
+            logger.debug("Couldn't abort generation on %s: %r", backend.name, e)
+
+    def abort(self, genkey: str):
+        """
+        Stop generating the response to the request with the given genkey (in its
+        post data), so that a blocked generate() returns (with whatever was
+        generated so far) and a stream() ends.  Only the backends still generating
+        it are asked to, since KoboldCPP only aborts that request in its multiuser
+        mode, and whatever it's generating otherwise.  Best effort.
+        """
+
+        with self._generating_lock:
+            backends = list(self._generating.get(genkey, ()))
+
+        for backend in backends:
+            self._abort(backend, genkey)
+
+    def _generate_hedged(self, primary: Backend, post_data: dict, tried: Set[Backend]) -> str:
+        futures = { self._executor.submit(self._generate_on, primary, post_data): primary }
+
+        done, _ = wait(futures, timeout=self.hedge_after_seconds)
+        if not done:
+            hedge = self._choose_backend(tried, healthy_only=True)
+            if hedge is not None:
+                logger.info("%s is slow to respond; also trying %s", primary.name, hedge.name)
+                tried.add(hedge)
+                futures[self._executor.submit(self._generate_on, hedge, post_data)] = hedge
+
+        last_error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response_text = future.result()
+                except KoboldAPIError as e:
+                    last_error = e
+                    continue
+
+                for loser in pending:
+                    self._executor.submit(self._abort, futures[loser], post_data.get('genkey'))
+
+                return response_text
+
+        raise last_error
+
+    def generate(self, post_data: dict) -> str:
+        """
+        Generate a response, returning its text.  Raises KoboldAPIError if
+        every backend failed.
+        """
+
+        tried = set()
+        errors = []
+        while True:
+            backend = self._choose_backend(tried)
+            if backend is None:
+                raise KoboldAPIError(f"All KoboldAI API backends failed: {errors!r}")
+
+            tried.add(backend)
+
+            try:
+                if self.hedge_after_seconds is not None and len(self.backends) > 1:
+                    return self._generate_hedged(backend, post_data, tried)
+                else:
+                    return self._generate_on(backend, post_data)
+
+            except KoboldAPIError as e:
+                logger.warning("%r", e)
+                errors.append(e)
+
+    def stream(self, post_data: dict) -> Iterator[str]:
+        """
+        Generate a response, yielding it token by token, via KoboldCPP's
+        server-sent events (SSE) streaming API.  Fails over to another
+        backend if one fails before sending anything.  Raises KoboldAPIError
+        if every backend failed, or if a backend fails part-way through.
+        """
+
+        tried = set()
+        errors = []
+        while True:
+            backend = self._choose_backend(tried)
+            if backend is None:
+                raise KoboldAPIError(f"All KoboldAI API backends failed: {errors!r}")
+
+            tried.add(backend)
+
+            yielded_tokens = False
+            try:
+                with self._generating_on(backend, post_data), backend.request('POST', self.stream_path, post_data, accept='text/event-stream') as response:
+                    charset = response_charset(response)
+
+                    for raw_line in response:
+                        line = raw_line.decode(charset).rstrip('\r\n')
+
+                        # we only care about the data lines of each event; the event
+                        # type is always 'message' for KoboldCPP
+                        if not line.startswith('data:'):
+                            continue
+
+                        try:
+                            token = json.loads(line[len('data:'):].strip())['token']
+                        except (ValueError, KeyError, TypeError) as e:
+                            raise KoboldAPIError(f"{backend.name} streamed an unexpected event format: {line!r}") from e
+
+                        if token:
+                            yielded_tokens = True
+                            yield token
+
+                backend.record_success()
+                return
+
+            except KoboldAPIError as e:
+                if yielded_tokens:
+                    raise
+
+                logger.warning("%r", e)
+                errors.append(e)
+
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens in text, per the LLM's tokenizer.  Raises KoboldAPIError on failure."""
+
+        backend = self._choose_backend(set())
+        # not every server has the token count endpoint
+        with backend.request('POST', self.token_count_path, {'prompt': text}, count_failure=False) as response:
+            body = response.read().decode(response_charset(response))
+
+        try:
+            return int(json.loads(body)['value'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise KoboldAPIError(f"{backend.name} returned an unexpected token count format: {body!r}") from e
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+        for backend in self.backends:
+            backend.close()
+
+
+def build_kobold_client(settings) -> KoboldClient:
+    return KoboldClient(
+        [settings.GENERATE_URL, *settings.EXTRA_GENERATE_URLS],
+        stream_path=urllib.parse.urlsplit(settings.GENERATE_STREAM_URL).path,
+        token_count_path=urllib.parse.urlsplit(settings.TOKEN_COUNT_URL).path,
+        connect_timeout=settings.API_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=settings.API_READ_TIMEOUT_SECONDS,
+        unhealthy_seconds=settings.API_UNHEALTHY_SECONDS,
+        hedge_after_seconds=settings.API_HEDGE_AFTER_SECONDS,
+    )
@@ -0,0 +1,170 @@
+import ctypes
+import ctypes.util
+import gc
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+def rss_bytes() -> Optional[int]:
+    """This process's resident set size (its memory use, roughly), or None if it's unavailable (e.g., not on Linux)"""
+
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def format_rss(rss: Optional[int]) -> str:
+    return f"{rss / 2**30:.2f}GB" if rss is not None else "unknown"
+
+
+def release_freed_memory():
+    """
+    Collect garbage, and ask glibc to give the freed memory back to the OS,
+    which it otherwise tends to keep, so that unloading a model barely reduces
+    the RSS.
+    """
+
+    gc.collect()
+
+    libc_path = ctypes.util.find_library('c')
+    if libc_path is None:
+        return
+
+    try:
+        ctypes.CDLL(libc_path).malloc_trim(0)
+    except (OSError, AttributeError):
+        # not glibc
+        pass
+
+
+# what the STT_PRECISION and TTS_PRECISION settings can be
+model_precisions = ('float32', 'int8')
+
+
+def check_precision(precision: str):
+    if precision not in model_precisions:
+        raise ValueError(f"Unknown model precision {precision!r}; choose from {model_precisions!r}")
+
+
+def quantize_int8(model):
+    """
+    Dynamically quantize a torch model's linear layers to int8, in place, for
+    CPU inference, which roughly quarters their memory use.  Subclasses of
+    torch.nn.Linear (such as whisper's) are replaced with plain ones first,
+    since torch only quantizes those.
+    """
+
+    import torch
+
+    def replace_linear_subclasses(module):
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+                linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                linear.load_state_dict(child.state_dict())
+                setattr(module, name, linear)
+            else:
+                replace_linear_subclasses(child)
+
+    replace_linear_subclasses(model)
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class ModelEvictor:
+    """
+    Unloads models that haven't been used for a while, to give their memory
+    back to everything else on the machine: after idle_seconds without use
+    (if idle_seconds isn't None), or when unload() is called (e.g., when the
+    assistant is told to sleep).  Models reload themselves when they're next
+    used, but restore_in_background() reloads them beforehand, so that they're
+    ready sooner.
+
+    Each of unloaders is called to unload a model, and each of loaders to load
+    one again.  touch() is called whenever the user needs the models, which
+    restores them, if they'd been unloaded.  The RSS is logged before and
+    after unloading and reloading.
+    """
+
+    def __init__(self, unloaders: List[Callable[[], None]], loaders: List[Callable[[], None]], idle_seconds: Optional[float] = None):
+        self.unloaders = unloaders
+        self.loaders = loaders
+        self.idle_seconds = idle_seconds
+
+        self._lock = threading.Lock()
+        self._last_used = time.monotonic()
+        self._unloaded = False
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='model-evictor', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed.set()
+
+    def touch(self):
+        with self._lock:
+            self._last_used = time.monotonic()
+            was_unloaded, self._unloaded = self._unloaded, False
+
+        if was_unloaded:
+            self.restore_in_background()
+
+    def _run(self):
+        while not self._closed.wait(5.0):
+            if self.idle_seconds is None:
+                continue
+
+            with self._lock:
+                idle = not self._unloaded and time.monotonic() - self._last_used >= self.idle_seconds
+
+            if idle:
+                logger.info("The models have been idle for %.0f minutes; unloading them.", self.idle_seconds / 60)
+                self.unload()
+
+    def unload(self, unloaders: Optional[List[Callable[[], None]]] = None):
+        """Unload the models (or just those unloaded by unloaders)"""
+
+        with self._lock:
+            self._unloaded = True
+
+        rss_before = rss_bytes()
+
+        for unload in (unloaders if unloaders is not None else self.unloaders):
+            unload()
+
+        release_freed_memory()
+
+        logger.info("Unloaded the models. RSS: %s before, %s after.", format_rss(rss_before), format_rss(rss_bytes()))
+
+    def restore_in_background(self):
+        """Start reloading the models, so that they're ready when they're next needed"""
+
+        def restore():
+            rss_before = rss_bytes()
+            start_time = time.perf_counter()
+
+            for load in self.loaders:
+                try:
+                    load()
+                except Exception as e:
+                    logger.exception("Reloading a model failed with %r; it'll be loaded when it's next used instead.", e)
+
+            logger.info("Reloaded the models in %.1fs. RSS: %s before, %s after.", time.perf_counter() - start_time, format_rss(rss_before), format_rss(rss_bytes()))
+
+        with self._lock:
+            self._last_used = time.monotonic()
+            self._unloaded = False
+
+        threading.Thread(target=restore, name='model-restorer', daemon=True).start()
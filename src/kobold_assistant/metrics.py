@@ -0,0 +1,241 @@
+import json
+import logging
+import logging.handlers
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterator, List, Optional
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already-sorted, non-empty list"""
+    # rounded first, so that floating point error (e.g., 0.3 * 10 == 3.0000000000000004) doesn't push it up a rank
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    index = min(len(sorted_values) - 1, max(0, rank - 1))
+    return sorted_values[index]
+
+
+class TurnMetrics:
+    """
+    Times each stage of each conversational turn (recognition, generation,
+    synthesis, and so on), so that slow turns can be attributed to the stage
+    that made them slow.
+
+    Each timed span is appended, as a line of JSON, to a size-rotated JSONL
+    file.  Summaries of recent spans, per stage, are also written to a file
+    in the Prometheus text exposition format, for a node exporter's textfile
+    collector to pick up.  Events that aren't timed (such as cache hits) are
+    counted the same way, with count().
+
+    Does nothing until configure()d.
+    """
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, window: int = 1000):
+        self.enabled = False
+
+        self._lock = threading.Lock()
+        self._turn = 0
+        self.turns_ended = 0
+        self._turn_started = None
+        self._first_audio_recorded = True
+
+        self._recent_spans = defaultdict(lambda: deque(maxlen=window))
+        self._span_sums = defaultdict(float)
+        self._span_counts = defaultdict(int)
+        self._event_counts = defaultdict(int)
+
+        self._jsonl_logger = None
+        self.prometheus_path = None
+
+    def configure(self, jsonl_path: Path, prometheus_path: Optional[Path], max_bytes: int = 10 * 1024 * 1024, backup_count: int = 3):
+        jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+
+        handler = logging.handlers.RotatingFileHandler(jsonl_path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+        self._jsonl_logger = logging.getLogger('kobold-assistant.metrics')
+        self._jsonl_logger.setLevel(logging.INFO)
+        self._jsonl_logger.propagate = False
+        self._jsonl_logger.addHandler(handler)
+
+        if prometheus_path is not None:
+            prometheus_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.prometheus_path = prometheus_path
+        self.enabled = True
+
+    def new_turn(self):
+        """Start timing a new turn, from the moment the user finished speaking"""
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._turn += 1
+            self._turn_started = time.perf_counter()
+            self._first_audio_recorded = False
+
+    def end_turn(self, responded: bool = True):
+        """
+        Finish timing the current turn.  responded=False means that it turned out
+        not to be a turn after all (e.g., nothing intelligible was said), so
+        its overall time isn't recorded.
+        """
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.turns_ended += 1
+            turn_seconds = time.perf_counter() - self._turn_started if self._turn_started is not None else None
+
+        if responded and turn_seconds is not None:
+            self.record('turn', turn_seconds)
+
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+
+    def record(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            turn = self._turn
+            self._recent_spans[stage].append(seconds)
+            self._span_sums[stage] += seconds
+            self._span_counts[stage] += 1
+
+        self._jsonl_logger.info(json.dumps({'ts': time.time(), 'turn': turn, 'stage': stage, 'seconds': round(seconds, 6)}))
+
+    def count(self, event: str):
+        """Count an occurrence of event, e.g., a cache hit"""
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            turn = self._turn
+            self._event_counts[event] += 1
+
+        self._jsonl_logger.info(json.dumps({'ts': time.time(), 'turn': turn, 'event': event}))
+
+    @contextmanager
+    def span(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def first_audio(self):
+        """Note that the assistant has started speaking its response, recording the latency of the turn"""
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if self._first_audio_recorded or self._turn_started is None:
+                return
+
+            self._first_audio_recorded = True
+            latency = time.perf_counter() - self._turn_started
+
+        self.record('first_audio', latency)
+
+    def write_prometheus(self):
+        lines = [
+            "# HELP kobold_assistant_stage_seconds Time spent in each stage of a conversational turn.",
+            "# TYPE kobold_assistant_stage_seconds summary",
+        ]
+
+        with self._lock:
+            for stage, recent_spans in sorted(self._recent_spans.items()):
+                sorted_spans = sorted(recent_spans)
+                for quantile in self.quantiles:
+                    lines.append(f'kobold_assistant_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {percentile(sorted_spans, quantile):.6f}')
+
+                lines.append(f'kobold_assistant_stage_seconds_sum{{stage="{stage}"}} {self._span_sums[stage]:.6f}')
+                lines.append(f'kobold_assistant_stage_seconds_count{{stage="{stage}"}} {self._span_counts[stage]}')
+
+            if self._event_counts:
+                lines.append("# HELP kobold_assistant_events_total Occurrences of each kind of event, such as cache hits.")
+                lines.append("# TYPE kobold_assistant_events_total counter")
+
+            for event, event_count in sorted(self._event_counts.items()):
+                lines.append(f'kobold_assistant_events_total{{event="{event}"}} {event_count}')
+
+        # write then rename, so that scrapers never see half a file
+        try:
+            with NamedTemporaryFile('w', dir=self.prometheus_path.parent, suffix='.tmp', delete=False) as fp:
+                fp.write("\n".join(lines) + "\n")
+
+            os.chmod(fp.name, 0o644)
+            os.replace(fp.name, self.prometheus_path)
+
+        except OSError as e:
+            logger.warning("Couldn't write metrics to %r: %r", str(self.prometheus_path), e)
+
+
+# TODO: make this non-global
+metrics = TurnMetrics()
+
+
+def read_spans(jsonl_path: Path) -> Iterator[dict]:
+    """Read all recorded spans, oldest first, including from rotated files"""
+
+    rotated_paths = sorted(
+        jsonl_path.parent.glob(jsonl_path.name + '.*'),
+        key=lambda path: int(path.suffix[1:]) if path.suffix[1:].isdigit() else 0,
+        reverse=True,
+    )
+
+    for path in [*rotated_paths, jsonl_path]:
+        try:
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        pass
+
+        except FileNotFoundError:
+            pass
+
+
+def print_stats(jsonl_path: Path):
+    """Print the count, mean and p50/p95/p99 of each stage's recorded spans, and the count of each event"""
+
+    spans_by_stage: Dict[str, List[float]] = defaultdict(list)
+    event_counts: Dict[str, int] = defaultdict(int)
+    for span in read_spans(jsonl_path):
+        if 'stage' in span and 'seconds' in span:
+            spans_by_stage[span['stage']].append(span['seconds'])
+        elif 'event' in span:
+            event_counts[span['event']] += 1
+
+    if not spans_by_stage and not event_counts:
+        print(f"No metrics recorded in {jsonl_path} yet.")
+        return
+
+    print(f"{'stage':<20} {'count':>7} {'mean (s)':>9} {'p50 (s)':>9} {'p95 (s)':>9} {'p99 (s)':>9}")
+
+    for stage, spans in sorted(spans_by_stage.items()):
+        spans.sort()
+        mean = sum(spans) / len(spans)
+        print(f"{stage:<20} {len(spans):>7} {mean:9.3f} {percentile(spans, 0.5):9.3f} {percentile(spans, 0.95):9.3f} {percentile(spans, 0.99):9.3f}")
+
+    if event_counts:
+        print(f"\n{'event':<28} {'count':>7}")
+
+        for event, event_count in sorted(event_counts.items()):
+            print(f"{event:<28} {event_count:>7}")
@@ -0,0 +1,359 @@
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+import speech_recognition as stt
+
+from .audio import PCMAudio
+from .stt_backends import STTBackend
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+# each message is a JSON header and a binary payload (raw PCM audio, if any),
+# preceded by their lengths
+message_lengths = struct.Struct('<II')
+
+
+class ModelHostError(RuntimeError):
+    """A request to the model host failed"""
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("connection closed")
+        received += n
+
+    return bytes(buffer)
+
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b''):
+    encoded_header = json.dumps(header).encode('utf8')
+    sock.sendall(message_lengths.pack(len(encoded_header), len(payload)) + encoded_header)
+    if payload:
+        sock.sendall(payload)
+
+
+def receive_message(sock: socket.socket) -> Tuple[dict, bytes]:
+    header_length, payload_length = message_lengths.unpack(_receive_exactly(sock, message_lengths.size))
+    header = json.loads(_receive_exactly(sock, header_length))
+    payload = _receive_exactly(sock, payload_length) if payload_length else b''
+    return header, payload
+
+
+class MicroBatcher:
+    """
+    Collects requests from many threads into small batches, for one worker
+    thread to process together.  A batch is started by the first request to
+    arrive, and waits up to batch_window_seconds for more (up to max_batch_size)
+    before process_batch(items) is called, returning a result per item, in order.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 4, batch_window_seconds: float = 0.02, name: str = 'batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.batch_window_seconds = batch_window_seconds
+
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Any:
+        """Process item as part of a batch, returning its result, or raising whatever processing it raised"""
+
+        future = Future()
+        self._requests.put((item, future))
+        return future.result()
+
+    def _next_batch(self) -> List[Tuple[Any, Future]]:
+        batch = [ self._requests.get() ]
+
+        deadline = time.monotonic() + self.batch_window_seconds
+        while len(batch) < self.max_batch_size:
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                break
+
+            try:
+                batch.append(self._requests.get(timeout=remaining_seconds))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            try:
+                results = self.process_batch([ item for item, _ in batch ])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class ModelHost:
+    """
+    Hosts the speech-to-text and text-to-speech models for several assistant
+    front ends (e.g., one per room or microphone) on the same machine, so that
+    each model is only loaded once.  Front ends connect over a Unix socket.
+
+    Concurrent requests are scheduled through a MicroBatcher per model, so that
+    each model runs one batch at a time, rather than having requests from
+    different rooms contend for the CPU.  Synthesis requests are synthesized
+    together, with TTSEngine.synthesize_batch(), and identical ones (such as
+    the same canned phrase from two rooms) are only synthesized once.
+    """
+
+    def __init__(self, stt_backend: STTBackend, tts_engine, socket_path: Path, max_batch_size: int = 4, batch_window_seconds: float = 0.02):
+        self.stt_backend = stt_backend
+        self.tts_engine = tts_engine
+        self.socket_path = socket_path
+
+        self._stt_batcher = MicroBatcher(self._recognize_batch, max_batch_size, batch_window_seconds, name='stt-batcher')
+        self._tts_batcher = MicroBatcher(self._synthesize_batch, max_batch_size, batch_window_seconds, name='tts-batcher')
+
+        self._server = None
+
+    def _recognize_batch(self, audios: List[stt.AudioData]) -> List[str]:
+        logger.debug("Recognizing a batch of %d utterances", len(audios))
+        return self.stt_backend.recognize_batch(audios)
+
+    def _synthesize_batch(self, requests: List[Tuple[str, bool]]) -> List[PCMAudio]:
+        logger.debug("Synthesizing a batch of %d texts", len(requests))
+
+        audios = {}
+        for cache in (False, True):
+            texts = list(dict.fromkeys(text for text, cache_text in requests if cache_text == cache))
+            if texts:
+                audios.update(zip([ (text, cache) for text in texts ], self.tts_engine.synthesize_batch(texts, cache=cache)))
+
+        return [ audios[request] for request in requests ]
+
+    def _handle(self, header: dict, payload: bytes) -> Tuple[dict, bytes]:
+        op = header.get('op')
+
+        if op == 'info':
+            return {
+                'tts_model_name': self.tts_engine.model_name,
+                'voice': list(self.tts_engine.voice),
+                'sample_rate': self.tts_engine.sample_rate,
+            }, b''
+
+        elif op == 'recognize':
+            audio = stt.AudioData(payload, header['sample_rate'], header['sample_width'])
+            return {'text': self._stt_batcher.submit(audio)}, b''
+
+        elif op == 'synthesize':
+            audio = self._tts_batcher.submit((header['text'], bool(header.get('cache', False))))
+            return {'sample_rate': audio.sample_rate, 'sample_width': audio.sample_width, 'channels': audio.channels}, bytes(audio.data)
+
+        raise ModelHostError(f"unknown operation {op!r}")
+
+    def serve_forever(self):
+        model_host = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        header, payload = receive_message(self.request)
+                    except (ConnectionError, OSError):
+                        return
+
+                    try:
+                        response_header, response_payload = model_host._handle(header, payload)
+                        response_header['ok'] = True
+                    except Exception as e:
+                        logger.exception("Model host request %r failed: %r", header.get('op'), e)
+                        response_header, response_payload = {'ok': False, 'error': repr(e)}, b''
+
+                    try:
+                        send_message(self.request, response_header, response_payload)
+                    except (ConnectionError, OSError):
+                        return
+
+        # a socket left behind by a previous run would stop us from listening
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+
+        self._server = socketserver.ThreadingUnixStreamServer(str(self.socket_path), Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+
+        logger.info("Model host listening on %r", str(self.socket_path))
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            try:
+                self.socket_path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ModelHostClient:
+    """
+    A connection to a ModelHost, for a front end.  Keeps a pool of
+    connections, so that several threads (e.g., speech recognition and speech
+    synthesis) can make requests at the same time.
+    """
+
+    def __init__(self, socket_path: Path, timeout: float = 300.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+        self._idle_connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(str(self.socket_path))
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    def request(self, header: dict, payload: bytes = b'') -> Tuple[dict, bytes]:
+        """Make a request of the model host, returning its response.  Raises ModelHostError on failure."""
+
+        with self._lock:
+            sock = self._idle_connections.pop() if self._idle_connections else None
+
+        # a pooled connection goes stale if the model host restarts, so that
+        # failing is retried once, on a fresh connection
+        while True:
+            pooled = sock is not None
+
+            try:
+                if sock is None:
+                    sock = self._connect()
+
+                send_message(sock, header, payload)
+                response_header, response_payload = receive_message(sock)
+                break
+
+            except (OSError, ValueError) as e:
+                if sock is not None:
+                    sock.close()
+                    sock = None
+
+                if pooled:
+                    logger.debug("Pooled connection to the model host failed with %r; reconnecting.", e)
+                    continue
+
+                raise ModelHostError(f"Model host request {header.get('op')!r} to {str(self.socket_path)!r} failed with {e!r}") from e
+
+        with self._lock:
+            self._idle_connections.append(sock)
+
+        if not response_header.get('ok'):
+            raise ModelHostError(f"Model host request {header.get('op')!r} failed: {response_header.get('error')}")
+
+        return response_header, response_payload
+
+    def close(self):
+        with self._lock:
+            idle_connections, self._idle_connections = self._idle_connections, []
+
+        for sock in idle_connections:
+            sock.close()
+
+
+class RemoteSTTBackend(STTBackend):
+    """Recognizes speech with the model host's STT backend"""
+
+    name = 'remote'
+
+    def __init__(self, client: ModelHostClient):
+        self.client = client
+
+    def recognize(self, audio: stt.AudioData) -> str:
+        header, _ = self.client.request(
+            {'op': 'recognize', 'sample_rate': audio.sample_rate, 'sample_width': audio.sample_width},
+            audio.frame_data,
+        )
+        return header['text']
+
+
+class RemoteTTSEngine:
+    """
+    Stands in for a TTSEngine, synthesizing speech with the model host's, which
+    also does the caching.  The model and voice are chosen by the model host's
+    settings.
+    """
+
+    cache = None
+
+    def __init__(self, client: ModelHostClient):
+        self.client = client
+
+        info = self._request_with_retries({'op': 'info'})[0]
+        self.model_name = info['tts_model_name']
+        self._voice = tuple(info['voice'])
+        self._sample_rate = info['sample_rate']
+
+        self.speed = self._voice[-1]
+
+    @property
+    def voice(self) -> Tuple:
+        return self._voice
+
+    @property
+    def sample_rate(self) -> Optional[int]:
+        return self._sample_rate
+
+    def _request_with_retries(self, header: dict) -> Tuple[dict, bytes]:
+        while True:
+            try:
+                return self.client.request(header)
+            except ModelHostError as e:
+                logger.error("%s. Is `kobold-assistant model-host` running? Retrying.", e)
+                time.sleep(1)
+
+    def load_model(self, model_name: str):
+        logger.warning("TTS_MODEL_NAME is chosen by the model host; change it in the model host's settings instead.")
+
+    def load(self):
+        pass
+
+    def unload(self):
+        # the model host's model is shared with other front ends, so it stays loaded
+        pass
+
+    def synthesize(self, text: str, cache: bool = False) -> PCMAudio:
+        assert text.strip() != "", "called synthesize() without any text"
+
+        header, payload = self._request_with_retries({'op': 'synthesize', 'text': text, 'cache': cache})
+        return PCMAudio(payload, header['sample_rate'], header['sample_width'], header['channels'])
+
+    def synthesize_batch(self, texts: List[str], cache: bool = False) -> List[PCMAudio]:
+        # requested concurrently, so that the model host can batch them together
+        with ThreadPoolExecutor(max_workers=max(1, len(texts)), thread_name_prefix='remote-tts') as executor:
+            return list(executor.map(lambda text: self.synthesize(text, cache=cache), texts))
@@ -0,0 +1,87 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Dict, Iterable
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+# mathematical formulae (like "2.5" or "x.y") and abbreviations (like "U.S.A." or "NASA")
+_component = r"([0-9]|[A-Za-z]+)"
+_term = _component + r"\." + _component
+_abbreviation = r"([A-Z](\.|)){2,}"
+expansion_re = re.compile(r"(" + _term + r"|" + _abbreviation + r"|" + r"\=" + r")")
+
+
+def literal_alternation(literals: Iterable[str]) -> str:
+    """
+    A regular expression matching any of the given literal strings, preferring
+    the longest.  The literals are merged into a trie first, so that the regex
+    engine checks each character of the text against one set of alternatives,
+    rather than trying every literal in turn at every position.
+    """
+
+    trie = {}
+    for literal in literals:
+        node = trie
+        for c in literal:
+            node = node.setdefault(c, {})
+        node[''] = {} # marks the end of a literal
+
+    def pattern_for(node: dict) -> str:
+        branches = [ re.escape(c) + pattern_for(child) for c, child in sorted(node.items()) if c != '' ]
+        if not branches:
+            return ''
+
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # a shorter literal ends here, but greedily try to match a longer one first
+            pattern = '(?:' + pattern + ')?'
+
+        return pattern
+
+    return pattern_for(trie)
+
+
+class TextNormalizer:
+    """
+    Turns LLM output into text that the TTS model can pronounce.  Built once, from
+    the settings, rather than on every call:
+
+    - remap() applies all of the AI_TEXT_TO_SPEECH_REMAPPINGS in one pass over the
+      text, using a single precompiled regex of all of the keys, which prefers
+      the longest match, so that "LOL!" wins over "LOL".  That barely slows down
+      as more remappings are added, and unlike applying each remapping in turn,
+      the result of one remapping is never remapped again.
+    - expand() spells out formulae and abbreviations in their pronounced word
+      form, with gruut.  The same few terms come up again and again, so their
+      expansions are memoized, in a bounded LRU cache.
+    """
+
+    def __init__(self, remappings: Dict[str, str], expansion_cache_size: int = 1024):
+        self.remappings = dict(remappings)
+
+        keys = [ key for key in self.remappings if key ]
+        self._remapping_re = re.compile(literal_alternation(keys)) if keys else None
+
+        self._expand_term = lru_cache(maxsize=expansion_cache_size)(self._expand_term_uncached)
+
+    def remap(self, text: str) -> str:
+        if self._remapping_re is None:
+            return text
+
+        return self._remapping_re.sub(lambda match: self.remappings[match.group(0)], text)
+
+    @staticmethod
+    def _expand_term_uncached(term: str) -> str:
+        import gruut # slow to import, and only needed once there's something to expand
+
+        return ' '.join([ s.text_spoken for s in gruut.sentences(term) ])
+
+    def expand(self, text: str) -> str:
+        """Detect mathematical formulae and abbreviations, and replace them"""
+        return expansion_re.sub(lambda match: self._expand_term(match.group(0)), text)
+
+    def cache_info(self):
+        return self._expand_term.cache_info()
@@ -0,0 +1,237 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+from .audio import PCMAudio
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class PlaybackEngine:
+    """
+    Speaks text in the background, as a two-stage pipeline: a synthesis thread
+    turns each queued chunk of text into audio, while a playback thread plays
+    the previous chunk.  Audio waits in a small bounded queue between the two,
+    so that chunks play back-to-back, without gaps, as long as synthesis keeps
+    up, and without synthesizing too far ahead of what's actually been heard.
+
+    synthesize(text, cache) must return something that play() can play.
+    play(audio, should_stop) should stop early if should_stop() returns True,
+    which it does once the audio has been cancelled.  While paused,
+    should_stop() blocks until playback is resumed (or cancelled), so that
+    play() stops where it was, and carries on from there.
+    """
+
+    def __init__(self, synthesize: Callable[[str, bool], Any], play: Callable[[Any, Callable[[], bool]], None], max_queued_audio: int = 2):
+        self._synthesize = synthesize
+        self._play = play
+
+        self._text_queue = queue.Queue()
+        self._audio_queue = queue.Queue(maxsize=max(1, max_queued_audio))
+
+        # everything queued is tagged with the generation it was queued in,
+        # so that cancel() can discard anything older, wherever it is in the pipeline
+        self._generation = 0
+        self._paused = False
+
+        self._pending = 0
+        self._idle = threading.Condition()
+
+        self._synthesis_thread = threading.Thread(target=self._synthesis_worker, name='tts-synthesis', daemon=True)
+        self._playback_thread = threading.Thread(target=self._playback_worker, name='tts-playback', daemon=True)
+
+        self._synthesis_thread.start()
+        self._playback_thread.start()
+
+    def say(self, text: str, cache: bool = False):
+        """Queue text to be spoken, returning immediately"""
+        with self._idle:
+            self._pending += 1
+            generation = self._generation
+
+        self._text_queue.put((generation, text, cache))
+
+    def wait(self):
+        """Block until everything queued so far has been spoken (or cancelled)"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def is_speaking(self) -> bool:
+        with self._idle:
+            return self._pending > 0
+
+    def pause(self):
+        """Hold playback where it is (within play()'s granularity), until resume() or cancel()"""
+        with self._idle:
+            self._paused = True
+
+    def resume(self):
+        with self._idle:
+            self._paused = False
+            self._idle.notify_all()
+
+    def cancel(self):
+        """
+        Discard everything that's queued, and stop what's currently playing,
+        if play() supports that.  Undoes pause(), for whatever's said next.
+        """
+        with self._idle:
+            self._generation += 1
+            self._paused = False
+            self._idle.notify_all()
+
+        for q in (self._text_queue, self._audio_queue):
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+
+                self._done()
+
+    def close(self, timeout: float = 5.0):
+        self.cancel()
+        self._text_queue.put(None)
+
+        self._synthesis_thread.join(timeout)
+        self._playback_thread.join(timeout)
+
+    def _done(self):
+        with self._idle:
+            self._pending -= 1
+            if self._pending <= 0:
+                self._pending = 0
+                self._idle.notify_all()
+
+    def _is_current(self, generation: int) -> bool:
+        with self._idle:
+            return generation == self._generation
+
+    def _should_stop(self, generation: int) -> bool:
+        with self._idle:
+            self._idle.wait_for(lambda: not self._paused or generation != self._generation)
+            return generation != self._generation
+
+    def _synthesis_worker(self):
+        while True:
+            item = self._text_queue.get()
+            if item is None:
+                self._audio_queue.put(None)
+                return
+
+            generation, text, cache = item
+            if not self._is_current(generation):
+                self._done()
+                continue
+
+            try:
+                audio = self._synthesize(text, cache)
+            except Exception as e:
+                logger.error("Couldn't synthesize speech for %r: %r", text, e)
+                self._done()
+                continue
+
+            self._audio_queue.put((generation, audio))
+
+    def _playback_worker(self):
+        while True:
+            item = self._audio_queue.get()
+            if item is None:
+                return
+
+            generation, audio = item
+            try:
+                if self._is_current(generation):
+                    self._play(audio, lambda: self._should_stop(generation))
+            except Exception as e:
+                logger.error("Couldn't play synthesized speech: %r", e)
+            finally:
+                self._done()
+
+
+class PyAudioOutput:
+    """
+    Plays PCMAudio through a single PyAudio output stream that's kept open
+    between utterances, so that there's no per-utterance setup cost and
+    back-to-back utterances play without gaps.  The stream is only reopened
+    if the audio format changes.
+    """
+
+    block_seconds = 0.1
+
+    def __init__(self, sample_rate: Optional[int] = None, sample_width: int = 2, channels: int = 1):
+        import pyaudio
+
+        self._pyaudio = pyaudio.PyAudio()
+        self._stream = None
+        self._stream_format = None
+
+        if sample_rate is not None:
+            self._open_stream((sample_rate, sample_width, channels))
+
+    def _open_stream(self, stream_format: Tuple[int, int, int]):
+        self._close_stream()
+
+        sample_rate, sample_width, channels = stream_format
+        self._stream = self._pyaudio.open(
+            format=self._pyaudio.get_format_from_width(sample_width),
+            channels=channels,
+            rate=sample_rate,
+            output=True,
+        )
+        self._stream_format = stream_format
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+
+    def play(self, audio: PCMAudio, should_stop: Optional[Callable[[], bool]] = None):
+        """Play audio, stopping early (within block_seconds) if should_stop() returns True"""
+
+        stream_format = (audio.sample_rate, audio.sample_width, audio.channels)
+        if self._stream is None or stream_format != self._stream_format:
+            self._open_stream(stream_format)
+
+        if should_stop is None:
+            self._stream.write(audio.data)
+            return
+
+        frame_size = audio.sample_width * audio.channels
+        block_size = int(audio.sample_rate * self.block_seconds) * frame_size
+
+        data = memoryview(audio.data).cast('B')
+        for block_start in range(0, len(data), block_size):
+            if should_stop():
+                break
+
+            self._stream.write(data[block_start:block_start + block_size])
+
+    def close(self):
+        self._close_stream()
+        self._pyaudio.terminate()
+
+
+class NullAudioOutput:
+    """
+    Discards audio, but takes as long to do so as playing it would, so that
+    the assistant can run headless (e.g., for benchmarking) with realistic timing.
+    """
+
+    block_seconds = 0.1
+
+    def play(self, audio: PCMAudio, should_stop: Optional[Callable[[], bool]] = None):
+        remaining_seconds = audio.duration
+        while remaining_seconds > 0:
+            if should_stop is not None and should_stop():
+                break
+
+            time.sleep(min(self.block_seconds, remaining_seconds))
+            remaining_seconds -= self.block_seconds
+
+    def close(self):
+        pass
@@ -1,4 +1,6 @@
 import os
+import sys
+import threading
 
 
 class RadioSilence:
@@ -53,3 +55,43 @@ class RadioSilence:
 
         for fd in fds_to_close:
             os.close(fd)
+
+
+class _ThreadFilteredStdout:
+    """sys.stdout stand-in that drops writes from threads inside a ThreadRadioSilence"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.silenced = threading.local()
+
+    def write(self, s):
+        if getattr(self.silenced, 'active', False):
+            return len(s)
+
+        return self.stdout.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+class ThreadRadioSilence:
+    """
+    Swallows Python-level stdout (print()s, such as Coqui TTS's chatter) from
+    the current thread only.  Unlike RadioSilence, which redirects the process's
+    file descriptors, this is safe to use from a background thread while other
+    threads are printing.
+    """
+
+    _install_lock = threading.Lock()
+
+    def __enter__(self):
+        with self._install_lock:
+            if not isinstance(sys.stdout, _ThreadFilteredStdout):
+                sys.stdout = _ThreadFilteredStdout(sys.stdout)
+
+            self.filtered_stdout = sys.stdout
+
+        self.filtered_stdout.silenced.active = True
+
+    def __exit__(self, *_):
+        self.filtered_stdout.silenced.active = False
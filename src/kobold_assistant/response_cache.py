@@ -0,0 +1,94 @@
+import difflib
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class ResponseCache:
+    """
+    Remembers the assistant's responses to things that users say over and over
+    (greetings, thanks, and so on), so that they can be answered again without
+    asking the LLM.
+
+    Responses are keyed on the user's (normalized) utterance, and on the
+    conversation state that the response depends on (such as the assistant's
+    persona), which the caller passes in.  If allow_list is non-empty, only
+    utterances at least min_similarity (0 to 1) similar to one of its phrases are
+    cached, and are keyed on that phrase, so that near misses from the
+    speech-to-text ("hello jenny" vs "hello jeny") share a response.
+    Otherwise, every utterance is cacheable, as is.
+
+    Entries expire after ttl_seconds, and the least recently used are evicted
+    beyond max_entries.  Hits and misses (of cacheable utterances) are counted.
+    """
+
+    def __init__(self, max_entries: int = 100, ttl_seconds: float = 3600, allow_list: Iterable[str] = (), min_similarity: float = 0.85):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.allow_list = [ phrase for phrase in allow_list if phrase ]
+        self.min_similarity = min_similarity
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (response, expiry time)
+
+    def cacheable_phrase(self, utterance: str) -> Optional[str]:
+        """The phrase that utterance (already normalized) is cached as, or None if it isn't cacheable"""
+
+        if not utterance:
+            return None
+
+        if not self.allow_list:
+            return utterance
+
+        best_similarity, best_phrase = max(
+            (difflib.SequenceMatcher(None, utterance, phrase).ratio(), phrase)
+            for phrase in self.allow_list
+        )
+
+        return best_phrase if best_similarity >= self.min_similarity else None
+
+    @staticmethod
+    def _key(phrase: str, state: Tuple[str, ...]) -> Tuple[str, str]:
+        return phrase, hashlib.sha256('\n'.join(state).encode('utf8')).hexdigest()
+
+    def get(self, phrase: str, state: Tuple[str, ...]) -> Optional[str]:
+        key = self._key(phrase, state)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        logger.debug("Response cache hit for %r (%d hits, %d misses so far)", phrase, self.hits, self.misses)
+        return entry[0]
+
+    def put(self, phrase: str, state: Tuple[str, ...], response: str):
+        key = self._key(phrase, state)
+
+        with self._lock:
+            self._entries[key] = (response, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
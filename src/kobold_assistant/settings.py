@@ -1,7 +1,14 @@
 import copy
 import json
+import logging
+import os
+import sys
+import threading
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+
+logger = logging.getLogger('kobold-assistant')
 
 
 class AttrDict(dict):
@@ -89,3 +96,149 @@ def build_settings():
             return None
 
     return AttrDict(**settings)
+
+
+def same_kind_of_value(value: Any, default_value: Any) -> bool:
+    if default_value is None:
+        return True # anything goes
+
+    if isinstance(default_value, bool) or isinstance(value, bool):
+        return isinstance(value, bool) and isinstance(default_value, bool)
+
+    if isinstance(default_value, (int, float)):
+        return isinstance(value, (int, float))
+
+    return isinstance(value, type(default_value))
+
+
+def validate_settings(settings: Dict[str, Any]) -> List[str]:
+    """
+    Check settings against the defaults: every default setting must still be
+    set, to the same kind of value (a number for a number, a list for a list,
+    and so on; anything for a default of null).  Returns a list of problems,
+    which is empty if the settings are OK.
+    """
+
+    with open(default_settings_path) as fp:
+        default_settings = json.load(fp)
+
+    problems = []
+    for name, default_value in default_settings.items():
+        if name not in settings:
+            problems.append(f"{name} is missing")
+
+        elif not same_kind_of_value(settings[name], default_value):
+            problems.append(f"{name} should be like {default_value!r}, not {settings[name]!r}")
+
+    return problems
+
+
+def settings_files_state() -> Tuple[Optional[Tuple[int, int]], ...]:
+    """The modification time and size of each settings file, or None for those that don't exist"""
+
+    state = []
+    for settings_path in settings_paths:
+        try:
+            settings_stat = os.stat(settings_path)
+            state.append((settings_stat.st_mtime_ns, settings_stat.st_size))
+        except OSError:
+            state.append(None)
+
+    return tuple(state)
+
+
+class SettingsWatcher:
+    """
+    Watches the settings files for changes, by polling, and reloads the
+    settings when any of them change.
+
+    The new settings are built (expanding templates) and validated in full
+    before anything is applied, and the old settings are kept if that fails.
+    Then prepare(changed_names, new_settings) is called, from the watcher's
+    thread, to build whatever depends on the settings that changed, which
+    rejects settings that are the right kind of value, but can't be used (such
+    as an unknown model name), and the old settings are kept if it raises.
+
+    Otherwise, the new settings are applied to the existing settings AttrDict
+    in place, in one go, so that everything holding a reference to it sees the
+    new settings.  Finally, on_change(changed_names, old_settings, prepared) is
+    called, with whatever prepare() returned, to put it in place.
+    """
+
+    def __init__(
+        self,
+        settings: AttrDict,
+        prepare: Callable[[Set[str], AttrDict], Any],
+        on_change: Callable[[Set[str], Dict[str, Any], Any], None],
+        poll_seconds: float = 2.0,
+    ):
+        self.settings = settings
+        self.prepare = prepare
+        self.on_change = on_change
+        self.poll_seconds = poll_seconds
+
+        self._files_state = settings_files_state()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='settings-watcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception("Reloading the settings failed: %r", e)
+
+    def check(self) -> bool:
+        """Reload the settings if the files have changed.  Returns whether they were reloaded."""
+
+        files_state = settings_files_state()
+        if files_state == self._files_state:
+            return False
+
+        self._files_state = files_state
+
+        try:
+            new_settings = build_settings()
+        except (OSError, ValueError) as e:
+            logger.error("Couldn't load the changed settings (%r); keeping the current settings.", e)
+            return False
+
+        if new_settings is None:
+            logger.error("Couldn't build the changed settings; keeping the current settings.")
+            return False
+
+        problems = validate_settings(new_settings)
+        if problems:
+            logger.error("The changed settings are invalid (%s); keeping the current settings.", "; ".join(problems))
+            return False
+
+        old_settings = dict(self.settings)
+        changed_names = { name for name in set(old_settings) | set(new_settings) if old_settings.get(name) != new_settings.get(name) }
+        if not changed_names:
+            return False
+
+        try:
+            prepared = self.prepare(changed_names, new_settings)
+        except Exception as e:
+            logger.exception("Couldn't apply the changed settings (%r); keeping the current settings.", e)
+            return False
+
+        # dict.update() with a dict of str keys happens entirely in C, holding
+        # the GIL, so no other thread sees a half-updated mix of settings
+        self.settings.update(new_settings)
+        for name in set(old_settings) - set(new_settings):
+            del self.settings[name]
+
+        logger.info("Settings reloaded; changed: %s", ", ".join(sorted(changed_names)))
+
+        self.on_change(changed_names, old_settings, prepared)
+
+        return True
@@ -0,0 +1,267 @@
+import audioop
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Iterator, Optional
+
+import speech_recognition as stt
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class Speculation:
+    """
+    A response being generated in the background, to a partial transcript of
+    what the user is saying.  Its tokens are collected as they arrive, so that
+    whoever ends up using it can replay them from the start.
+
+    Cancelling it calls abort() (if given), unless it's finished, to stop the
+    LLM generating it there and then, rather than only once the next token
+    arrives, which could be the whole response, if it isn't streamed.
+    """
+
+    def __init__(self, transcript: str, chat_state: str, tokens: Iterator[str], abort: Optional[Callable[[], None]] = None):
+        self.transcript = transcript
+        self.chat_state = chat_state # the prompt before the user's line, to check that nothing else has changed
+        self.abort = abort
+
+        self._tokens = []
+        self._done = False
+        self._error = None
+        self._cancelled = threading.Event()
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._collect, args=(tokens,), name='speculation', daemon=True)
+        self._thread.start()
+
+    def _collect(self, tokens: Iterator[str]):
+        try:
+            for token in tokens:
+                if self._cancelled.is_set():
+                    # closing a token stream closes its connection, which stops generation
+                    close = getattr(tokens, 'close', None)
+                    if close is not None:
+                        close()
+                    break
+
+                with self._condition:
+                    self._tokens.append(token)
+                    self._condition.notify_all()
+
+        except Exception as e:
+            self._error = e
+
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def cancel(self):
+        if self._cancelled.is_set():
+            return
+
+        self._cancelled.set()
+
+        with self._condition:
+            done = self._done
+
+        if not done and self.abort is not None:
+            self.abort()
+
+    def tokens(self) -> Iterator[str]:
+        """Yield the response's tokens, from the start, as they're generated.  Raises whatever generating them raised."""
+
+        i = 0
+        while True:
+            with self._condition:
+                while i >= len(self._tokens) and not self._done:
+                    self._condition.wait()
+
+                if i < len(self._tokens):
+                    token = self._tokens[i]
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+
+            i += 1
+            yield token
+
+
+class Speculator:
+    """
+    Starts generating the assistant's response while the user is still
+    speaking, so that the LLM's prompt processing (usually the slowest part)
+    overlaps with the end of the user's speech, and the wait to detect that
+    it has ended.
+
+    Whenever the user pauses, ContinuousCapture passes the utterance so far to
+    on_partial_utterance(), which recognizes it, in the background, with
+    recognize(audio).  If the transcript differs (per normalize()) from the one
+    being speculated on, the old speculation is cancelled, and speculate(transcript)
+    is asked to start a new one (or to return None, if it shouldn't be responded to).
+
+    Once the utterance ends, transcript_for() returns the partial transcript, if
+    the user said nothing more after the pause, saving recognizing it again.  Then,
+    take() returns the speculation, if it was for the same transcript and chat
+    state as the final one.  If not, it's cancelled, and the caller generates
+    the response as usual.
+    """
+
+    def __init__(
+        self,
+        recognize: Callable[[stt.AudioData], str],
+        speculate: Callable[[str], Optional[Speculation]],
+        normalize: Callable[[str], str],
+        energy_threshold: Callable[[], float],
+    ):
+        self.recognize = recognize
+        self.speculate = speculate
+        self.normalize = normalize
+        self.energy_threshold = energy_threshold
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._utterance_number = 0 # incremented by take(), so that partials of earlier utterances are ignored
+        self._partial_audio = None
+        self._partial_transcript = None # a Future
+        self._speculation = None
+
+        self._partials = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='speculator', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._partials.put(None)
+
+        with self._lock:
+            speculation, self._speculation = self._speculation, None
+
+        if speculation is not None:
+            speculation.cancel()
+
+    def on_partial_utterance(self, audio: stt.AudioData):
+        transcript = Future()
+
+        with self._lock:
+            self._partial_audio, self._partial_transcript = audio, transcript
+            utterance_number = self._utterance_number
+
+        self._partials.put((audio, transcript, utterance_number))
+
+    def _is_stale(self, transcript: Future, utterance_number: int) -> bool:
+        with self._lock:
+            return transcript is not self._partial_transcript or utterance_number != self._utterance_number
+
+    def _run(self):
+        while True:
+            partial = self._partials.get()
+            if partial is None:
+                return
+
+            audio, transcript, utterance_number = partial
+
+            # only the latest partial matters
+            if self._is_stale(transcript, utterance_number):
+                transcript.set_result(None)
+                continue
+
+            try:
+                text = self.recognize(audio).strip()
+            except Exception as e:
+                logger.warning("Recognizing a partial utterance failed with %r", e)
+                transcript.set_result(None)
+                continue
+
+            if text and not self._is_stale(transcript, utterance_number):
+                self._speculate_on(text, utterance_number)
+
+            transcript.set_result(text)
+
+    def _speculate_on(self, text: str, utterance_number: int):
+        with self._lock:
+            current_speculation = self._speculation
+
+        if current_speculation is not None and self.normalize(current_speculation.transcript) == self.normalize(text):
+            # the same as before, so just let it carry on
+            return
+
+        speculation = self.speculate(text)
+        if speculation is not None:
+            logger.debug("Speculatively generating a response to %r", text)
+
+        with self._lock:
+            if utterance_number != self._utterance_number:
+                # the utterance ended while we were starting on it
+                old_speculation, speculation = speculation, None
+            else:
+                old_speculation, self._speculation = self._speculation, speculation
+
+        if old_speculation is not None:
+            old_speculation.cancel()
+
+    def transcript_for(self, audio: stt.AudioData) -> Optional[str]:
+        """
+        The transcript of the last partial utterance, if audio is that, plus only
+        silence (waiting for it to be recognized, if need be), or None if the
+        user said anything more, so that audio needs recognizing itself.
+        """
+
+        with self._lock:
+            partial_audio, transcript = self._partial_audio, self._partial_transcript
+
+        if partial_audio is None:
+            return None
+
+        partial_frame_data = partial_audio.frame_data
+        if not audio.frame_data.startswith(partial_frame_data):
+            return None
+
+        rest = audio.frame_data[len(partial_frame_data):]
+        if rest and audioop.rms(rest, audio.sample_width) > self.energy_threshold():
+            return None
+
+        return transcript.result()
+
+    def _end_utterance(self) -> Optional[Speculation]:
+        with self._lock:
+            self._utterance_number += 1
+            self._partial_audio = self._partial_transcript = None
+            speculation, self._speculation = self._speculation, None
+
+        return speculation
+
+    def discard(self):
+        """
+        Cancel any speculation on the utterance, since it won't be responded to
+        (e.g., it was a command, or just noise).  Call instead of take().
+        """
+
+        speculation = self._end_utterance()
+        if speculation is not None:
+            logger.debug("Discarding the speculative response to %r, since the utterance isn't being responded to", speculation.transcript)
+            speculation.cancel()
+
+    def take(self, transcript: str, chat_state: str) -> Optional[Speculation]:
+        """
+        Return the speculation for the final transcript, if there's one for the
+        same transcript and chat state, or None.  Call once per utterance.
+        """
+
+        speculation = self._end_utterance()
+        if speculation is None:
+            return None
+
+        if speculation.chat_state == chat_state and self.normalize(speculation.transcript) == self.normalize(transcript):
+            self.hits += 1
+            logger.debug("Using the speculative response to %r (%d hits, %d misses so far)", speculation.transcript, self.hits, self.misses)
+            return speculation
+
+        self.misses += 1
+        logger.debug("Discarding the speculative response to %r, since the user said %r (%d hits, %d misses so far)", speculation.transcript, transcript, self.hits, self.misses)
+        speculation.cancel()
+        return None
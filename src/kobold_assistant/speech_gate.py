@@ -0,0 +1,108 @@
+import logging
+import threading
+from typing import Callable, NamedTuple
+
+import speech_recognition as stt
+
+from .metrics import metrics
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class SpeechScores(NamedTuple):
+    duration: float # seconds
+    speech_seconds: float # how much of the clip has speech-like frames
+    speech_ratio: float # speech_seconds / duration
+
+
+class SpeechGate:
+    """
+    Cheaply decides whether an utterance could be speech, before it's given to
+    the (expensive) speech-to-text model, so that noises that happen to be
+    loud enough to be captured (door slams, coughs, music, and so on) aren't
+    recognized at all.  Those otherwise take a full decode, only to come out as
+    nothing, or as one of the STT_HALLUCINATIONS.
+
+    The clip is split into short frames, and a frame counts as speech-like if
+    it's louder than energy_threshold(), has at least min_band_ratio of its
+    power in the speech band (300-3400Hz), and has a spectral flatness (how
+    noise-like, as opposed to tonal, it is; from 0 to 1) of at most
+    max_flatness.  The clip passes if it has at least min_speech_seconds of
+    such frames.  All of that is computed in a few vectorized numpy operations
+    over the whole clip.
+
+    How many clips are gated and passed is counted.
+    """
+
+    speech_band_hz = (300, 3400)
+
+    def __init__(
+        self,
+        energy_threshold: Callable[[], float],
+        min_speech_seconds: float = 0.2,
+        min_band_ratio: float = 0.4,
+        max_flatness: float = 0.4,
+        frame_seconds: float = 0.02,
+    ):
+        self.energy_threshold = energy_threshold
+        self.min_speech_seconds = min_speech_seconds
+        self.min_band_ratio = min_band_ratio
+        self.max_flatness = max_flatness
+        self.frame_seconds = frame_seconds
+
+        self.gated = 0
+        self.passed = 0
+        self._lock = threading.Lock()
+
+    def score(self, audio: stt.AudioData) -> SpeechScores:
+        import numpy as np
+
+        frame_data = audio.frame_data if audio.sample_width == 2 else audio.get_raw_data(convert_width=2)
+        samples = np.frombuffer(frame_data, dtype='<i2')
+
+        duration = len(samples) / audio.sample_rate
+        frame_length = max(int(audio.sample_rate * self.frame_seconds), 2)
+        frame_count = len(samples) // frame_length
+        if frame_count == 0:
+            return SpeechScores(duration, 0.0, 0.0)
+
+        frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length).astype(np.float32)
+
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+
+        power = np.abs(np.fft.rfft(frames * np.hanning(frame_length).astype(np.float32), axis=1)) ** 2
+        power = power[:, 1:] + 1e-10 # without DC, and never zero, for the log below
+        freqs = np.fft.rfftfreq(frame_length, 1.0 / audio.sample_rate)[1:]
+
+        band = (freqs >= self.speech_band_hz[0]) & (freqs <= self.speech_band_hz[1])
+        total_power = power.sum(axis=1)
+        band_ratio = power[:, band].sum(axis=1) / total_power
+
+        # geometric mean over arithmetic mean: high for noise, near 0 for voiced (harmonic) sounds
+        flatness = np.exp(np.mean(np.log(power), axis=1)) / (total_power / power.shape[1])
+
+        speech_frames = (rms > self.energy_threshold()) & (band_ratio >= self.min_band_ratio) & (flatness <= self.max_flatness)
+        speech_seconds = float(np.count_nonzero(speech_frames)) * frame_length / audio.sample_rate
+
+        return SpeechScores(duration, speech_seconds, speech_seconds / duration)
+
+    def is_speech(self, audio: stt.AudioData) -> bool:
+        scores = self.score(audio)
+        passed = scores.speech_seconds >= self.min_speech_seconds
+
+        with self._lock:
+            if passed:
+                self.passed += 1
+            else:
+                self.gated += 1
+
+        metrics.count('stt_decoded' if passed else 'stt_gated')
+
+        if not passed:
+            logger.debug(
+                "Not recognizing a %.1fs clip with only %.2fs (%.0f%%) of speech-like audio (%d gated, %d passed so far)",
+                scores.duration, scores.speech_seconds, scores.speech_ratio * 100, self.gated, self.passed,
+            )
+
+        return passed
@@ -0,0 +1,190 @@
+import logging
+import threading
+from typing import List, Optional
+
+import speech_recognition as stt
+
+from .audio import WhisperSampleConverter
+from .memory import check_precision, quantize_int8
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class STTBackend:
+    """A speech-to-text engine, which turns recorded speech into text"""
+
+    name = None
+
+    def recognize(self, audio: stt.AudioData) -> str:
+        raise NotImplementedError()
+
+    def recognize_batch(self, audios: List[stt.AudioData]) -> List[str]:
+        """Recognize several utterances, e.g., from different rooms.  Backends that can decode a batch at once should override this."""
+        return [ self.recognize(audio) for audio in audios ]
+
+    def load(self):
+        """Load the model now, if it's not loaded already, rather than when it's next needed"""
+        pass
+
+    def unload(self):
+        """Free the model's memory; it's loaded again when it's next needed"""
+        pass
+
+
+class WhisperSamplesBackend(STTBackend):
+    """
+    A whisper-based backend, which is given the captured audio directly, as
+    16kHz float32 samples (see WhisperSampleConverter), rather than as a WAV
+    file to decode and resample again.
+    """
+
+    def __init__(self):
+        # the converter's buffers are reused, so only one utterance can be converted (and recognized) at a time
+        self._converter = WhisperSampleConverter()
+        self._lock = threading.Lock()
+
+    def recognize(self, audio: stt.AudioData) -> str:
+        frame_data = audio.frame_data if audio.sample_width == 2 else audio.get_raw_data(convert_width=2)
+
+        with self._lock:
+            return self.recognize_samples(self._converter.convert(frame_data, audio.sample_rate))
+
+    def recognize_samples(self, samples) -> str:
+        """Recognize 16kHz mono float32 samples"""
+        raise NotImplementedError()
+
+
+# whisper models, by name and precision, shared by all WhisperBackends (e.g., after the STT settings are reloaded)
+_whisper_models = {}
+_whisper_models_lock = threading.Lock()
+
+
+class WhisperBackend(WhisperSamplesBackend):
+    """
+    OpenAI's reference whisper implementation.  With precision='int8', the
+    model's linear layers are quantized, for a CPU.
+    """
+
+    name = 'whisper'
+
+    def __init__(self, model: str, language: str, initial_prompt: Optional[str] = None, precision: str = 'float32'):
+        check_precision(precision)
+
+        super().__init__()
+        self.model_name = model
+        self.language = language.lower()
+        self.initial_prompt = initial_prompt
+        self.precision = precision
+
+    @property
+    def model(self):
+        with _whisper_models_lock:
+            model = _whisper_models.get((self.model_name, self.precision))
+            if model is None:
+                import whisper
+
+                model = whisper.load_model(self.model_name, device='cpu' if self.precision == 'int8' else None)
+                if self.precision == 'int8':
+                    model = quantize_int8(model)
+
+                _whisper_models[(self.model_name, self.precision)] = model
+
+        return model
+
+    def load(self):
+        self.model
+
+    def unload(self):
+        with _whisper_models_lock:
+            _whisper_models.pop((self.model_name, self.precision), None)
+
+    def recognize_samples(self, samples) -> str:
+        import torch
+
+        result = self.model.transcribe(
+            samples,
+            language=self.language,
+            initial_prompt=self.initial_prompt,
+            fp16=torch.cuda.is_available(),
+        )
+
+        return result['text']
+
+
+class FasterWhisperBackend(WhisperSamplesBackend):
+    """
+    Whisper, via faster-whisper's CTranslate2 port, which can run quantized
+    (e.g., int8) models, and is typically several times faster than the
+    reference implementation on a CPU, with similar accuracy.
+    """
+
+    name = 'faster-whisper'
+
+    def __init__(self, model: str, language: str, device: str = 'cpu', compute_type: str = 'int8', cpu_threads: int = 0, beam_size: int = 1, initial_prompt: Optional[str] = None):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("The faster-whisper STT_BACKEND needs the faster-whisper package. Install it with `pip install faster-whisper`.")
+
+        from whisper.tokenizer import TO_LANGUAGE_CODE
+
+        super().__init__()
+
+        self._load_model = lambda: WhisperModel(model, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+        self._model_lock = threading.Lock()
+        self._model = self._load_model()
+        self.language = TO_LANGUAGE_CODE.get(language.lower(), language.lower())
+        self.beam_size = beam_size
+        self.initial_prompt = initial_prompt
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = self._load_model()
+
+            return self._model
+
+    def load(self):
+        self.model
+
+    def unload(self):
+        with self._model_lock:
+            self._model = None
+
+    def recognize_samples(self, samples) -> str:
+        segments, _ = self.model.transcribe(samples, language=self.language, beam_size=self.beam_size, initial_prompt=self.initial_prompt)
+
+        # segments is a lazy generator; transcription happens as we iterate it
+        return "".join(segment.text for segment in segments)
+
+
+stt_backend_names = (WhisperBackend.name, FasterWhisperBackend.name)
+
+
+def build_stt_backend(settings, backend_name: Optional[str] = None, model: Optional[str] = None, initial_prompt: Optional[str] = None) -> STTBackend:
+    """
+    Build the STT backend chosen by settings.STT_BACKEND (or backend_name, if given),
+    using settings.WHISPER_MODEL (or model, if given).  initial_prompt, if given,
+    biases recognition towards the words in it.
+    """
+
+    backend_name = backend_name or settings.STT_BACKEND
+    model = model or settings.WHISPER_MODEL
+
+    if backend_name == WhisperBackend.name:
+        return WhisperBackend(model, settings.LANGUAGE, initial_prompt=initial_prompt, precision=settings.STT_PRECISION)
+
+    elif backend_name == FasterWhisperBackend.name:
+        return FasterWhisperBackend(
+            model,
+            settings.LANGUAGE,
+            device=settings.STT_DEVICE,
+            compute_type=settings.STT_COMPUTE_TYPE,
+            cpu_threads=settings.STT_CPU_THREADS,
+            beam_size=settings.STT_BEAM_SIZE,
+            initial_prompt=initial_prompt,
+        )
+
+    raise ValueError(f"Unknown STT_BACKEND {backend_name!r}; choose from {stt_backend_names!r}")
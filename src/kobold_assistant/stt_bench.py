@@ -0,0 +1,88 @@
+import logging
+import time
+from typing import List
+
+import speech_recognition as stt
+
+from .fixtures import Fixture
+from .stt_backends import build_stt_backend
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+def normalize_words(text: str) -> List[str]:
+    return "".join(c for c in text.lower() if c.isalnum() or c.isspace() or c == "'").split()
+
+
+def word_error_rate(transcript: str, recognized: str) -> float:
+    """Word-level edit distance between what was said and what was recognized, per word said"""
+
+    reference = normalize_words(transcript)
+    hypothesis = normalize_words(recognized)
+
+    previous_row = list(range(len(hypothesis) + 1))
+    for i, reference_word in enumerate(reference, start=1):
+        row = [i]
+        for j, hypothesis_word in enumerate(hypothesis, start=1):
+            row.append(min(
+                previous_row[j] + 1, # deletion
+                row[j - 1] + 1, # insertion
+                previous_row[j - 1] + (reference_word != hypothesis_word), # substitution
+            ))
+        previous_row = row
+
+    return previous_row[-1] / max(1, len(reference))
+
+
+def audio_duration(audio: stt.AudioData) -> float:
+    return len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+
+
+def run_stt_benchmark(settings, fixtures: List[Fixture], backend_names: List[str], models: List[str]):
+    """
+    Recognize each fixture with each combination of STT backend and model, and
+    print the load time (including a first, warm-up recognition), real-time
+    factor (RTF: time taken to recognize, divided by the length of the audio;
+    lower is faster, and anything over 1.0 can't keep up with speech), and
+    word error rate (WER) of each.
+    """
+
+    total_audio_seconds = sum(audio_duration(fixture.audio) for fixture in fixtures)
+    print(f"Benchmarking on {len(fixtures)} fixtures, {total_audio_seconds:.1f}s of audio in total.\n")
+
+    print(f"{'backend':<16} {'model':<12} {'load (s)':>9} {'RTF':>7} {'WER':>7}")
+
+    for backend_name in backend_names:
+        for model in models:
+            start_time = time.perf_counter()
+            try:
+                backend = build_stt_backend(settings, backend_name=backend_name, model=model)
+
+                # the first recognition includes one-off setup costs, which we don't want to measure
+                backend.recognize(fixtures[0].audio)
+
+            except Exception as e:
+                logger.error("Couldn't load STT backend %r with model %r: %r", backend_name, model, e)
+                continue
+
+            load_seconds = time.perf_counter() - start_time
+
+            recognize_seconds = 0.0
+            error_rates = []
+            for fixture in fixtures:
+                start_time = time.perf_counter()
+                recognized = backend.recognize(fixture.audio)
+                recognize_seconds += time.perf_counter() - start_time
+
+                logger.debug("%s/%s recognized %r as %r", backend_name, model, str(fixture.path), recognized)
+
+                if fixture.transcript is not None:
+                    error_rates.append(word_error_rate(fixture.transcript, recognized))
+
+            rtf = recognize_seconds / total_audio_seconds
+            wer = f"{sum(error_rates) / len(error_rates):7.1%}" if error_rates else f"{'n/a':>7}"
+
+            print(f"{backend_name:<16} {model:<12} {load_seconds:9.1f} {rtf:7.3f} {wer}")
+
+            del backend
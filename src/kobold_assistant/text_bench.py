@@ -0,0 +1,84 @@
+import logging
+import time
+from typing import Callable, Dict
+
+from .normalizer import TextNormalizer, expansion_re
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+# a long, chatty LLM response, with the kinds of things that need remapping or expanding
+sample_response_paragraph = (
+    "Sure! LOL, that's a great question 🤔 (pauses) The U.S.A. has about 330 million people, "
+    "and the formula is E=mc2, where c is roughly 3.0 times ten to the eight metres per second. "
+    "NASA measured it to 2.5 decimal places, which is pretty good (laughs) 😊 "
+    "Honestly, ROFL, I love that you asked. The U.K. and the E.U. use SI units, so 1.5 km is 1500 m. "
+    "Would you like to know more? 😀 "
+)
+
+
+def sequential_remap(text: str, remappings: Dict[str, str]) -> str:
+    """The old way of remapping: one str.replace() pass over the text per remapping, for comparison"""
+    for remap_key, remap_val in remappings.items():
+        text = text.replace(remap_key, remap_val)
+    return text
+
+
+def uncached_expand(text: str) -> str:
+    """The old way of expanding: a gruut pass for every match, for comparison"""
+    import gruut
+
+    return expansion_re.sub(lambda match: ' '.join([ s.text_spoken for s in gruut.sentences(match.group(0)) ]), text)
+
+
+def time_per_call(function: Callable[[str], str], text: str, iterations: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        function(text)
+    return (time.perf_counter() - start_time) / iterations
+
+
+def run_text_benchmark(settings, paragraphs: int = 20, iterations: int = 20):
+    """
+    Time remapping and expanding a long LLM response, the old way and with
+    TextNormalizer, both as one whole response, and sentence by sentence, as
+    when responses are streamed.
+    """
+
+    remappings = settings.AI_TEXT_TO_SPEECH_REMAPPINGS
+    normalizer = TextNormalizer(remappings)
+
+    response = sample_response_paragraph * paragraphs
+    sentences = [ sentence + '.' for sentence in response.split('.') if sentence.strip() ]
+
+    assert normalizer.remap(response) == sequential_remap(response, remappings), "single-pass remapping differs from sequential remapping"
+
+    print(f"Normalizing a {len(response)} character response ({len(sentences)} sentences), with {len(remappings)} remappings.\n")
+
+    print(f"{'stage':<28} {'old (ms)':>10} {'new (ms)':>10} {'speedup':>8}")
+
+    def report(stage: str, old_seconds: float, new_seconds: float):
+        print(f"{stage:<28} {old_seconds * 1000:10.3f} {new_seconds * 1000:10.3f} {old_seconds / new_seconds:7.1f}x")
+
+    report(
+        "remap (whole response)",
+        time_per_call(lambda text: sequential_remap(text, remappings), response, iterations),
+        time_per_call(normalizer.remap, response, iterations),
+    )
+
+    report(
+        "remap (per sentence)",
+        sum(time_per_call(lambda text: sequential_remap(text, remappings), sentence, iterations) for sentence in sentences),
+        sum(time_per_call(normalizer.remap, sentence, iterations) for sentence in sentences),
+    )
+
+    # fewer iterations, since gruut is slow; the first call warms up the memo
+    # of expansions, as the first few responses would
+    report(
+        "expand (whole response)",
+        time_per_call(uncached_expand, response, max(1, iterations // 10)),
+        time_per_call(normalizer.expand, response, max(1, iterations // 10)),
+    )
+
+    logger.debug("expansion cache: %r", normalizer.cache_info())
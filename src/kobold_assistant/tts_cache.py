@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any, Optional, Tuple
+
+from .audio import PCMAudio
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class TTSCache:
+    """
+    Persistent cache of synthesized speech, so that phrases that come up again
+    (greetings, canned responses, common answers) don't need to be synthesized
+    again, even after a restart.
+
+    Entries are grouped by voice (the TTS model, speaker, language, and speed,
+    that is, everything other than the text that affects the audio), with one
+    directory per voice, and one file of raw PCM per (expanded) text.  The
+    total size on disk is capped, evicting the least recently used entries
+    first.  A small number of entries are also kept in memory.
+    """
+
+    file_magic = b'KAPCM1'
+    file_header = struct.Struct('<6sIBB') # magic, sample rate, sample width, channels
+
+    def __init__(self, cache_dir: Path, max_bytes: int, max_memory_entries: int = 32):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.max_bytes = max_bytes
+        self.max_memory_entries = max_memory_entries
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._disk_bytes = sum(entry_path.stat().st_size for entry_path in self.cache_dir.glob('*/*.pcm'))
+
+    @staticmethod
+    def _hash(value: Any) -> str:
+        return hashlib.sha256(json.dumps(value).encode('utf8')).hexdigest()[:32]
+
+    def _entry_path(self, voice: Tuple, text: str) -> Path:
+        return self.cache_dir / self._hash(voice) / f"{self._hash(text)}.pcm"
+
+    def get(self, voice: Tuple, text: str) -> Optional[PCMAudio]:
+        entry_path = self._entry_path(voice, text)
+
+        with self._lock:
+            audio = self._memory.get(entry_path)
+            if audio is not None:
+                self._memory.move_to_end(entry_path)
+                return audio
+
+        try:
+            with open(entry_path, 'rb') as fp:
+                magic, sample_rate, sample_width, channels = self.file_header.unpack(fp.read(self.file_header.size))
+                if magic != self.file_magic:
+                    logger.warning("Ignoring corrupt TTS cache entry %r", str(entry_path))
+                    return None
+
+                audio = PCMAudio(fp.read(), sample_rate, sample_width, channels)
+
+            # the mtime is the entry's last use, for LRU eviction
+            os.utime(entry_path)
+
+        except FileNotFoundError:
+            return None
+
+        except (OSError, struct.error) as e:
+            logger.warning("Couldn't read TTS cache entry %r: %r", str(entry_path), e)
+            return None
+
+        self._remember(entry_path, audio)
+        return audio
+
+    def put(self, voice: Tuple, text: str, audio: PCMAudio):
+        entry_path = self._entry_path(voice, text)
+        self._remember(entry_path, audio)
+
+        voice_dir = entry_path.parent
+        try:
+            if not voice_dir.exists():
+                voice_dir.mkdir(parents=True, exist_ok=True)
+                with open(voice_dir / 'voice.json', 'w') as fp:
+                    json.dump(voice, fp)
+
+            # overwriting an entry (e.g., one written by another process meanwhile) doesn't add its size again
+            try:
+                old_size = entry_path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+
+            # write then rename, so that other processes never see half an entry
+            with NamedTemporaryFile(dir=voice_dir, suffix='.tmp', delete=False) as fp:
+                fp.write(self.file_header.pack(self.file_magic, audio.sample_rate, audio.sample_width, audio.channels))
+                fp.write(audio.data)
+
+            os.replace(fp.name, entry_path)
+
+        except OSError as e:
+            logger.warning("Couldn't write TTS cache entry %r: %r", str(entry_path), e)
+            return
+
+        with self._lock:
+            self._disk_bytes += self.file_header.size + len(audio.data) - old_size
+            if self._disk_bytes > self.max_bytes:
+                self._evict()
+
+    def invalidate(self, voice: Tuple, text: str):
+        """Delete the entry for a text, e.g., once it's no longer going to be said"""
+
+        entry_path = self._entry_path(voice, text)
+
+        with self._lock:
+            self._memory.pop(entry_path, None)
+
+            try:
+                size = entry_path.stat().st_size
+                entry_path.unlink()
+            except FileNotFoundError:
+                return
+
+            self._disk_bytes -= size
+
+    def invalidate_voice(self, voice: Tuple):
+        """Delete all entries for a voice, e.g., once it's no longer in use"""
+
+        voice_dir = self.cache_dir / self._hash(voice)
+
+        with self._lock:
+            for entry_path in list(self._memory):
+                if entry_path.parent == voice_dir:
+                    del self._memory[entry_path]
+
+            for entry_path in voice_dir.glob('*'):
+                try:
+                    size = entry_path.stat().st_size
+                    entry_path.unlink()
+                except FileNotFoundError:
+                    continue
+
+                if entry_path.suffix == '.pcm':
+                    self._disk_bytes -= size
+
+            try:
+                voice_dir.rmdir()
+            except OSError:
+                pass
+
+    def _remember(self, entry_path: Path, audio: PCMAudio):
+        with self._lock:
+            self._memory[entry_path] = audio
+            self._memory.move_to_end(entry_path)
+
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self):
+        """Delete least recently used entries until we're within the size cap again.  Call with _lock held."""
+
+        entries = []
+        for entry_path in self.cache_dir.glob('*/*.pcm'):
+            try:
+                entry_stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+
+        entries.sort()
+
+        self._disk_bytes = sum(size for _, size, _ in entries)
+
+        # evict down to 90% of the cap, so that we're not doing this for every new entry
+        target_bytes = self.max_bytes * 0.9
+        for _, size, entry_path in entries:
+            if self._disk_bytes <= target_bytes:
+                break
+
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+
+            self._memory.pop(entry_path, None)
+            self._disk_bytes -= size
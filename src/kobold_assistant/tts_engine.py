@@ -0,0 +1,272 @@
+import logging
+import threading
+import time
+from tempfile import NamedTemporaryFile
+from typing import List, Optional, Tuple
+
+from .audio import PCMAudio, float_to_pcm16
+from .memory import check_precision, quantize_int8
+from .radio_silence import ThreadRadioSilence
+from .tts_cache import TTSCache
+
+
+logger = logging.getLogger('kobold-assistant')
+
+
+class TTSEngine:
+    """
+    Turns text into speech audio with a Coqui TTS model, checking the TTS cache first.
+
+    By default, the model's waveform is converted to PCM in memory.  If that isn't
+    possible for the model in use, or in_memory is False, we fall back to having
+    the TTS library write a WAV file, and reading that back in.
+
+    synthesize_batch() synthesizes several sentences at once, in padded batches,
+    where the model supports that (currently, single-speaker VITS models, such
+    as the default), which makes better use of the CPU's cores than
+    synthesizing each sentence with its own, small, forward pass.
+
+    With precision='int8', the model's linear layers are quantized, for a CPU.
+    unload() frees the model, which is loaded again when it's next needed.
+    """
+
+    def __init__(self, model_name: str, speed: float, cache: Optional[TTSCache] = None, in_memory: bool = True, precision: str = 'float32'):
+        check_precision(precision)
+
+        self.speed = speed
+        self.cache = cache
+        self.in_memory = in_memory
+        self.precision = precision
+
+        # serializes use of the model, which may be called from the playback
+        # engine's synthesis thread as well as the main thread
+        self._lock = threading.Lock()
+
+        self.load_model(model_name)
+
+    def load_model(self, model_name: str):
+        """
+        Load a TTS model, replacing the current one, if any (e.g., when the
+        TTS_MODEL_NAME setting changes).  The current model keeps synthesizing
+        until the new one is ready.
+        """
+
+        model, speaker, language = self._load(model_name)
+
+        with self._lock:
+            self.model_name = model_name
+            self.model = model
+            self.speaker = speaker
+            self.language = language
+            self._sample_rate = self.sample_rate
+
+    def _load(self, model_name: str):
+        # Coqui TTS pulls in torch, which takes seconds to import, so it's
+        # only imported once something actually needs to synthesize speech
+        from TTS.api import TTS
+
+        # models are (re)loaded while other threads are printing (e.g., after being
+        # unloaded, or when the settings change), so only this thread's output is silenced
+        with ThreadRadioSilence():
+            model = TTS(model_name)
+
+        tts_model = getattr(getattr(model, 'synthesizer', None), 'tts_model', None)
+        if self.precision == 'int8' and tts_model is not None:
+            model.synthesizer.tts_model = quantize_int8(tts_model)
+
+        # TODO: Choose (or obtain from config) the best speaker
+        #       in a better way, per model.
+        speaker = None
+        if model.speakers is not None and len(model.speakers) > 0:
+            speaker = model.speakers[0]
+
+        # TODO: Choose (or obtain from config) the best language in a better
+        #       way, based on locale.
+        language = None
+        if model.languages is not None and len(model.languages) > 0:
+            language = model.languages[0]
+
+        return model, speaker, language
+
+    def load(self):
+        """Load the model again, if it's been unloaded, rather than when it's next needed"""
+
+        with self._lock:
+            self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        # called with the lock held
+        if self.model is None:
+            self.model, self.speaker, self.language = self._load(self.model_name)
+
+    def unload(self):
+        with self._lock:
+            self.model = None
+
+    @property
+    def voice(self) -> Tuple:
+        """Everything other than the text that affects how synthesized speech sounds"""
+        return (self.model_name, self.speaker, self.language, self.speed)
+
+    @property
+    def sample_rate(self) -> Optional[int]:
+        if self.model is None:
+            # unloaded
+            return self._sample_rate
+
+        synthesizer = getattr(self.model, 'synthesizer', None)
+        if synthesizer is None:
+            return None
+
+        return synthesizer.output_sample_rate
+
+    def _tts_params(self, text: str) -> dict:
+        params = {
+            "emotion": "Happy",
+            "speed": self.speed,
+            "text": text,
+        }
+
+        if self.speaker is not None:
+            params['speaker'] = self.speaker
+
+        if self.language is not None:
+            params['language'] = self.language
+
+        return params
+
+    def _synthesize_in_memory(self, text: str) -> PCMAudio:
+        waveform = self.model.tts(**self._tts_params(text))
+        return float_to_pcm16(waveform, self.sample_rate)
+
+    def _can_synthesize_batches(self) -> bool:
+        tts_model = getattr(getattr(self.model, 'synthesizer', None), 'tts_model', None)
+
+        # multi-speaker/multi-lingual models would need speaker and language ids for each sentence, too
+        return (
+            self.in_memory
+            and type(tts_model).__name__ == 'Vits'
+            and self.speaker is None
+            and self.language is None
+        )
+
+    def _synthesize_padded_batch(self, texts: List[str]) -> List[PCMAudio]:
+        import torch
+
+        tts_model = self.model.synthesizer.tts_model
+        device = next(tts_model.parameters()).device
+        hop_length = tts_model.config.audio.hop_length
+
+        token_ids = [ tts_model.tokenizer.text_to_ids(text) for text in texts ]
+        x_lengths = torch.tensor([ len(ids) for ids in token_ids ], dtype=torch.long, device=device)
+
+        x = torch.zeros((len(texts), int(x_lengths.max())), dtype=torch.long, device=device)
+        for i, ids in enumerate(token_ids):
+            x[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+
+        with torch.no_grad():
+            outputs = tts_model.inference(x, aux_input={'x_lengths': x_lengths})
+
+        # trim each waveform back to its own length, dropping the padding
+        y_lengths = outputs['y_mask'].sum(dim=(1, 2)).long() * hop_length
+        waveforms = outputs['model_outputs'][:, 0, :].cpu().numpy()
+
+        return [ float_to_pcm16(waveforms[i, :int(y_lengths[i])], self.sample_rate) for i in range(len(texts)) ]
+
+    def _synthesize_via_file(self, text: str) -> PCMAudio:
+        from pydub import AudioSegment
+
+        with NamedTemporaryFile(suffix='.wav') as audio_file:
+            self.model.tts_to_file(file_path=audio_file.name, **self._tts_params(text))
+            audio = AudioSegment.from_wav(audio_file.name)
+
+        return PCMAudio(audio.raw_data, audio.frame_rate, audio.sample_width, audio.channels)
+
+    def synthesize(self, text: str, cache: bool = False) -> PCMAudio:
+        """
+        Synthesize text, which should already be expanded to its pronounced form.
+        Anything synthesized with cache=True is added to the cache.
+        """
+
+        assert text.strip() != "", "called synthesize() without any text"
+
+        if self.cache is not None:
+            cached_audio = self.cache.get(self.voice, text)
+            if cached_audio is not None:
+                return cached_audio
+
+        audio = None
+        while audio is None:
+            try:
+                with self._lock, ThreadRadioSilence():
+                    self._ensure_loaded()
+                    if self.in_memory and self.sample_rate is not None:
+                        audio = self._synthesize_in_memory(text)
+                    else:
+                        audio = self._synthesize_via_file(text)
+
+            except Exception as e:
+                logger.error(
+                    "WARNING:"
+                    " TTS model %r threw error %r. Retrying. If this keeps failing,"
+                    " override the TTS_MODEL_NAME setting, and/or file a bug if it's the"
+                    " default setting.",
+                    self.model_name,
+                    e,
+                )
+                time.sleep(1) # because the loop doesn't respond to Ctrl-C otherwise
+
+        if self.cache is not None and cache:
+            self.cache.put(self.voice, text, audio)
+
+        return audio
+
+    def synthesize_batch(self, texts: List[str], cache: bool = False, max_batch_size: int = 8) -> List[PCMAudio]:
+        """
+        Synthesize several texts (e.g., the sentences of a long response, or
+        phrases to pre-render into the cache), returning their audio in the
+        same order.  Texts are batched with others of similar length, to keep
+        the padding down.  Falls back to synthesizing one at a time if the model
+        can't do batches, or a batch fails.
+        """
+
+        audios = [ None ] * len(texts)
+
+        uncached_indices = {}
+        for i, text in enumerate(texts):
+            assert text.strip() != "", "called synthesize_batch() with an empty text"
+
+            cached_audio = self.cache.get(self.voice, text) if self.cache is not None else None
+            if cached_audio is not None:
+                audios[i] = cached_audio
+            else:
+                uncached_indices.setdefault(text, []).append(i)
+
+        uncached_texts = sorted(uncached_indices, key=len)
+
+        for start in range(0, len(uncached_texts), max_batch_size):
+            batch_texts = uncached_texts[start:start + max_batch_size]
+
+            batch_audios = None
+            if len(batch_texts) > 1:
+                try:
+                    with self._lock, ThreadRadioSilence():
+                        self._ensure_loaded()
+                        if self._can_synthesize_batches():
+                            batch_audios = self._synthesize_padded_batch(batch_texts)
+
+                except Exception as e:
+                    logger.warning("Batched synthesis with TTS model %r failed with %r; synthesizing one at a time instead.", self.model_name, e)
+
+            if batch_audios is None:
+                batch_audios = [ self.synthesize(text, cache=cache) for text in batch_texts ]
+
+            elif self.cache is not None and cache:
+                for text, audio in zip(batch_texts, batch_audios):
+                    self.cache.put(self.voice, text, audio)
+
+            for text, audio in zip(batch_texts, batch_audios):
+                for i in uncached_indices[text]:
+                    audios[i] = audio
+
+        return audios
@@ -0,0 +1,49 @@
+import json
+
+from kobold_assistant.chat_log import ChatHistory
+
+
+def write_records(path, records):
+    path.write_text(''.join(record if isinstance(record, str) else json.dumps(record) + '\n' for record in records))
+
+
+def test_load_without_a_file(tmp_path):
+    assert ChatHistory(tmp_path / 'history.jsonl').load() == (None, [])
+
+
+def test_load_skips_corrupt_records(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    write_records(path, [
+        {'ts': 1, 'line': 'User: Hi'},
+        'not json at all\n',
+        {'ts': 2, 'line': 'Jenny: Hello!'},
+        '{"ts": 3, "line": "User: half-writ',
+    ])
+
+    assert ChatHistory(path).load() == (None, ['User: Hi', 'Jenny: Hello!'])
+
+
+def test_load_returns_the_latest_summary_and_the_lines_since(tmp_path):
+    path = tmp_path / 'history.jsonl'
+    write_records(path, [
+        {'ts': 1, 'line': 'User: Hi'},
+        {'ts': 2, 'line': 'Jenny: Hello!'},
+        {'ts': 3, 'summary': 'They said hello.', 'through': 1},
+        {'ts': 4, 'line': 'User: How are you?'},
+        '{corrupt\n',
+        {'ts': 5, 'summary': 'They greeted each other.', 'through': 2},
+        {'ts': 6, 'line': 'Jenny: Fine, thanks.'},
+    ])
+
+    assert ChatHistory(path).load() == ('They greeted each other.', ['User: How are you?', 'Jenny: Fine, thanks.'])
+
+
+def test_rewrite_keeps_only_the_summary_and_the_lines_since(tmp_path):
+    history = ChatHistory(tmp_path / 'history.jsonl')
+    history.append_line('User: Hi')
+    history.append_line('Jenny: Hello!')
+
+    history.rewrite('They said hello.', ['User: How are you?'])
+    history.append_line('Jenny: Fine, thanks.')
+
+    assert history.load() == ('They said hello.', ['User: How are you?', 'Jenny: Fine, thanks.'])
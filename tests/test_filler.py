@@ -0,0 +1,48 @@
+import pytest
+
+from kobold_assistant.filler import LatencyModel
+
+
+def test_no_prediction_without_timings():
+    assert LatencyModel().predict(100) is None
+
+
+def test_predicts_the_mean_of_too_few_timings():
+    model = LatencyModel()
+    model.record(100, 1.0)
+    model.record(1000, 3.0)
+
+    assert model.predict(5000) == pytest.approx(2.0)
+
+
+def test_fits_a_line_through_the_timings():
+    model = LatencyModel()
+    for tokens in (100, 200, 400, 800):
+        model.record(tokens, 0.5 + 0.01 * tokens)
+
+    assert model.predict(1000) == pytest.approx(10.5)
+    assert model.predict(0) == pytest.approx(0.5)
+
+
+def test_ignores_a_negative_slope():
+    model = LatencyModel()
+    for tokens, seconds in ((100, 3.0), (200, 2.0), (300, 1.0)):
+        model.record(tokens, seconds)
+
+    assert model.predict(1000) == pytest.approx(2.0)
+
+
+def test_same_length_prompts_predict_their_mean():
+    model = LatencyModel()
+    for seconds in (1.0, 2.0, 3.0):
+        model.record(500, seconds)
+
+    assert model.predict(500) == pytest.approx(2.0)
+
+
+def test_only_the_latest_timings_count():
+    model = LatencyModel(window=3)
+    for seconds in (100.0, 1.0, 1.0, 1.0):
+        model.record(500, seconds)
+
+    assert model.predict(500) == pytest.approx(1.0)
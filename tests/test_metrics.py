@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from kobold_assistant.metrics import percentile, read_spans
+
+
+@pytest.mark.parametrize('fraction, expected', [
+    (0.0, 1),
+    (0.1, 1),
+    (0.3, 3),
+    (0.5, 5),
+    (0.51, 6),
+    (0.9, 9),
+    (0.95, 10),
+    (1.0, 10),
+])
+def test_percentile_is_nearest_rank(fraction, expected):
+    assert percentile(list(range(1, 11)), fraction) == expected
+
+
+def test_percentile_of_one_value():
+    assert percentile([7.0], 0.5) == 7.0
+    assert percentile([7.0], 0.99) == 7.0
+
+
+def test_percentile_of_100_values():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+
+
+def test_read_spans_reads_rotated_files_oldest_first(tmp_path):
+    jsonl_path = tmp_path / 'metrics.jsonl'
+
+    for path, stage in [
+        (tmp_path / 'metrics.jsonl.2', 'oldest'),
+        (tmp_path / 'metrics.jsonl.1', 'older'),
+        (jsonl_path, 'newest'),
+    ]:
+        path.write_text(json.dumps({'stage': stage, 'seconds': 1.0}) + '\n')
+
+    assert [ span['stage'] for span in read_spans(jsonl_path) ] == ['oldest', 'older', 'newest']
+
+
+def test_read_spans_skips_corrupt_lines(tmp_path):
+    jsonl_path = tmp_path / 'metrics.jsonl'
+    jsonl_path.write_text('{"stage": "stt", "seconds": 0.5}\n{"stage": "tts", "sec\n{"event": "response_cache_hit"}\n')
+
+    assert list(read_spans(jsonl_path)) == [ {'stage': 'stt', 'seconds': 0.5}, {'event': 'response_cache_hit'} ]
+
+
+def test_read_spans_without_a_file(tmp_path):
+    assert list(read_spans(tmp_path / 'missing.jsonl')) == []
@@ -0,0 +1,24 @@
+from kobold_assistant.normalizer import TextNormalizer
+
+
+def test_remap_prefers_the_longest_match():
+    normalizer = TextNormalizer({'LOL': 'laugh out loud', 'LOL!': 'ha ha!'})
+
+    assert normalizer.remap("LOL! That's funny. LOL") == "ha ha! That's funny. laugh out loud"
+
+
+def test_remap_prefers_the_longest_match_with_a_shared_prefix():
+    normalizer = TextNormalizer({'*': '', '**': ' ', '***': '. '})
+
+    assert normalizer.remap('a***b**c*d') == 'a. b cd'
+
+
+def test_remap_never_remaps_a_remapping():
+    normalizer = TextNormalizer({'a': 'b', 'b': 'c'})
+
+    assert normalizer.remap('ab') == 'bc'
+
+
+def test_remap_without_remappings():
+    assert TextNormalizer({}).remap('unchanged') == 'unchanged'
+    assert TextNormalizer({'': 'ignored'}).remap('unchanged') == 'unchanged'
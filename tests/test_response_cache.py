@@ -0,0 +1,77 @@
+import pytest
+
+from kobold_assistant import response_cache
+from kobold_assistant.response_cache import ResponseCache
+
+
+state = ('You are a helpful assistant.',)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(response_cache, 'time', clock)
+    return clock
+
+
+def test_hit_and_miss():
+    cache = ResponseCache()
+    cache.put('hello', state, 'Hi there!')
+
+    assert cache.get('hello', state) == 'Hi there!'
+    assert cache.get('goodbye', state) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_the_state_is_part_of_the_key():
+    cache = ResponseCache()
+    cache.put('hello', state, 'Hi there!')
+
+    assert cache.get('hello', ('You are a pirate.',)) is None
+
+
+def test_entries_expire(clock):
+    cache = ResponseCache(ttl_seconds=60)
+    cache.put('hello', state, 'Hi there!')
+
+    clock.now += 59
+    assert cache.get('hello', state) == 'Hi there!'
+
+    clock.now += 2
+    assert cache.get('hello', state) is None
+
+
+def test_evicts_the_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', state, 'A')
+    cache.put('b', state, 'B')
+    cache.get('a', state)
+    cache.put('c', state, 'C')
+
+    assert cache.get('a', state) == 'A'
+    assert cache.get('b', state) is None
+    assert cache.get('c', state) == 'C'
+
+
+def test_similar_utterances_share_the_allowed_phrase():
+    cache = ResponseCache(allow_list=['hello jenny', 'thank you'], min_similarity=0.85)
+
+    assert cache.cacheable_phrase('hello jenny') == 'hello jenny'
+    assert cache.cacheable_phrase('hello jeny') == 'hello jenny'
+    assert cache.cacheable_phrase('thank you jenny') is None
+    assert cache.cacheable_phrase('what time is it') is None
+
+
+def test_without_an_allow_list_everything_is_cacheable_as_is():
+    cache = ResponseCache()
+
+    assert cache.cacheable_phrase('what time is it') == 'what time is it'
+    assert cache.cacheable_phrase('') is None
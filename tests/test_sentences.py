@@ -0,0 +1,36 @@
+from kobold_assistant.__main__ import split_into_sentences
+
+
+def test_yields_each_sentence_once_its_complete():
+    tokens = ['Hel', 'lo there', '! How', ' are', ' you?', ' I', "'m fine."]
+
+    assert list(split_into_sentences(tokens, [])) == ['Hello there!', 'How are you?', "I'm fine."]
+
+
+def test_yields_sentences_as_the_tokens_arrive():
+    sentences = split_into_sentences(iter(['One. ', 'Two', ' three.']), [])
+
+    assert next(sentences) == 'One.'
+    assert list(sentences) == ['Two three.']
+
+
+def test_doesnt_split_numbers_or_abbreviations():
+    tokens = ['Pi is about 3.', '14 in the U.S.A', '. too. Yes.']
+
+    assert list(split_into_sentences(tokens, [])) == ['Pi is about 3.14 in the U.S.A.', 'too.', 'Yes.']
+
+
+def test_splits_at_line_breaks_and_after_closing_quotes():
+    tokens = ['She said "Hi." Then', ' left\n\nThe end']
+
+    assert list(split_into_sentences(tokens, [])) == ['She said "Hi."', 'Then left', 'The end']
+
+
+def test_stops_at_a_stop_word():
+    tokens = ['Sure. Anything', ' else?\nUs', 'er: What about', ' this?']
+
+    assert list(split_into_sentences(tokens, ['\nUser:'])) == ['Sure.', 'Anything else?']
+
+
+def test_nothing_but_whitespace():
+    assert list(split_into_sentences(['  ', '\n'], [])) == []
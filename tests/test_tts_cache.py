@@ -0,0 +1,99 @@
+import os
+import shutil
+
+from kobold_assistant.audio import PCMAudio
+from kobold_assistant.tts_cache import TTSCache
+
+
+voice = ('tts_models/en/ljspeech/vits', None, None, 1.0)
+other_voice = ('tts_models/en/vctk/vits', 'p225', None, 1.0)
+
+
+def audio(data: bytes = b'\x00\x01' * 50) -> PCMAudio:
+    return PCMAudio(data, 22050, 2)
+
+
+def entry_size(entry_audio: PCMAudio) -> int:
+    return TTSCache.file_header.size + len(entry_audio.data)
+
+
+def test_round_trip_through_disk(tmp_path):
+    TTSCache(tmp_path, max_bytes=10000).put(voice, 'hello', audio())
+
+    # a new cache, as after a restart, has nothing in memory
+    assert TTSCache(tmp_path, max_bytes=10000).get(voice, 'hello') == audio()
+
+
+def test_miss(tmp_path):
+    cache = TTSCache(tmp_path, max_bytes=10000)
+    cache.put(voice, 'hello', audio())
+
+    assert cache.get(voice, 'goodbye') is None
+    assert cache.get(other_voice, 'hello') is None
+
+
+def test_memory_keeps_the_most_recently_used(tmp_path):
+    cache = TTSCache(tmp_path, max_bytes=10000, max_memory_entries=2)
+    cache.put(voice, 'a', audio(b'a'))
+    cache.put(voice, 'b', audio(b'b'))
+    cache.get(voice, 'a')
+    cache.put(voice, 'c', audio(b'c'))
+
+    # without the files, only what's still in memory is found
+    shutil.rmtree(tmp_path)
+
+    assert cache.get(voice, 'a') == audio(b'a')
+    assert cache.get(voice, 'b') is None
+    assert cache.get(voice, 'c') == audio(b'c')
+
+
+def test_disk_evicts_the_least_recently_used(tmp_path):
+    cache = TTSCache(tmp_path, max_bytes=3 * entry_size(audio()) - 1, max_memory_entries=0)
+    cache.put(voice, 'a', audio())
+    cache.put(voice, 'b', audio())
+
+    # make the last uses unambiguous, then use 'a', making 'b' the least recently used
+    os.utime(cache._entry_path(voice, 'a'), (1, 1))
+    os.utime(cache._entry_path(voice, 'b'), (2, 2))
+    assert cache.get(voice, 'a') is not None
+
+    cache.put(voice, 'c', audio())
+
+    assert cache.get(voice, 'a') is not None
+    assert cache.get(voice, 'b') is None
+    assert cache.get(voice, 'c') is not None
+
+
+def test_overwriting_an_entry_doesnt_count_it_twice(tmp_path):
+    cache = TTSCache(tmp_path, max_bytes=10000)
+    cache.put(voice, 'a', audio())
+    cache.put(voice, 'a', audio())
+
+    assert cache._disk_bytes == entry_size(audio())
+
+
+def test_invalidate_voice(tmp_path):
+    cache = TTSCache(tmp_path, max_bytes=10000)
+    cache.put(voice, 'a', audio())
+    cache.put(voice, 'b', audio())
+    cache.put(other_voice, 'a', audio())
+
+    cache.invalidate_voice(voice)
+
+    assert cache.get(voice, 'a') is None
+    assert cache.get(voice, 'b') is None
+    assert cache.get(other_voice, 'a') == audio()
+    assert cache._disk_bytes == entry_size(audio())
+    assert not cache._entry_path(voice, 'a').parent.exists()
+
+
+def test_invalidate(tmp_path):
+    cache = TTSCache(tmp_path, max_bytes=10000)
+    cache.put(voice, 'a', audio())
+    cache.put(voice, 'b', audio())
+
+    cache.invalidate(voice, 'a')
+
+    assert cache.get(voice, 'a') is None
+    assert cache.get(voice, 'b') == audio()
+    assert cache._disk_bytes == entry_size(audio())